@@ -1,9 +1,74 @@
 #!/usr/bin/python3.9
 
-from json import loads as json_loads
+from ctypes import (
+	CDLL,
+	c_char_p,
+	c_int,
+	c_long,
+	c_size_t,
+	c_ubyte,
+	c_ulong,
+	c_void_p,
+	get_errno
+)
+from ctypes.util import find_library
+from bz2 import (
+	BZ2File,
+	compress as bz2_compress,
+	decompress as bz2_decompress
+)
+from collections import deque
+from contextlib import ExitStack,contextmanager
+from concurrent.futures import (
+	ProcessPoolExecutor,
+	ThreadPoolExecutor
+)
+from errno import ENOSYS,ENXIO
+from fcntl import LOCK_EX,LOCK_NB,LOCK_UN,flock,ioctl
+from gzip import GzipFile
+from hashlib import sha256
+from json import (
+	dumps as json_dumps,
+	loads as json_loads
+)
+from mmap import mmap
+from lzma import (
+	LZMAFile,
+	compress as lzma_compress,
+	decompress as lzma_decompress
+)
+from os import (
+	O_APPEND,O_CREAT,O_DIRECT,O_EXCL,O_RDONLY,O_RDWR,O_TRUNC,O_WRONLY,
+	POSIX_FADV_DONTNEED,POSIX_FADV_WILLNEED,PRIO_PROCESS,
+	SEEK_DATA,SEEK_END,SEEK_HOLE,
+	close,fsencode,fstat,fsync,ftruncate,lseek,major,minor,
+	open as os_open,posix_fadvise,pread,preadv,pwrite,
+	chmod as os_chmod,chown as os_chown,link,setpriority,stat,strerror,sysconf,
+	unlink,urandom,utime,write as os_write
+)
+from os.path import realpath
 from pathlib import Path
+from platform import machine
+from random import Random
+from re import (
+	finditer as re_finditer,
+	sub as re_sub
+)
 from typing import Mapping,Optional,Union
+from struct import (
+	calcsize as struct_calcsize,
+	pack as struct_pack,
+	unpack as struct_unpack
+)
 from subprocess import run as sub_run
+from tempfile import gettempdir
+from threading import Lock,get_ident,get_native_id
+from time import monotonic,sleep
+from zlib import (
+	compress as zlib_compress,
+	crc32 as zlib_crc32,
+	decompress as zlib_decompress
+)
 
 _RET_ALL=0
 _RET_RETURNCODE=1
@@ -16,6 +81,229 @@ _FSTYPE_FAT32="fat32"
 _FSTYPE_NTFS="ntfs"
 _FSTYPE_EXFAT="exfat"
 _FSTYPE_EXT4="ext4"
+_FSTYPE_SQUASHFS="squashfs"
+_FSTYPE_EROFS="erofs"
+
+# Compressed read-only filesystems
+# The default compressors favour fast reads over the smallest size
+
+_ARCHIVE_COMPRESSORS={
+	_FSTYPE_SQUASHFS:"zstd",
+	_FSTYPE_EROFS:"lz4hc",
+}
+
+# mount(2) and umount2(2) flags (see <sys/mount.h>)
+
+_MS_RDONLY=1
+_MS_NOSUID=2
+_MS_NODEV=4
+_MS_NOEXEC=8
+_MS_SYNCHRONOUS=16
+_MS_REMOUNT=32
+_MS_NOATIME=1024
+_MS_NODIRATIME=2048
+_MS_BIND=4096
+_MS_REC=16384
+_MS_RELATIME=2097152
+
+_MNT_FORCE=1
+_MNT_DETACH=2
+
+_MOUNT_OPTION_FLAGS={
+	"rw":0,
+	"auto":0,
+	"defaults":0,
+	"ro":_MS_RDONLY,
+	"nosuid":_MS_NOSUID,
+	"nodev":_MS_NODEV,
+	"noexec":_MS_NOEXEC,
+	"sync":_MS_SYNCHRONOUS,
+	"noatime":_MS_NOATIME,
+	"nodiratime":_MS_NODIRATIME,
+	"relatime":_MS_RELATIME,
+	"bind":_MS_BIND,
+	"rbind":_MS_BIND|_MS_REC,
+}
+
+_PROC_MOUNTINFO="/proc/self/mountinfo"
+_SYSFS_BLOCK="/sys/block"
+
+_LIBC_CACHE={}
+
+# Loop device ioctls (linux/loop.h)
+# struct loop_info64 is 232 bytes, and lo_flags is at offset 52
+
+_LOOP_CLR_FD=0x4C01
+_LOOP_SET_STATUS64=0x4C04
+_LOOP_GET_STATUS64=0x4C05
+_LOOP_INFO64_SIZE=232
+_LOOP_INFO64_FLAGS="<I"
+_LOOP_INFO64_FLAGS_OFFSET=52
+_LO_FLAGS_AUTOCLEAR=4
+
+# Page cache
+# Residency is checked with mincore(2) over windows of the file, so huge files do not need huge page vectors
+
+_PAGE_SIZE=sysconf("SC_PAGE_SIZE")
+_PROT_READ=1
+_MAP_SHARED=1
+_MAP_FAILED=c_void_p(-1).value
+_RESIDENCY_WINDOW=1024*1024*1024
+_WARM_CHUNK_SIZE=8*1024*1024
+
+# The reads asked for with WILLNEED finish in the background: the residency is sampled again until it stops growing, for this long at most
+
+_WARM_SETTLE_SECONDS=30
+_WARM_SETTLE_INTERVAL=0.2
+_WARM_SETTLE_STALLS=5
+
+# cgroup v2 I/O controller
+# Rules are per device (major:minor), and only whole disks are accepted: partitions are mapped to their disk
+# A cleared rule: no limits in io.max, the default weight, and no latency target
+
+_CGROUP2_FSTYPE="cgroup2"
+_CGROUP_IO_MAX_KEYS=("rbps","wbps","riops","wiops")
+_CGROUP_IO_FILES=("io.max","io.weight","io.latency")
+
+# Benchmark
+# A synthetic workload shaped like WiredTiger: random page reads (4K internal pages, 32K leaf pages), journal appends with fsync, and checkpoint bursts of page writes
+
+_BENCH_PAGE_SIZES=(4096,32768)
+_BENCH_JOURNAL_RECORD=8192
+_BENCH_JOURNAL_FILE_SIZE=100*1024*1024
+_BENCH_CHECKPOINT_INTERVAL=5.0
+_BENCH_CHECKPOINT_SIZE=32*1024*1024
+
+# MBR partition table
+# → four 16 byte entries at offset 446: status, CHS start, type, CHS end, LBA start (u32), sectors (u32)
+# → the CHS fields are not used, the end is set to the "beyond CHS" marker like parted does
+
+_MBR_SECTOR_SIZE=512
+_MBR_ENTRIES_OFFSET=446
+_MBR_ENTRY="<B3sB3sII"
+_MBR_ENTRY_SIZE=16
+_MBR_SIGNATURE=b"\x55\xaa"
+_MBR_CHS_BEYOND=b"\xfe\xff\xff"
+
+# ext4 superblock (1024 bytes in), the fields needed to size a filesystem
+
+_EXT4_SUPERBLOCK_OFFSET=1024
+_EXT4_MAGIC=0xEF53
+_EXT4_FEATURE_INCOMPAT_RECOVER=0x4
+_EXT4_FEATURE_INCOMPAT_64BIT=0x80
+_EXT4_STATE_ERRORS=0x2
+
+# Filesystem freeze ioctls (linux/fs.h)
+
+_FIFREEZE=0xC0045877
+_FITHAW=0xC0045878
+
+# Project quotas (linux/fs.h, linux/quota.h)
+# → a directory gets a project ID and the inherit flag through FS_IOC_FSSETXATTR, everything created under it belongs to the same project
+# → the limits of a project are set with quotactl(2) on the block device of the filesystem, in 1K blocks
+# struct fsxattr: xflags, extsize, nextents, projid, cowextsize, padding
+# struct if_dqblk: bhardlimit, bsoftlimit, curspace, ihardlimit, isoftlimit, curinodes, btime, itime, valid
+
+_FS_IOC_FSGETXATTR=0x801C581F
+_FS_IOC_FSSETXATTR=0x401C5820
+_FSXATTR="<IIIII8x"
+_FSXATTR_PROJID=3
+_FS_XFLAG_PROJINHERIT=0x200
+
+_Q_GETQUOTA=0x800007
+_Q_SETQUOTA=0x800008
+_PRJQUOTA=2
+_QIF_BLIMITS=1
+_QIF_ILIMITS=4
+_QIF_DQBLKSIZE=1024
+_IF_DQBLK="<QQQQQQQQI4x"
+
+# Locks
+# → one per image, so commands on different images can run at the same time
+# → one for the whole host, only held while a loop device is being allocated
+
+_LOCK_DIR="/run/lock/mongolical"
+_LOCK_HOST_LOOP="host-loop-alloc"
+
+_LOCKS_HELD={}
+_LOCKS_GUARD=Lock()
+
+# Sparse stream
+# → magic, header length (u32) and a JSON header
+# → one record per stored chunk: offset (u64), raw length (u32), stored length (u32), CRC32 of the raw data (u32), and the stored data
+# → an end record with the offset set to _SPARSE_END
+
+_SPARSE_MAGIC=b"MGLSPRS1"
+_SPARSE_RECORD="<QIII"
+_SPARSE_RECORD_SIZE=struct_calcsize(_SPARSE_RECORD)
+_SPARSE_END=0xFFFFFFFFFFFFFFFF
+_SPARSE_CHUNK_SIZE=4*1024*1024
+
+# The lengths of a record are u32, and a compressed chunk can end up a little bigger than the raw one
+
+_SPARSE_CHUNK_SIZE_MAX=2*1024*1024*1024
+
+_HASH_ALGORITHM="sha256"
+_HASH_CHUNK_SIZE=64*1024*1024
+_HASH_ZERO_BLOCK=bytes(1024*1024)
+
+_CODEC_NONE="none"
+_CODEC_ZLIB="zlib"
+_CODEC_BZ2="bz2"
+_CODEC_LZMA="lzma"
+
+_CODECS={
+	_CODEC_NONE:(lambda data:data,lambda data:data),
+	_CODEC_ZLIB:(lambda data:zlib_compress(data,1),zlib_decompress),
+	_CODEC_BZ2:(lambda data:bz2_compress(data,1),bz2_decompress),
+	_CODEC_LZMA:(lambda data:lzma_compress(data,preset=1),lzma_decompress),
+}
+
+# Whole files are compressed into the standard format of each codec, so the usual tools (zcat, bzcat, xzcat) can read them
+
+_CODEC_FILES={
+	_CODEC_ZLIB:(".gz",lambda fobj,name:GzipFile(filename=name,mode="wb",fileobj=fobj)),
+	_CODEC_BZ2:(".bz2",lambda fobj,name:BZ2File(fobj,"wb")),
+	_CODEC_LZMA:(".xz",lambda fobj,name:LZMAFile(fobj,"wb")),
+}
+
+_COMPRESS_CHUNK_SIZE=1024*1024
+
+# Background work
+# ioprio_set(2) has no wrapper in libc, and its syscall number depends on the architecture
+# The lowest best effort level is used rather than the idle class, so the work still gets done on a disk that is never idle
+
+_IOPRIO_SYSCALLS={
+	"x86_64":251,
+	"i686":289,
+	"aarch64":30,
+	"riscv64":30,
+	"armv7l":314,
+	"ppc64le":273,
+	"s390x":282,
+}
+_IOPRIO_WHO_PROCESS=1
+_IOPRIO_CLASS_SHIFT=13
+_IOPRIO_CLASS_BE=2
+_IOPRIO_LEVEL_LOWEST=7
+_NICE_LOWEST=19
+
+_SIZE_UNITS={
+	"":1,
+	"b":1,
+	"k":1024,
+	"kb":1024,
+	"kib":1024,
+	"m":1024**2,
+	"mb":1024**2,
+	"mib":1024**2,
+	"g":1024**3,
+	"gb":1024**3,
+	"gib":1024**3,
+	"t":1024**4,
+	"tb":1024**4,
+	"tib":1024**4,
+}
 
 def util_fixstring(
 		data:Optional[str],
@@ -31,6 +319,27 @@ def util_fixstring(
 		return data.lower()
 	return data
 
+def util_parse_size(data:Optional[str])->Optional[int]:
+
+	# Turns sizes like "512K", "4M" or "10GiB" into bytes
+
+	data_ok=util_fixstring(data,low=True)
+	if data_ok is None:
+		return None
+
+	idx=0
+	while idx<len(data_ok) and (data_ok[idx].isdigit() or data_ok[idx]=="."):
+		idx=idx+1
+
+	unit=data_ok[idx:].strip()
+	if unit not in _SIZE_UNITS.keys():
+		return None
+
+	try:
+		return int(float(data_ok[:idx])*_SIZE_UNITS[unit])
+	except ValueError:
+		return None
+
 def util_path_to_str(filepath)->str:
 	fse_ok=filepath
 	if isinstance(fse_ok,Path):
@@ -39,7 +348,8 @@ def util_path_to_str(filepath)->str:
 
 def util_subrun(
 		command:list,
-		ret_mode:int=0
+		ret_mode:int=0,
+		input_text:Optional[str]=None
 	)->Union[tuple,int,Optional[str]]:
 
 
@@ -57,11 +367,23 @@ def util_subrun(
 	catch_output=(
 		ret_mode in (_RET_ALL,_RET_STDOUT)
 	)
-	proc=sub_run(
-		command,
-		capture_output=catch_output,
-		text=catch_output
-	)
+
+	# A missing tool fails like the shell does (127), so the caller reports its step as failed instead of crashing
+
+	try:
+		proc=sub_run(
+			command,
+			capture_output=catch_output,
+			text=(catch_output or input_text is not None),
+			input=input_text
+		)
+	except FileNotFoundError:
+		print("Command not found:",command[0])
+		if ret_mode==_RET_RETURNCODE:
+			return 127
+		if ret_mode==_RET_STDOUT:
+			return None
+		return (127,None)
 
 	if ret_mode==_RET_RETURNCODE:
 		return proc.returncode
@@ -72,6 +394,1814 @@ def util_subrun(
 
 	return (proc.returncode,output)
 
+# LIBC
+
+def util_get_libc()->Optional[CDLL]:
+
+	# Loads the C library once, so mount(2), umount2(2), mincore(2) and quotactl(2) can be called in-process
+	# Returns None if that is not possible, and callers fall back to the command line tools
+
+	if "libc" in _LIBC_CACHE.keys():
+		return _LIBC_CACHE["libc"]
+
+	libc:Optional[CDLL]=None
+	try:
+		libc=CDLL(
+			find_library("c") or "libc.so.6",
+			use_errno=True
+		)
+		libc.mount.argtypes=[c_char_p,c_char_p,c_char_p,c_ulong,c_char_p]
+		libc.mount.restype=c_int
+		libc.umount2.argtypes=[c_char_p,c_int]
+		libc.umount2.restype=c_int
+		libc.mmap.argtypes=[c_void_p,c_size_t,c_int,c_int,c_int,c_long]
+		libc.mmap.restype=c_void_p
+		libc.munmap.argtypes=[c_void_p,c_size_t]
+		libc.munmap.restype=c_int
+		libc.mincore.argtypes=[c_void_p,c_size_t,c_void_p]
+		libc.mincore.restype=c_int
+		libc.quotactl.argtypes=[c_int,c_char_p,c_int,c_void_p]
+		libc.quotactl.restype=c_int
+	except Exception as exc:
+		print("libc not available:",exc)
+		libc=None
+
+	_LIBC_CACHE.update({"libc":libc})
+	return libc
+
+def util_mount_options(options:Optional[str])->tuple:
+
+	# Splits a comma separated list of mount options into mount(2) flags and the filesystem specific data string
+
+	flags=0
+	data=[]
+
+	if options is None:
+		return (flags,None)
+
+	for opt in options.split(","):
+		opt_ok=util_fixstring(opt)
+		if opt_ok is None:
+			continue
+		if opt_ok in _MOUNT_OPTION_FLAGS.keys():
+			flags=flags|_MOUNT_OPTION_FLAGS[opt_ok]
+			continue
+		data.append(opt_ok)
+
+	if len(data)==0:
+		return (flags,None)
+
+	return (flags,",".join(data))
+
+def util_guess_fstype(filepath:Union[str,Path])->Optional[str]:
+
+	# Reads the superblock magic of a block device or image to know what to pass as the filesystem type to mount(2)
+
+	fse_ok=util_path_to_str(filepath)
+
+	try:
+		with open(fse_ok,"rb") as f:
+			head=f.read(65608)
+	except Exception as exc:
+		print("Unable to read the superblock:",exc)
+		return None
+
+	if head[0:4]==b"hsqs":
+		return _FSTYPE_SQUASHFS
+	if head[0:4]==b"XFSB":
+		return "xfs"
+	if head[1080:1082]==b"\x53\xef":
+		return "ext4"
+	if head[1024:1028]==b"\xe2\xe1\xf5\xe0":
+		return _FSTYPE_EROFS
+	if head[3:11]==b"EXFAT   ":
+		return "exfat"
+	if head[82:90]==b"FAT32   ":
+		return "vfat"
+	if head[54:59] in (b"FAT12",b"FAT16"):
+		return "vfat"
+	if head[65600:65608]==b"_BHRfS_M":
+		return "btrfs"
+
+	return None
+
+def util_read_mountinfo()->Optional[list]:
+
+	# Parses the mount table of the current process
+	# Returns None if the mount table is not available
+
+	try:
+		with open(_PROC_MOUNTINFO,"rt") as f:
+			lines=f.read().splitlines()
+	except Exception as exc:
+		print("Unable to read the mount table:",exc)
+		return None
+
+	mounts=[]
+	for line in lines:
+		fields=line.split(" ")
+		if not len(fields)>9:
+			continue
+		if "-" not in fields[6:]:
+			continue
+
+		sep=fields.index("-",6)
+		mounts.append({
+			"mount_id":int(fields[0]),
+			"parent_id":int(fields[1]),
+			"majmin":fields[2],
+			"root":util_unescape_mountinfo(fields[3]),
+			"target":util_unescape_mountinfo(fields[4]),
+			"options":fields[5],
+			"fstype":fields[sep+1],
+			"source":util_unescape_mountinfo(fields[sep+2]),
+			"super_options":fields[sep+3],
+		})
+
+	return mounts
+
+def util_unescape_mountinfo(field:str)->str:
+
+	# Spaces, tabs, newlines and backslashes are escaped as octal in the mount table
+
+	return re_sub(
+		r"\\([0-7]{3})",
+		lambda m:chr(int(m.group(1),8)),
+		field
+	)
+
+# SYSFS
+
+def util_dev_majmin(filepath:Union[str,Path])->Optional[str]:
+
+	# Returns the "major:minor" pair of a device node, as it shows up in the mount table
+
+	try:
+		st=stat(util_path_to_str(filepath))
+	except Exception as exc:
+		print("Unable to stat the device:",exc)
+		return None
+
+	if st.st_rdev==0:
+		return None
+
+	return f"{major(st.st_rdev)}:{minor(st.st_rdev)}"
+
+def util_sysfs_loop_devices(filepath:Union[str,Path])->Optional[list]:
+
+	# Given a path to a file, it gets all the loop devices that come from that file without running losetup
+	# Returns a list of paths, or None if sysfs is not available
+
+	sysfs=Path(_SYSFS_BLOCK)
+	if not sysfs.is_dir():
+		return None
+
+	fse_real=realpath(util_path_to_str(filepath))
+
+	selection=[]
+	for entry in sysfs.glob("loop*"):
+		backfile=entry.joinpath("loop","backing_file")
+		if not backfile.is_file():
+			continue
+		try:
+			backfile_str=backfile.read_text().strip()
+		except Exception:
+			continue
+		if backfile_str.endswith(" (deleted)"):
+			continue
+		if not backfile_str==fse_real:
+			continue
+
+		selection.append(f"/dev/{entry.name}")
+
+	selection.sort()
+	return selection
+
+def util_sysfs_partitions(filepath:Union[str,Path])->list:
+
+	# Given a path to a block device, it gets the paths of its partitions from sysfs
+
+	name=Path(util_path_to_str(filepath)).name
+	sysfs_dev=Path(_SYSFS_BLOCK).joinpath(name)
+	if not sysfs_dev.is_dir():
+		return []
+
+	selection=[]
+	for entry in sysfs_dev.glob(f"{name}*"):
+		if not entry.joinpath("partition").is_file():
+			continue
+		selection.append(f"/dev/{entry.name}")
+
+	selection.sort()
+	return selection
+
+def util_sysfs_entry(filepath:Union[str,Path])->Path:
+
+	# /dev/mapper/* are links to /dev/dm-*, and sysfs only knows about the latter
+
+	name=Path(realpath(util_path_to_str(filepath))).name
+	return Path("/sys/class/block").joinpath(name)
+
+def util_sysfs_sectors(filepath:Union[str,Path])->Optional[int]:
+
+	# Gets the size of a block device in 512 byte sectors
+
+	size_raw=util_sysfs_read(util_sysfs_entry(filepath),"size")
+	if size_raw is None:
+		return None
+	if not size_raw.isdigit():
+		return None
+
+	return int(size_raw)
+
+def util_sysfs_holders(filepaths:list)->list:
+
+	# Gets every device stacked on top of some block devices (device-mapper targets for example), directly or not
+	# The ones on top come first, so they can be removed in that order
+
+	order=[]
+
+	def visit(entry:Path):
+		holders_dir=entry.joinpath("holders")
+		if not holders_dir.is_dir():
+			return
+		for holder in sorted(holders_dir.iterdir()):
+			holder_path=f"/dev/{holder.name}"
+			if holder_path in order:
+				continue
+			visit(Path("/sys/class/block").joinpath(holder.name))
+			order.append(holder_path)
+
+	for filepath in filepaths:
+		visit(util_sysfs_entry(filepath))
+
+	return order
+
+def util_sysfs_dm_name(filepath:Union[str,Path])->Optional[str]:
+
+	return util_sysfs_read(
+		util_sysfs_entry(filepath),
+		"dm/name"
+	)
+
+def util_sysfs_read(entry:Path,name:str)->Optional[str]:
+
+	try:
+		return util_fixstring(
+			entry.joinpath(name).read_text()
+		)
+	except Exception:
+		return None
+
+def fun_get_topology()->Optional[Mapping]:
+
+	# Builds a map of every backing file that is attached as a loop device, in one pass over sysfs and the mount table
+	# backing file → loop devices → partitions, each with its "major:minor" and the places where it is mounted
+	# Returns None if sysfs or the mount table are not available
+
+	sysfs=Path(_SYSFS_BLOCK)
+	if not sysfs.is_dir():
+		return None
+
+	mounts=util_read_mountinfo()
+	if mounts is None:
+		return None
+
+	targets={}
+	for m in mounts:
+		if m["majmin"] not in targets.keys():
+			targets.update({m["majmin"]:[]})
+		targets[m["majmin"]].append({
+			"target":m["target"],
+			"root":m["root"],
+		})
+
+	topology={}
+	for entry in sorted(sysfs.glob("loop*")):
+		backfile=util_sysfs_read(entry,"loop/backing_file")
+		if backfile is None:
+			continue
+
+		majmin=util_sysfs_read(entry,"dev")
+
+		partitions=[]
+		for part in sorted(entry.glob(f"{entry.name}*")):
+			if not part.joinpath("partition").is_file():
+				continue
+			part_majmin=util_sysfs_read(part,"dev")
+			partitions.append({
+				"path":f"/dev/{part.name}",
+				"majmin":part_majmin,
+				"mounts":targets.get(part_majmin,[]),
+			})
+
+		holders=[]
+		if entry.joinpath("holders").is_dir():
+			for holder in sorted(entry.joinpath("holders").iterdir()):
+				holders.append(f"/dev/{holder.name}")
+
+		if backfile not in topology.keys():
+			topology.update({backfile:[]})
+
+		topology[backfile].append({
+			"path":f"/dev/{entry.name}",
+			"majmin":majmin,
+			"mounts":targets.get(majmin,[]),
+			"partitions":partitions,
+			"holders":holders,
+		})
+
+	return topology
+
+def libc_mount(
+		source:str,
+		target:str,
+		fstype:Optional[str],
+		flags:int,
+		data:Optional[str]=None
+	)->int:
+
+	# Calls mount(2) directly
+	# Returns 0 on success or the errno value
+
+	print("\n$",["mount(2)",source,target,fstype,hex(flags),data])
+
+	libc=util_get_libc()
+	result=libc.mount(
+		fsencode(source),
+		fsencode(target),
+		None if fstype is None else fstype.encode(),
+		flags,
+		None if data is None else data.encode()
+	)
+	if not result==0:
+		errno=get_errno()
+		print(strerror(errno))
+		return errno
+
+	return 0
+
+def libc_umount(
+		target:str,
+		flags:int=0
+	)->int:
+
+	# Calls umount2(2) directly
+	# Returns 0 on success or the errno value
+
+	print("\n$",["umount2(2)",target,flags])
+
+	libc=util_get_libc()
+	result=libc.umount2(fsencode(target),flags)
+	if not result==0:
+		errno=get_errno()
+		print(strerror(errno))
+		return errno
+
+	return 0
+
+def libc_loop_set_autoclear(
+		loopdev:str,
+		enable:bool=True
+	)->int:
+
+	# Sets (or clears) LO_FLAGS_AUTOCLEAR on a loop device, through LOOP_GET_STATUS64 and LOOP_SET_STATUS64
+	# With it, the kernel detaches the loop device by itself once nothing has it open anymore (the last mount is gone)
+	# Returns 0 on success or the errno value
+
+	print("\n$",["ioctl(LOOP_SET_STATUS64)",loopdev,"autoclear",enable])
+
+	try:
+		fd=os_open(loopdev,O_RDONLY)
+	except OSError as exc:
+		print(exc)
+		return exc.errno
+
+	try:
+		info=bytearray(_LOOP_INFO64_SIZE)
+		ioctl(fd,_LOOP_GET_STATUS64,info)
+
+		flags=struct_unpack(
+			_LOOP_INFO64_FLAGS,
+			info[_LOOP_INFO64_FLAGS_OFFSET:_LOOP_INFO64_FLAGS_OFFSET+4]
+		)[0]
+		if enable:
+			flags=flags|_LO_FLAGS_AUTOCLEAR
+		else:
+			flags=flags&(~_LO_FLAGS_AUTOCLEAR)
+		info[_LOOP_INFO64_FLAGS_OFFSET:_LOOP_INFO64_FLAGS_OFFSET+4]=struct_pack(
+			_LOOP_INFO64_FLAGS,flags
+		)
+
+		ioctl(fd,_LOOP_SET_STATUS64,bytes(info))
+
+	except OSError as exc:
+		print(exc)
+		return exc.errno
+
+	finally:
+		close(fd)
+
+	return 0
+
+def libc_loop_detach(loopdev:str)->int:
+
+	# Detaches a loop device through LOOP_CLR_FD
+	# If the device is still open by someone else, the kernel marks it as autoclear instead, and it goes away when it is closed
+	# Returns 0 on success or the errno value (ENXIO if it was not attached)
+
+	print("\n$",["ioctl(LOOP_CLR_FD)",loopdev])
+
+	try:
+		fd=os_open(loopdev,O_RDONLY)
+	except OSError as exc:
+		print(exc)
+		return exc.errno
+
+	try:
+		ioctl(fd,_LOOP_CLR_FD,0)
+	except OSError as exc:
+		print(exc)
+		return exc.errno
+	finally:
+		close(fd)
+
+	return 0
+
+def libc_fs_freeze(
+		mountpoint:Union[str,Path],
+		freeze:bool=True
+	)->int:
+
+	# Freezes (FIFREEZE) or thaws (FITHAW) the filesystem mounted at the given path
+	# While frozen, the filesystem is consistent on its device, and writes wait until it is thawed
+	# Returns 0 on success or the errno value
+
+	fse_ok=util_path_to_str(mountpoint)
+
+	request=_FIFREEZE
+	if not freeze:
+		request=_FITHAW
+
+	print("\n$",["ioctl(FIFREEZE)" if freeze else "ioctl(FITHAW)",fse_ok])
+
+	try:
+		fd=os_open(fse_ok,O_RDONLY)
+	except OSError as exc:
+		print(exc)
+		return exc.errno
+
+	try:
+		ioctl(fd,request,0)
+	except OSError as exc:
+		print(exc)
+		return exc.errno
+	finally:
+		close(fd)
+
+	return 0
+
+# QUOTAS
+
+def libc_set_project(
+		dirpath:Union[str,Path],
+		project_id:int
+	)->int:
+
+	# Gives a directory a project ID, with the inherit flag, through FS_IOC_FSGETXATTR and FS_IOC_FSSETXATTR
+	# Only what is created afterwards inherits it, so it is meant for new (empty) directories
+	# Returns 0 on success or the errno value
+
+	fse_ok=util_path_to_str(dirpath)
+
+	print("\n$",["ioctl(FS_IOC_FSSETXATTR)",fse_ok,"project",project_id])
+
+	try:
+		fd=os_open(fse_ok,O_RDONLY)
+	except OSError as exc:
+		print(exc)
+		return exc.errno
+
+	try:
+		attr=bytearray(struct_calcsize(_FSXATTR))
+		ioctl(fd,_FS_IOC_FSGETXATTR,attr)
+
+		fields=list(struct_unpack(_FSXATTR,attr))
+		fields[0]=fields[0]|_FS_XFLAG_PROJINHERIT
+		fields[_FSXATTR_PROJID]=project_id
+
+		ioctl(fd,_FS_IOC_FSSETXATTR,struct_pack(_FSXATTR,*fields))
+
+	except OSError as exc:
+		print(exc)
+		return exc.errno
+
+	finally:
+		close(fd)
+
+	return 0
+
+def libc_quota_set_project(
+		fse_dev:str,
+		project_id:int,
+		max_bytes:Optional[int]=None,
+		max_inodes:Optional[int]=None
+	)->int:
+
+	# Sets the hard limits of a project on the filesystem of a block device, the soft limits are the same
+	# A limit set to None (or 0) is removed
+	# Returns 0 on success or the errno value
+
+	print("\n$",["quotactl(Q_SETQUOTA)",fse_dev,"project",project_id,max_bytes,max_inodes])
+
+	libc=util_get_libc()
+	if libc is None:
+		return ENOSYS
+
+	blocks=0
+	if max_bytes is not None:
+		blocks=-(-max_bytes//_QIF_DQBLKSIZE)
+	inodes=0
+	if max_inodes is not None:
+		inodes=max_inodes
+
+	dqblk=bytearray(struct_pack(
+		_IF_DQBLK,
+		blocks,blocks,0,
+		inodes,inodes,0,
+		0,0,
+		_QIF_BLIMITS|_QIF_ILIMITS
+	))
+
+	result=libc.quotactl(
+		(_Q_SETQUOTA<<8)|_PRJQUOTA,
+		fsencode(fse_dev),
+		project_id,
+		(c_ubyte*len(dqblk)).from_buffer(dqblk)
+	)
+	if not result==0:
+		errno=get_errno()
+		print(strerror(errno))
+		return errno
+
+	return 0
+
+def libc_quota_get_project(
+		fse_dev:str,
+		project_id:int
+	)->Optional[Mapping]:
+
+	# The usage and the hard limits of a project (None for no limit), or None if quotas are not available
+
+	libc=util_get_libc()
+	if libc is None:
+		return None
+
+	dqblk=bytearray(struct_calcsize(_IF_DQBLK))
+	result=libc.quotactl(
+		(_Q_GETQUOTA<<8)|_PRJQUOTA,
+		fsencode(fse_dev),
+		project_id,
+		(c_ubyte*len(dqblk)).from_buffer(dqblk)
+	)
+	if not result==0:
+		return None
+
+	fields=struct_unpack(_IF_DQBLK,dqblk)
+
+	return {
+		"bytes":fields[2],
+		"max_bytes":(fields[0]*_QIF_DQBLKSIZE) or None,
+		"inodes":fields[5],
+		"max_inodes":fields[3] or None,
+	}
+
+# PAGE CACHE
+
+def util_file_residency(
+		fd:int,
+		size:int
+	)->Optional[tuple]:
+
+	# Finds which parts of an open file are in the page cache, with mincore(2)
+	# Returns the number of bytes cached, and the (start,end) ranges that are not
+	# Returns None if it can not be checked
+
+	libc=util_get_libc()
+	if libc is None:
+		return None
+
+	cached=0
+	missing=[]
+	pos=0
+	while pos<size:
+		length=min(_RESIDENCY_WINDOW,size-pos)
+		pages=(length+_PAGE_SIZE-1)//_PAGE_SIZE
+
+		addr=libc.mmap(None,length,_PROT_READ,_MAP_SHARED,fd,pos)
+		if addr is None or addr==_MAP_FAILED:
+			return None
+		try:
+			vec=(c_ubyte*pages)()
+			if not libc.mincore(addr,length,vec)==0:
+				return None
+		finally:
+			libc.munmap(addr,length)
+
+		# Only the lowest bit of each byte tells if the page is cached
+
+		data=bytes(vec).translate(bytes(i&1 for i in range(256)))
+		cached=cached+data.count(1)*_PAGE_SIZE
+
+		for match in re_finditer(b"\x00+",data):
+			start=pos+match.start()*_PAGE_SIZE
+			end=min(pos+match.end()*_PAGE_SIZE,size)
+			if len(missing)>0 and missing[-1][1]==start:
+				missing[-1]=(missing[-1][0],end)
+				continue
+			missing.append((start,end))
+
+		pos=pos+length
+
+	return (min(cached,size),missing)
+
+def fun_warm_files(
+		files:list,
+		budget:Optional[int]=None,
+		workers:int=4,
+		chunk_size:int=_WARM_CHUNK_SIZE,
+		settle:float=_WARM_SETTLE_SECONDS
+	)->Mapping:
+
+	# Asks the kernel to read files into the page cache (posix_fadvise WILLNEED), in the given order
+	# Only the parts that are not cached yet are requested
+	# The budget (bytes per second, for all the workers together) paces the requests, the reads themselves happen in the background
+	# Once every request is out, the residency is sampled until everything requested is cached or it stops growing (memory pressure), for settle seconds at most
+	# Returns how much was cached before and after, and whether the reads were seen to finish (if not, brought_in is a lower bound)
+
+	budget_lock=Lock()
+	budget_clock={"next":monotonic()}
+
+	def throttle(nbytes:int):
+		if budget is None:
+			return
+		with budget_lock:
+			now=monotonic()
+			start=max(now,budget_clock["next"])
+			budget_clock.update({"next":start+nbytes/budget})
+		if start>now:
+			sleep(start-now)
+
+	def warm(filepath:Union[str,Path])->Optional[Mapping]:
+		try:
+			fd=os_open(util_path_to_str(filepath),O_RDONLY)
+		except OSError as exc:
+			print("Unable to open:",filepath,exc)
+			return None
+
+		try:
+			size=lseek(fd,0,SEEK_END)
+			residency=util_file_residency(fd,size)
+			if residency is None:
+				residency=(None,[(0,size)])
+
+			requested=0
+			for start,end in util_split_extents(residency[1],chunk_size):
+				throttle(end-start)
+				posix_fadvise(fd,start,end-start,POSIX_FADV_WILLNEED)
+				requested=requested+(end-start)
+		finally:
+			close(fd)
+
+		return {
+			"file":util_path_to_str(filepath),
+			"size":size,
+			"requested":requested,
+			"cached_before":residency[0],
+		}
+
+	time_start=monotonic()
+
+	with ThreadPoolExecutor(
+			max_workers=max(1,workers)
+		) as pool:
+		results=[
+			r for r in pool.map(warm,files)
+			if r is not None
+		]
+
+	stats={
+		"files":len(results),
+		"size":0,
+		"requested":0,
+		"cached_before":0,
+		"cached_after":0,
+		"settled":False,
+		"seconds":0,
+	}
+	for result in results:
+		stats.update({
+			"size":stats["size"]+result["size"],
+			"requested":stats["requested"]+result["requested"],
+			"cached_before":stats["cached_before"]+(result["cached_before"] or 0),
+		})
+
+	def cached_now()->int:
+		total=0
+		for result in results:
+			try:
+				fd=os_open(result["file"],O_RDONLY)
+			except OSError:
+				continue
+			try:
+				residency=util_file_residency(fd,result["size"])
+			finally:
+				close(fd)
+			if residency is not None:
+				total=total+residency[0]
+		return total
+
+	target=stats["cached_before"]+stats["requested"]
+	deadline=monotonic()+max(0,settle)
+	cached=cached_now()
+	stalls=0
+	while cached<target and monotonic()<deadline and stalls<_WARM_SETTLE_STALLS:
+		sleep(_WARM_SETTLE_INTERVAL)
+		cached_next=cached_now()
+		stalls=0 if cached_next>cached else stalls+1
+		cached=cached_next
+
+	stats.update({
+		"cached_after":cached,
+		"settled":(cached>=target or not stalls<_WARM_SETTLE_STALLS),
+		"brought_in":max(0,cached-stats["cached_before"]),
+		"seconds":round(monotonic()-time_start,3),
+	})
+
+	return stats
+
+# BACKGROUND WORK
+
+def libc_lower_priority(
+		nice:int=_NICE_LOWEST,
+		level:int=_IOPRIO_LEVEL_LOWEST
+	)->int:
+
+	# Lowers the CPU (nice) and I/O (best effort class) priority of the calling thread only, so background workers do not slow the rest of the process down
+	# Returns 0 on success or the errno value
+
+	try:
+		setpriority(PRIO_PROCESS,get_native_id(),nice)
+	except OSError as exc:
+		print("Unable to set the CPU priority:",exc)
+		return exc.errno
+
+	libc=util_get_libc()
+	nr=_IOPRIO_SYSCALLS.get(machine())
+	if libc is None or nr is None:
+		return ENOSYS
+
+	# A "who" of 0 means the calling thread
+
+	result=libc.syscall(
+		c_long(nr),
+		c_int(_IOPRIO_WHO_PROCESS),
+		c_int(0),
+		c_int((_IOPRIO_CLASS_BE<<_IOPRIO_CLASS_SHIFT)|level)
+	)
+	if not result==0:
+		errno=get_errno()
+		print("Unable to set the I/O priority:",strerror(errno))
+		return errno
+
+	return 0
+
+def fun_compress_files(
+		files:list,
+		codec:str=_CODEC_ZLIB,
+		dest_dir:Optional[Union[str,Path]]=None,
+		budget:Optional[int]=None,
+		workers:int=2,
+		chunk_size:int=_COMPRESS_CHUNK_SIZE
+	)->Union[Mapping,str]:
+
+	# Compresses each file into the standard file format of the codec, and deletes the original
+	# The compressed file is written next to the original (or in dest_dir) under a temporary name, synced and linked in place, and only then the original is deleted
+	# An existing compressed file is never replaced: the name gets the modification time of the original instead (logrotate reuses "<name>.1" for example), and if that one exists too the file is left as it is
+	# The workers run at the lowest CPU and I/O priority, and the budget (bytes per second read and written, for all the workers together) paces them
+	# Returns the result of each file and the totals, or an error message
+
+	if codec not in _CODEC_FILES.keys():
+		return f"unknown codec: {codec}"
+
+	suffix,opener=_CODEC_FILES[codec]
+
+	budget_lock=Lock()
+	budget_clock={"next":monotonic()}
+
+	def throttle(nbytes:int):
+		if budget is None:
+			return
+		with budget_lock:
+			now=monotonic()
+			start=max(now,budget_clock["next"])
+			budget_clock.update({"next":start+nbytes/budget})
+		if start>now:
+			sleep(start-now)
+
+	def compress(filepath:Union[str,Path])->Mapping:
+		libc_lower_priority()
+
+		fse_src=Path(filepath)
+		fse_dir=fse_src.parent
+		if dest_dir is not None:
+			fse_dir=Path(dest_dir)
+		fse_dst=fse_dir.joinpath(f"{fse_src.name}{suffix}")
+		fse_tmp=fse_dir.joinpath(f".{fse_dst.name}.{get_native_id()}")
+
+		time_start=monotonic()
+		try:
+			st=fse_src.stat()
+			with open(fse_src,"rb") as fin,open(fse_tmp,"wb") as fout:
+				with opener(fout,fse_src.name) as fz:
+					while True:
+						data=fin.read(chunk_size)
+						if len(data)==0:
+							break
+						written=fout.tell()
+						fz.write(data)
+						throttle(len(data)+fout.tell()-written)
+
+				fout.flush()
+				fsync(fout.fileno())
+
+				# Neither file is needed in the page cache, mongod is
+
+				posix_fadvise(fout.fileno(),0,0,POSIX_FADV_DONTNEED)
+				posix_fadvise(fin.fileno(),0,0,POSIX_FADV_DONTNEED)
+
+			os_chown(fse_tmp,st.st_uid,st.st_gid)
+			os_chmod(fse_tmp,st.st_mode&0o7777)
+			utime(fse_tmp,(st.st_atime,st.st_mtime))
+
+			# link(2) fails if the name is taken, unlike rename(2)
+
+			try:
+				link(fse_tmp,fse_dst)
+			except FileExistsError:
+				fse_dst=fse_dir.joinpath(f"{fse_src.name}.{int(st.st_mtime)}{suffix}")
+				link(fse_tmp,fse_dst)
+			unlink(fse_tmp)
+			unlink(fse_src)
+
+		except Exception as exc:
+			if fse_tmp.exists():
+				unlink(fse_tmp)
+			return {
+				"file":str(fse_src),
+				"error":str(exc),
+			}
+
+		return {
+			"file":str(fse_src),
+			"output":str(fse_dst),
+			"size":st.st_size,
+			"compressed":fse_dst.stat().st_size,
+			"seconds":round(monotonic()-time_start,3),
+		}
+
+	time_start=monotonic()
+
+	with ThreadPoolExecutor(
+			max_workers=max(1,workers)
+		) as pool:
+		results=list(pool.map(compress,files))
+
+	stats={
+		"files":len(results),
+		"failed":0,
+		"size":0,
+		"compressed":0,
+		"seconds":round(monotonic()-time_start,3),
+		"results":results,
+	}
+	for result in results:
+		if "error" in result.keys():
+			stats.update({"failed":stats["failed"]+1})
+			continue
+		stats.update({
+			"size":stats["size"]+result["size"],
+			"compressed":stats["compressed"]+result["compressed"],
+		})
+
+	return stats
+
+def fun_read_throughput(
+		filepath:Union[str,Path],
+		size:int,
+		block_size:int=1024*1024
+	)->Optional[float]:
+
+	# Reads the start of a block device with O_DIRECT (the page cache is not involved), and returns the throughput in bytes per second
+	# Returns None if it can not be read
+
+	try:
+		fd=os_open(util_path_to_str(filepath),O_RDONLY|O_DIRECT)
+	except OSError as exc:
+		print("Unable to open:",filepath,exc)
+		return None
+
+	# Anonymous memory maps are page aligned, as O_DIRECT needs
+
+	buffer=mmap(-1,block_size)
+	total=0
+	try:
+		size_ok=min(size,lseek(fd,0,SEEK_END))
+		time_start=monotonic()
+		while total<size_ok:
+			done=preadv(fd,[buffer],total)
+			if done==0:
+				break
+			total=total+done
+		seconds=monotonic()-time_start
+	except OSError as exc:
+		print("Unable to read:",filepath,exc)
+		return None
+	finally:
+		close(fd)
+		buffer.close()
+
+	if not seconds>0:
+		return None
+
+	return total/seconds
+
+# CGROUPS
+
+def util_cgroup2_root()->Optional[Path]:
+
+	# Where the cgroup v2 hierarchy is mounted (/sys/fs/cgroup, or /sys/fs/cgroup/unified on hybrid hosts)
+
+	mounts=util_read_mountinfo()
+	if mounts is None:
+		return None
+
+	for m in mounts:
+		if m["fstype"]==_CGROUP2_FSTYPE:
+			return Path(m["target"])
+
+	return None
+
+def util_cgroup_path(cgroup:Union[str,Path])->Optional[Path]:
+
+	# A cgroup given as an absolute path, or relative to the cgroup v2 root
+
+	fse=Path(util_path_to_str(cgroup))
+	if fse.is_absolute():
+		return fse
+
+	root=util_cgroup2_root()
+	if root is None:
+		return None
+
+	return root.joinpath(fse)
+
+def util_whole_disk_majmin(majmin:str)->Optional[str]:
+
+	# The "major:minor" of the disk a partition belongs to, or the same one if it is a whole disk already
+	# Returns None if it is not a block device (tmpfs or overlay for example)
+
+	entry=Path("/sys/dev/block").joinpath(majmin)
+	if not entry.exists():
+		return None
+
+	if not entry.joinpath("partition").is_file():
+		return majmin
+
+	return util_sysfs_read(
+		Path(realpath(str(entry))).parent,
+		"dev"
+	)
+
+def util_backing_majmin(filepath:Union[str,Path])->Optional[str]:
+
+	# The "major:minor" of the disk a file is stored on
+
+	try:
+		st=stat(util_path_to_str(filepath))
+	except OSError:
+		return None
+
+	return util_whole_disk_majmin(f"{major(st.st_dev)}:{minor(st.st_dev)}")
+
+def util_cgroup_io_lines(
+		majmin:str,
+		io_max:Optional[Mapping],
+		weight:Optional[int],
+		latency:Optional[int]
+	)->list:
+
+	# The lines to write for a device, as (file,line) pairs
+	# Limits set to None are cleared
+
+	lines=[]
+	if io_max is not None:
+		values=[]
+		for key in _CGROUP_IO_MAX_KEYS:
+			value=io_max.get(key)
+			values.append(f"{key}={'max' if value is None else value}")
+		lines.append(("io.max",f"{majmin} {' '.join(values)}"))
+
+	if weight is not None:
+		lines.append(("io.weight",f"{majmin} {weight if weight>0 else 'default'}"))
+
+	if latency is not None:
+		lines.append(("io.latency",f"{majmin} target={latency if latency>0 else 'max'}"))
+
+	return lines
+
+def fun_cgroup_io_apply(
+		cgroup:Path,
+		majmin_list:list,
+		io_max:Optional[Mapping]=None,
+		weight:Optional[int]=None,
+		latency:Optional[int]=None
+	)->Optional[str]:
+
+	# Writes the I/O rules of a cgroup for each device
+	# → io_max: "rbps", "wbps" (bytes per second), "riops", "wiops"; a missing key means no limit
+	# → weight: 1 to 10000, or 0 for the default (only used if the disk has a weight-based controller, like io.cost or BFQ)
+	# → latency: target in microseconds, or 0 for none
+	# Nothing is written for the settings that are None
+	# Returns an error message, or None
+
+	for majmin in majmin_list:
+		for filename,line in util_cgroup_io_lines(majmin,io_max,weight,latency):
+			fse=cgroup.joinpath(filename)
+			if not fse.exists():
+				return f"the I/O controller is not available for the cgroup, {fse} does not exist (is io in the cgroup.subtree_control of its parent?)"
+			print("\n$",["write",str(fse),line])
+			try:
+				fse.write_text(f"{line}\n")
+			except OSError as exc:
+				return f"failed to write the I/O rule to {fse}: {line}: {exc}"
+
+	return None
+
+def fun_cgroup_io_read(
+		cgroup:Path,
+		majmin_list:list
+	)->Mapping:
+
+	# The I/O rules and statistics of a cgroup, for the given devices only
+
+	result={}
+	for filename in _CGROUP_IO_FILES+("io.stat",):
+		try:
+			lines=cgroup.joinpath(filename).read_text().splitlines()
+		except OSError:
+			continue
+		selection={}
+		for line in lines:
+			fields=line.split(maxsplit=1)
+			if len(fields)==2 and fields[0] in majmin_list:
+				selection.update({fields[0]:fields[1]})
+		result.update({filename:selection})
+
+	return result
+
+# BENCHMARK
+
+def util_latency_stats(
+		latencies:list,
+		seconds:float,
+		nbytes:int=0
+	)->Mapping:
+
+	# Operations per second, throughput and latency percentiles (in microseconds) of a list of latencies (in seconds)
+
+	count=len(latencies)
+	if count==0:
+		return {"count":0}
+
+	ordered=sorted(latencies)
+
+	def pick(percent:float)->float:
+		idx=min(count-1,int(percent*(count-1)/100+0.5))
+		return round(ordered[idx]*1000000,1)
+
+	return {
+		"count":count,
+		"iops":round(count/seconds,1),
+		"bytes_per_second":int(nbytes/seconds),
+		"latency_us":{
+			"mean":round(sum(ordered)/count*1000000,1),
+			"p50":pick(50),
+			"p90":pick(90),
+			"p99":pick(99),
+			"p99_9":pick(99.9),
+			"max":round(ordered[-1]*1000000,1),
+		},
+	}
+
+def fun_io_bench(
+		data_file:Union[str,Path],
+		journal_file:Union[str,Path],
+		file_size:int=256*1024*1024,
+		duration:float=30.0,
+		readers:int=4,
+		checkpoint_interval:float=_BENCH_CHECKPOINT_INTERVAL,
+		checkpoint_size:int=_BENCH_CHECKPOINT_SIZE
+	)->Union[Mapping,str]:
+
+	# Runs the WiredTiger-shaped workload for a while, all at the same time, in a thread pool
+	# → readers: random 4K and 32K reads over the data file, with O_DIRECT if the filesystem allows it (so the storage is measured, not the page cache)
+	# → journal: one thread appending records to the journal file, each one followed by fsync, starting over once the file reaches the size of a WiredTiger log file
+	# → checkpoint: one thread writing a burst of random pages to the data file every interval, followed by fsync
+	# The data file is filled first, and dropped from the page cache
+	# Returns the statistics of each kind of operation, or an error message
+
+	fse_data=util_path_to_str(data_file)
+	fse_journal=util_path_to_str(journal_file)
+
+	file_size=max(file_size,max(_BENCH_PAGE_SIZES))
+	file_size=(file_size//4096)*4096
+
+	try:
+		fd=os_open(fse_data,O_WRONLY|O_CREAT|O_TRUNC,0o600)
+		try:
+			block=urandom(1024*1024)
+			pos=0
+			while pos<file_size:
+				pos=pos+os_write(fd,block[:min(len(block),file_size-pos)])
+			fsync(fd)
+			posix_fadvise(fd,0,0,POSIX_FADV_DONTNEED)
+		finally:
+			close(fd)
+	except OSError as exc:
+		return f"failed to prepare the data file: {exc}"
+
+	direct=True
+	try:
+		fd_read=os_open(fse_data,O_RDONLY|O_DIRECT)
+	except OSError:
+		direct=False
+		fd_read=os_open(fse_data,O_RDONLY)
+
+	time_stop=monotonic()+duration
+
+	def reader(seed:int)->Mapping:
+		rng=Random(seed)
+		buffers={size:mmap(-1,size) for size in _BENCH_PAGE_SIZES}
+		latencies={size:[] for size in _BENCH_PAGE_SIZES}
+		try:
+			while monotonic()<time_stop:
+				size=rng.choice(_BENCH_PAGE_SIZES)
+				offset=rng.randrange(0,(file_size-size)//4096+1)*4096
+				time_start=monotonic()
+				preadv(fd_read,[buffers[size]],offset)
+				latencies[size].append(monotonic()-time_start)
+		finally:
+			for buffer in buffers.values():
+				buffer.close()
+		return latencies
+
+	def journal()->list:
+		record=urandom(_BENCH_JOURNAL_RECORD)
+		latencies=[]
+		fd=os_open(fse_journal,O_WRONLY|O_CREAT|O_TRUNC|O_APPEND,0o600)
+		try:
+			written=0
+			while monotonic()<time_stop:
+				if written+len(record)>_BENCH_JOURNAL_FILE_SIZE:
+					ftruncate(fd,0)
+					written=0
+				time_start=monotonic()
+				os_write(fd,record)
+				fsync(fd)
+				latencies.append(monotonic()-time_start)
+				written=written+len(record)
+		finally:
+			close(fd)
+		return latencies
+
+	def checkpoint()->tuple:
+		rng=Random(0)
+		page=urandom(max(_BENCH_PAGE_SIZES))
+		latencies=[]
+		bursts=[]
+		total=0
+		fd=os_open(fse_data,O_WRONLY)
+		try:
+			time_next=monotonic()+checkpoint_interval
+			while time_next<time_stop:
+				sleep(max(0,time_next-monotonic()))
+				time_burst=monotonic()
+				written=0
+				while written<checkpoint_size:
+					size=rng.choice(_BENCH_PAGE_SIZES)
+					offset=rng.randrange(0,(file_size-size)//4096+1)*4096
+					time_start=monotonic()
+					pwrite(fd,page[:size],offset)
+					latencies.append(monotonic()-time_start)
+					written=written+size
+				fsync(fd)
+				bursts.append(monotonic()-time_burst)
+				total=total+written
+				time_next=time_next+checkpoint_interval
+		finally:
+			close(fd)
+		return (latencies,bursts,total)
+
+	time_start=monotonic()
+	try:
+		with ThreadPoolExecutor(
+				max_workers=readers+2
+			) as pool:
+			futures_read=[
+				pool.submit(reader,seed)
+				for seed in range(readers)
+			]
+			future_journal=pool.submit(journal)
+			future_checkpoint=pool.submit(checkpoint)
+
+			reads={size:[] for size in _BENCH_PAGE_SIZES}
+			for future in futures_read:
+				for size,latencies in future.result().items():
+					reads[size].extend(latencies)
+			journal_latencies=future_journal.result()
+			checkpoint_result=future_checkpoint.result()
+	except OSError as exc:
+		return f"the benchmark failed: {exc}"
+	finally:
+		close(fd_read)
+
+	seconds=monotonic()-time_start
+
+	result={
+		"seconds":round(seconds,3),
+		"file_size":file_size,
+		"readers":readers,
+		"direct":direct,
+	}
+	for size,latencies in reads.items():
+		result.update({
+			f"read_{size//1024}k":util_latency_stats(latencies,seconds,size*len(latencies))
+		})
+	result.update({
+		"journal":util_latency_stats(
+			journal_latencies,
+			seconds,
+			_BENCH_JOURNAL_RECORD*len(journal_latencies)
+		),
+		"checkpoint":{
+			"writes":util_latency_stats(
+				checkpoint_result[0],
+				seconds,
+				checkpoint_result[2]
+			),
+			"bursts":util_latency_stats(
+				checkpoint_result[1],
+				seconds
+			),
+		},
+	})
+
+	return result
+
+# LOCKS
+
+def util_lock_dir()->Path:
+
+	lock_dir=Path(_LOCK_DIR)
+	try:
+		lock_dir.mkdir(
+			exist_ok=True,
+			parents=True
+		)
+	except Exception:
+		lock_dir=Path(gettempdir()).joinpath("mongolical-locks")
+		lock_dir.mkdir(
+			exist_ok=True,
+			parents=True
+		)
+
+	return lock_dir
+
+@contextmanager
+def util_flock(key:str):
+
+	# Holds an exclusive flock(2) on a lock file named after the key, waiting for it if another process (or thread) has it
+	# It is reentrant within the same thread, so functions holding a lock can call each other
+
+	thread=get_ident()
+	with _LOCKS_GUARD:
+		held=_LOCKS_HELD.get(key)
+		if held is not None and held[2]==thread:
+			held[1]=held[1]+1
+			reentrant=True
+		else:
+			reentrant=False
+
+	if not reentrant:
+		fd=os_open(
+			str(util_lock_dir().joinpath(f"{key}.lock")),
+			O_RDWR|O_CREAT,
+			0o600
+		)
+		try:
+			flock(fd,LOCK_EX|LOCK_NB)
+		except BlockingIOError:
+			print("\nWaiting for lock:",key)
+			flock(fd,LOCK_EX)
+
+		with _LOCKS_GUARD:
+			_LOCKS_HELD.update({key:[fd,1,thread]})
+
+	try:
+		yield
+	finally:
+		with _LOCKS_GUARD:
+			held=_LOCKS_HELD[key]
+			held[1]=held[1]-1
+			if held[1]==0:
+				del _LOCKS_HELD[key]
+				flock(held[0],LOCK_UN)
+				close(held[0])
+
+def util_lock_keys(filepath:Union[str,Path])->list:
+
+	# The keys of the locks of an image
+	# → by name: the inode of its directory and its file name, which exists even before the image does
+	# → by inode: if the image exists, so two names of the same file share the lock
+	# They are always taken in this order
+
+	fse_path=Path(util_path_to_str(filepath))
+	fse_dir=Path(realpath(str(fse_path.parent)))
+
+	keys=[]
+	try:
+		st_dir=stat(str(fse_dir))
+		name=sha256(fse_path.name.encode()).hexdigest()[:16]
+		keys.append(f"name-{st_dir.st_dev:x}-{st_dir.st_ino}-{name}")
+	except FileNotFoundError:
+		name=sha256(realpath(str(fse_path)).encode()).hexdigest()[:16]
+		keys.append(f"path-{name}")
+
+	try:
+		st=stat(realpath(str(fse_path)))
+		keys.append(f"inode-{st.st_dev:x}-{st.st_ino}")
+	except FileNotFoundError:
+		pass
+
+	return keys
+
+@contextmanager
+def util_lock_image(filepath:Union[str,Path]):
+
+	# Holds the locks of an image
+
+	with ExitStack() as stack:
+		for key in util_lock_keys(filepath):
+			stack.enter_context(util_flock(key))
+		yield
+
+def util_lock_host_loop():
+
+	# Holds the lock for allocating loop devices, for the whole host
+
+	return util_flock(_LOCK_HOST_LOOP)
+
+# SPARSE FILES
+
+def util_file_extents(
+		fd:int,
+		size:Optional[int]=None
+	)->list:
+
+	# Gets the allocated (data) extents of an open file as (start,end) pairs, using SEEK_DATA and SEEK_HOLE
+	# If the filesystem does not support it, the whole file is returned as one extent
+
+	if size is None:
+		size=lseek(fd,0,SEEK_END)
+
+	extents=[]
+	pos=0
+	try:
+		while pos<size:
+			try:
+				start=lseek(fd,pos,SEEK_DATA)
+			except OSError as exc:
+				# There is no more data after pos
+				if exc.errno==ENXIO:
+					break
+				raise
+			end=lseek(fd,start,SEEK_HOLE)
+			extents.append((start,min(end,size)))
+			pos=end
+	except OSError as exc:
+		print("SEEK_DATA/SEEK_HOLE not supported:",exc)
+		extents=[]
+		if size>0:
+			extents.append((0,size))
+
+	return extents
+
+def util_split_extents(
+		extents:list,
+		chunk_size:int
+	)->list:
+
+	# Splits extents into pieces that do not cross chunk boundaries
+
+	pieces=[]
+	for start,end in extents:
+		pos=start
+		while pos<end:
+			limit=min(end,(pos//chunk_size+1)*chunk_size)
+			pieces.append((pos,limit))
+			pos=limit
+
+	return pieces
+
+def util_read_exact(fobj,size:int)->bytes:
+
+	# Reads exactly "size" bytes from a file object or a pipe, or less only at the end of the stream
+
+	parts=[]
+	missing=size
+	while missing>0:
+		data=fobj.read(missing)
+		if not data:
+			break
+		parts.append(data)
+		missing=missing-len(data)
+
+	return b"".join(parts)
+
+def fun_sparse_export(
+		filepath:Union[str,Path],
+		fobj,
+		codec:str=_CODEC_NONE,
+		chunk_size:int=_SPARSE_CHUNK_SIZE,
+		workers:int=4
+	)->Union[Mapping,str]:
+
+	# Writes a file as a sparse stream to a file object (a file, a pipe or stdout)
+	# Only the allocated extents are read, and chunks that are all zeroes are skipped too
+	# The chunks are compressed in parallel, and written in order
+	# Returns some statistics, or an error message
+
+	if codec not in _CODECS.keys():
+		return f"unknown codec: {codec}"
+
+	if not 0<chunk_size<=_SPARSE_CHUNK_SIZE_MAX:
+		return f"the chunk size must be above 0 and up to {_SPARSE_CHUNK_SIZE_MAX}"
+
+	compress_fn=_CODECS[codec][0]
+
+	fse_ok=util_path_to_str(filepath)
+	try:
+		fd=os_open(fse_ok,O_RDONLY)
+	except Exception as exc:
+		return f"failed to open the file: {exc}"
+
+	stats={
+		"size":0,
+		"chunks":0,
+		"bytes_read":0,
+		"bytes_written":0,
+	}
+
+	def process(piece:tuple)->Optional[tuple]:
+		data=pread(fd,piece[1]-piece[0],piece[0])
+		if data.count(0)==len(data):
+			return None
+		stored=compress_fn(data)
+		return (
+			piece[0],
+			len(data),
+			stored,
+			zlib_crc32(data)
+		)
+
+	try:
+		size=lseek(fd,0,SEEK_END)
+		pieces=util_split_extents(
+			util_file_extents(fd,size),
+			chunk_size
+		)
+
+		header=json_dumps({
+			"size":size,
+			"chunk_size":chunk_size,
+			"codec":codec,
+		}).encode()
+		fobj.write(_SPARSE_MAGIC)
+		fobj.write(struct_pack("<I",len(header)))
+		fobj.write(header)
+
+		stats.update({"size":size})
+
+		def write_result(result:Optional[tuple]):
+			if result is None:
+				return
+			fobj.write(
+				struct_pack(
+					_SPARSE_RECORD,
+					result[0],result[1],len(result[2]),result[3]
+				)
+			)
+			fobj.write(result[2])
+			stats.update({
+				"chunks":stats["chunks"]+1,
+				"bytes_read":stats["bytes_read"]+result[1],
+				"bytes_written":stats["bytes_written"]+_SPARSE_RECORD_SIZE+len(result[2]),
+			})
+
+		with ThreadPoolExecutor(max_workers=max(1,workers)) as pool:
+			pending=deque()
+			for piece in pieces:
+				pending.append(pool.submit(process,piece))
+				if len(pending)>workers*2:
+					write_result(pending.popleft().result())
+
+			while len(pending)>0:
+				write_result(pending.popleft().result())
+
+		fobj.write(struct_pack(_SPARSE_RECORD,_SPARSE_END,0,0,0))
+		fobj.flush()
+
+	except Exception as exc:
+		return f"failed to export: {exc}"
+
+	finally:
+		close(fd)
+
+	return stats
+
+def fun_sparse_import(
+		fobj,
+		filepath:Union[str,Path],
+		workers:int=4
+	)->Union[Mapping,str]:
+
+	# Rebuilds a sparse file from a stream written by fun_sparse_export
+	# The file must not exist, and is created with its full apparent size but only the stored chunks allocated
+	# Returns some statistics, or an error message
+
+	magic=util_read_exact(fobj,len(_SPARSE_MAGIC))
+	if not magic==_SPARSE_MAGIC:
+		return "not a sparse stream"
+
+	try:
+		header_len=struct_unpack("<I",util_read_exact(fobj,4))[0]
+		header=json_loads(util_read_exact(fobj,header_len).decode())
+	except Exception as exc:
+		return f"invalid header: {exc}"
+
+	codec=header.get("codec")
+	if codec not in _CODECS.keys():
+		return f"unknown codec: {codec}"
+
+	size=header.get("size")
+	if not isinstance(size,int):
+		return "invalid header: no size"
+
+	decompress_fn=_CODECS[codec][1]
+
+	fse_ok=util_path_to_str(filepath)
+	try:
+		fd=os_open(fse_ok,O_WRONLY|O_CREAT|O_EXCL,0o600)
+	except Exception as exc:
+		return f"failed to create the file: {exc}"
+
+	stats={
+		"size":size,
+		"chunks":0,
+		"bytes_written":0,
+	}
+
+	def process(record:tuple,stored:bytes)->int:
+		data=decompress_fn(stored)
+		if not len(data)==record[1]:
+			raise ValueError(f"chunk at {record[0]}: wrong length")
+		if not zlib_crc32(data)==record[3]:
+			raise ValueError(f"chunk at {record[0]}: checksum mismatch")
+		pwrite(fd,data,record[0])
+		return len(data)
+
+	def collect(future):
+		written=future.result()
+		stats.update({
+			"chunks":stats["chunks"]+1,
+			"bytes_written":stats["bytes_written"]+written,
+		})
+
+	ok=False
+	msg_err:Optional[str]=None
+
+	try:
+		ftruncate(fd,size)
+
+		with ThreadPoolExecutor(max_workers=max(1,workers)) as pool:
+			pending=deque()
+			while True:
+				raw=util_read_exact(fobj,_SPARSE_RECORD_SIZE)
+				if not len(raw)==_SPARSE_RECORD_SIZE:
+					raise ValueError("the stream ended unexpectedly")
+
+				record=struct_unpack(_SPARSE_RECORD,raw)
+				if record[0]==_SPARSE_END:
+					break
+
+				if record[0]+record[1]>size:
+					raise ValueError(f"chunk at {record[0]}: out of bounds")
+
+				stored=util_read_exact(fobj,record[2])
+				if not len(stored)==record[2]:
+					raise ValueError("the stream ended unexpectedly")
+
+				pending.append(pool.submit(process,record,stored))
+				if len(pending)>workers*2:
+					collect(pending.popleft())
+
+			while len(pending)>0:
+				collect(pending.popleft())
+
+		fsync(fd)
+		ok=True
+
+	except Exception as exc:
+		msg_err=f"failed to import: {exc}"
+
+	finally:
+		close(fd)
+
+	if not ok:
+		Path(fse_ok).unlink()
+		return msg_err
+
+	return stats
+
+# HASHING
+
+def util_hash_zeroes(hasher,size:int):
+
+	# Feeds a run of zeroes (a hole) into a hash object without allocating it
+
+	view=memoryview(_HASH_ZERO_BLOCK)
+	while size>0:
+		n=min(size,len(_HASH_ZERO_BLOCK))
+		hasher.update(view[:n])
+		size=size-n
+
+def util_hash_chunk(task:tuple)->str:
+
+	# Hashes one chunk of a file, given as (path,start,end,extents)
+	# Only the extents are read; holes are hashed as zeroes, so the digest only depends on the contents
+	# This runs on the workers of a process pool
+
+	filepath,start,end,extents=task
+
+	hasher=sha256()
+	fd=os_open(filepath,O_RDONLY)
+	try:
+		pos=start
+		for ext_start,ext_end in extents:
+			util_hash_zeroes(hasher,ext_start-pos)
+			offset=ext_start
+			while offset<ext_end:
+				data=pread(fd,min(ext_end-offset,len(_HASH_ZERO_BLOCK)*8),offset)
+				if not data:
+					break
+				hasher.update(data)
+				offset=offset+len(data)
+			pos=ext_end
+		util_hash_zeroes(hasher,end-pos)
+	finally:
+		close(fd)
+
+	return hasher.hexdigest()
+
+def util_merkle_root(digests:list)->str:
+
+	# Builds a binary hash tree over the chunk digests and returns its root
+
+	level=[bytes.fromhex(d) for d in digests]
+	if len(level)==0:
+		return sha256(b"").hexdigest()
+
+	while len(level)>1:
+		upper=[]
+		for idx in range(0,len(level),2):
+			if idx+1==len(level):
+				upper.append(level[idx])
+				continue
+			upper.append(
+				sha256(level[idx]+level[idx+1]).digest()
+			)
+		level=upper
+
+	return level[0].hex()
+
+def fun_hash_file(
+		filepath:Union[str,Path],
+		chunk_size:int=_HASH_CHUNK_SIZE,
+		workers:int=4,
+		previous:Optional[Mapping]=None
+	)->Union[Mapping,str]:
+
+	# Hashes a file in fixed size chunks across a process pool, reading only the allocated extents
+	# Chunks without extents are not read at all
+	# If a previous result is given and the file has the same size, modification and change times as back then, the chunks whose extents are the same keep their old digests
+	# This is only a fast path for a file that was not written to at all: a write anywhere changes the times, and then every chunk is hashed again (there is no telling which chunks a write touched)
+	# Writes that leave the times untouched (through the block device underneath, or with the times set back) go unnoticed, so reused digests prove nothing about the data
+	# Returns the chunk digests, their extents, the times of the file and the root of the hash tree, or an error message
+
+	fse_ok=util_path_to_str(filepath)
+	try:
+		fd=os_open(fse_ok,O_RDONLY)
+	except Exception as exc:
+		return f"failed to open the file: {exc}"
+
+	try:
+		st=fstat(fd)
+		size=lseek(fd,0,SEEK_END)
+		pieces=util_split_extents(
+			util_file_extents(fd,size),
+			chunk_size
+		)
+	finally:
+		close(fd)
+
+	qtty=(size+chunk_size-1)//chunk_size
+	chunks=[]
+	for idx in range(qtty):
+		chunks.append({
+			"extents":[],
+			"digest":None
+		})
+	for piece in pieces:
+		chunks[piece[0]//chunk_size]["extents"].append(list(piece))
+
+	old_chunks=[]
+	if previous is not None:
+		if not (previous.get("size")==size and previous.get("chunk_size")==chunk_size):
+			print("The size or the chunk size changed, hashing everything")
+		elif not (previous.get("mtime_ns")==st.st_mtime_ns and previous.get("ctime_ns")==st.st_ctime_ns):
+			print("The file was modified, hashing everything")
+		else:
+			old_chunks=previous.get("chunks",[])
+
+	zero_digests={}
+	tasks=[]
+	reused=0
+	for idx,chunk in enumerate(chunks):
+		start=idx*chunk_size
+		end=min(size,start+chunk_size)
+
+		if idx<len(old_chunks):
+			if old_chunks[idx].get("extents")==chunk["extents"]:
+				chunk.update({"digest":old_chunks[idx].get("digest")})
+				reused=reused+1
+				continue
+
+		if len(chunk["extents"])==0:
+			if end-start not in zero_digests.keys():
+				zero_digests.update({
+					end-start:util_hash_chunk((fse_ok,start,end,[]))
+				})
+			chunk.update({"digest":zero_digests[end-start]})
+			continue
+
+		tasks.append((idx,(fse_ok,start,end,chunk["extents"])))
+
+	if len(tasks)>0:
+		try:
+			with ProcessPoolExecutor(max_workers=max(1,workers)) as pool:
+				digests=pool.map(
+					util_hash_chunk,
+					[t[1] for t in tasks],
+					chunksize=max(1,len(tasks)//(workers*8))
+				)
+				for t,digest in zip(tasks,digests):
+					chunks[t[0]].update({"digest":digest})
+		except Exception as exc:
+			return f"failed to hash the file: {exc}"
+
+	return {
+		"algorithm":_HASH_ALGORITHM,
+		"size":size,
+		"chunk_size":chunk_size,
+		"mtime_ns":st.st_mtime_ns,
+		"ctime_ns":st.st_ctime_ns,
+		"root":util_merkle_root([c["digest"] for c in chunks]),
+		"hashed":len(tasks),
+		"reused":reused,
+		"chunks":chunks,
+	}
+
 # BASIC
 
 # MOUNTPOINT
@@ -84,6 +2214,15 @@ def cmd_mountpoint(
 
 	dir_str=util_path_to_str(dirpath)
 
+	mounts=util_read_mountinfo()
+	if mounts is not None:
+		dir_real=realpath(dir_str)
+		for m in mounts:
+			if m["target"]==dir_real:
+				return True
+
+		return False
+
 	result=util_subrun(["mountpoint",dir_str])
 	if not result[0]==0:
 		if result[1] is not None:
@@ -100,25 +2239,59 @@ def cmd_mount_path(
 		spec_mode:Optional[str]=None,
 		ensure_dest:bool=False,
 		conf_only:bool=True,
+		options:Optional[str]=None,
+		use_libc:bool=True,
+		fs_type:Optional[str]=None,
 	)->Union[bool,int]:
 
 	# Mounts a block device (filesystem) or a directory (bind mount) depending on the path given
+	# With a filesystem type, the source can be anything that filesystem accepts (tmpfs for example)
+	# Uses mount(2) directly when possible, otherwise it runs the mount command
 
 	fse_dev=util_path_to_str(orig)
 	fse_dir=util_path_to_str(dest)
 
 	if ensure_dest:
-		Path(fse_dir).mkdir(
-			exist_ok=True,
-			parents=True
-		)
+		try:
+			Path(fse_dir).mkdir(
+				exist_ok=True,
+				parents=True
+			)
+		except Exception as exc:
+			print("Unable to create the mountpoint:",exc)
+			return False
+
+	is_bind=(fs_type is None) and Path(fse_dev).is_dir()
+
+	opts=[]
+	if spec_mode in ("rw","ro","auto"):
+		opts.append(spec_mode)
+	if options is not None:
+		opts.append(options)
+
+	fstype:Optional[str]=fs_type
+	if use_libc and (not is_bind) and (fstype is None):
+		fstype=util_guess_fstype(fse_dev)
+
+	if use_libc and (is_bind or fstype is not None):
+		if util_get_libc() is not None:
+			result=fun_libc_mount_path(
+				fse_dev,fse_dir,fstype,
+				",".join(opts),
+				is_bind
+			)
+			if conf_only:
+				return result==0
+			return result
 
 	command=["mount"]
-	if Path(fse_dev).is_dir():
+	if is_bind:
 		command.append("-B")
+	if fs_type is not None:
+		command.extend(["-t",fs_type])
 
-	if spec_mode in ("rw","ro","auto"):
-		command.extend(["-o",spec_mode])
+	if len(opts)>0:
+		command.extend(["-o",",".join(opts)])
 	command.extend([fse_dev,fse_dir])
 
 	result=util_subrun(command)
@@ -136,6 +2309,38 @@ def cmd_mount_path(
 
 	return True
 
+def fun_libc_mount_path(
+		fse_dev:str,
+		fse_dir:str,
+		fstype:Optional[str],
+		options:str,
+		is_bind:bool
+	)->int:
+
+	# Mounts through mount(2)
+	# The flags of a bind mount are ignored by the kernel on creation, so they are applied with a remount afterwards
+
+	flags,data=util_mount_options(options)
+
+	if not is_bind:
+		return libc_mount(fse_dev,fse_dir,fstype,flags,data)
+
+	result=libc_mount(
+		fse_dev,fse_dir,None,
+		_MS_BIND|(flags&_MS_REC)
+	)
+	if not result==0:
+		return result
+
+	flags_extra=flags&(~(_MS_BIND|_MS_REC))
+	if flags_extra==0:
+		return 0
+
+	return libc_mount(
+		"none",fse_dir,None,
+		_MS_REMOUNT|_MS_BIND|flags_extra
+	)
+
 def cmd_mount_volume(
 		uuid:str,
 		dest:str,
@@ -180,9 +2385,12 @@ def cmd_umount(
 		mount_point:Union[str,Path],
 		recursive:bool=False,
 		conf_only:bool=True,
+		lazy:bool=False,
+		use_libc:bool=True,
 	)->Union[bool,int]:
 
 	# Unmounts whatever is mounted on a given directory
+	# Uses umount2(2) directly when possible, otherwise it runs the umount command
 
 	fse_dir=util_path_to_str(mount_point)
 	if not Path(fse_dir).is_dir():
@@ -190,9 +2398,21 @@ def cmd_umount(
 			return 69
 		return False
 
+	if use_libc and (util_get_libc() is not None):
+		result=fun_libc_umount_path(
+			fse_dir,
+			recursive=recursive,
+			lazy=lazy
+		)
+		if conf_only:
+			return result==0
+		return result
+
 	command=["umount"]
 	if recursive:
 		command.append("-R")
+	if lazy:
+		command.append("-l")
 	command.append(fse_dir)
 
 	result=util_subrun(command)
@@ -203,12 +2423,50 @@ def cmd_umount(
 		if not conf_only:
 			return result[0]
 
-		return False
+		return False
+
+	if not conf_only:
+		return result[0]
+
+	return True
+
+def fun_libc_umount_path(
+		fse_dir:str,
+		recursive:bool=False,
+		lazy:bool=False
+	)->int:
+
+	# Unmounts through umount2(2)
+	# When recursive, the submounts are taken from the mount table and unmounted deepest first
+
+	flags=0
+	if lazy:
+		flags=_MNT_DETACH
+
+	dir_real=realpath(fse_dir)
+	targets=[dir_real]
 
-	if not conf_only:
-		return result[0]
+	if recursive:
+		mounts=util_read_mountinfo()
+		if mounts is not None:
+			prefix=dir_real.rstrip("/")+"/"
+			selection=[]
+			for m in mounts:
+				if m["target"]==dir_real or m["target"].startswith(prefix):
+					selection.append(m)
+			selection.sort(
+				key=lambda m:(m["target"].count("/"),m["mount_id"]),
+				reverse=True
+			)
+			if len(selection)>0:
+				targets=[m["target"] for m in selection]
 
-	return True
+	for target in targets:
+		result=libc_umount(target,flags)
+		if not result==0:
+			return result
+
+	return 0
 
 # FINDMNT
 
@@ -385,131 +2643,584 @@ def cmd_lsblk_get_devices(
 			if item.get("path")==fse_ok:
 				continue
 
-		selection.append(item)
+		selection.append(item)
+
+	if get_quantity:
+		return len(selection)
+	return selection
+
+def cmd_lsblk_get_dev_size(
+		filepath:Union[str,Path],
+		is_filesystem:bool=False
+	)->Optional[int]:
+
+	# Get disk/filesystem size
+
+	column={
+		True:"FSSIZE",
+		False:"SIZE"
+	}[is_filesystem]
+
+	fse_ok=util_path_to_str(filepath)
+
+	result=util_subrun([
+		"lsblk",fse_ok,
+		"-n","-b",
+		"-o",column,
+	])
+	if not result[0]==0:
+		print(result[1])
+		return None
+
+	size_raw=result[1]
+	if not size_raw.isdigit():
+		print("NaN")
+		return None
+
+	return int(size_raw)
+
+# PARTED
+
+def cmd_parted_disk_init(
+		filepath:Union[str,Path],
+		table:str
+	)->bool:
+
+	# Creates a partition table
+
+	fse_ok=util_path_to_str(filepath)
+
+	result=util_subrun([
+		"parted","-s",fse_ok,
+		"mklabel",table
+	])
+	if not result[0]==0:
+		if result[1] is not None:
+			print(result[1])
+
+	return (result[0]==0)
+
+def cmd_parted_part_new(
+		filepath:Union[str,Path],
+		fs_type:str,
+		fs_start:Optional[str]=None,
+		fs_end:Optional[str]=None,
+	)->bool:
+
+	# Create a primary partition
+
+	fse_ok=util_path_to_str(filepath)
+
+	the_start=fs_start
+	the_end=fs_end
+	if fs_type==_FSTYPE_EXT4:
+		if the_start is None:
+			the_start="1MiB"
+		if the_end is None:
+			the_end="100%"
+
+	if fs_type==_FSTYPE_FAT32:
+		if the_start is None:
+			the_start="2048s"
+		if the_end is None:
+			the_end="100%"
+
+	result=util_subrun([
+		"parted","-s",fse_ok,
+		"mkpart","primary",fs_type,
+		the_start,the_end
+	])
+	if not result[0]==0:
+		if result[1] is not None:
+			print(result[1])
+
+	return (result[0]==0)
+
+def util_mbr_partitions(filepath:Union[str,Path])->Optional[list]:
+
+	# Reads the MBR partition table of a disk image (or device)
+	# Returns the used entries: index (0 to 3), type, first sector and number of sectors, or None if there is no MBR
+
+	try:
+		with open(util_path_to_str(filepath),"rb") as f:
+			head=f.read(_MBR_SECTOR_SIZE)
+	except Exception as exc:
+		print("Unable to read the partition table:",exc)
+		return None
+
+	if not len(head)==_MBR_SECTOR_SIZE:
+		return None
+	if not head[510:512]==_MBR_SIGNATURE:
+		return None
+
+	entries=[]
+	for idx in range(4):
+		offset=_MBR_ENTRIES_OFFSET+idx*_MBR_ENTRY_SIZE
+		fields=struct_unpack(
+			_MBR_ENTRY,
+			head[offset:offset+_MBR_ENTRY_SIZE]
+		)
+		if fields[2]==0:
+			continue
+		entries.append({
+			"index":idx,
+			"type":fields[2],
+			"start":fields[4],
+			"sectors":fields[5],
+		})
+
+	return entries
+
+def util_mbr_resize_partition(
+		filepath:Union[str,Path],
+		index:int,
+		sectors:int
+	)->bool:
+
+	# Changes the number of sectors of an MBR partition, the start stays where it is
+	# The filesystem in it must fit already
+
+	fse_ok=util_path_to_str(filepath)
+
+	print("\n$",["mbr resize",fse_ok,index,sectors])
+
+	offset=_MBR_ENTRIES_OFFSET+index*_MBR_ENTRY_SIZE
+	try:
+		fd=os_open(fse_ok,O_RDWR)
+	except OSError as exc:
+		print(exc)
+		return False
+
+	try:
+		fields=list(struct_unpack(
+			_MBR_ENTRY,
+			pread(fd,_MBR_ENTRY_SIZE,offset)
+		))
+		fields[3]=_MBR_CHS_BEYOND
+		fields[5]=sectors
+		pwrite(fd,struct_pack(_MBR_ENTRY,*fields),offset)
+		fsync(fd)
+	except Exception as exc:
+		print(exc)
+		return False
+	finally:
+		close(fd)
+
+	return True
+
+# MKFS
+
+def cmd_mkfs_part_format(
+		filepath:Union[str,Path],
+		fs_type:str,
+		fs_label:Optional[str]=None,
+		extra_args:Optional[list]=None,
+	)->bool:
+
+	# Formats a partition
+
+	command=[]
+	fs_label_ok=util_fixstring(fs_label,low=True)
+	if fs_type==_FSTYPE_EXT4:
+		command.extend(["mkfs.ext4","-F"])
+		if fs_label_ok is not None:
+			command.extend(["-L",fs_label_ok])
+
+	if fs_type==_FSTYPE_FAT32:
+		command.extend(["mkfs.fat","-v","-F","32"])
+		if fs_label_ok is not None:
+			command.extend(["-n",fs_label_ok])
+
+	if extra_args is not None:
+		command.extend(extra_args)
+
+	command.append(
+		util_path_to_str(filepath)
+	)
+
+	result=util_subrun(command)
+	if not result[0]==0:
+		if result[1] is not None:
+			print(result[1])
+
+	return (result[0]==0)
+
+def cmd_tune2fs_project_quota(filepath:Union[str,Path])->bool:
+
+	# Turns on project IDs and project quota accounting on an (unmounted) ext4 filesystem
+	# The limits are only enforced when it is mounted with "prjquota"
+
+	result=util_subrun([
+		"tune2fs",
+		"-O","quota,project",
+		"-Q","prjquota",
+		util_path_to_str(filepath)
+	])
+	if not result[0]==0:
+		if result[1] is not None:
+			print(result[1])
+
+	return (result[0]==0)
+
+# E2FSPROGS
+
+def util_ext4_superblock(filepath:Union[str,Path])->Optional[Mapping]:
+
+	# Reads the sizes of an ext4 filesystem from its superblock: block size, blocks, free blocks, inodes and inode size
+	# Also whether the journal has to be replayed (it was not unmounted cleanly), whether the kernel found errors in it, and the label
+
+	try:
+		with open(util_path_to_str(filepath),"rb") as f:
+			f.seek(_EXT4_SUPERBLOCK_OFFSET)
+			sb=f.read(1024)
+	except Exception as exc:
+		print("Unable to read the superblock:",exc)
+		return None
+
+	if not len(sb)==1024:
+		return None
+	if not struct_unpack("<H",sb[56:58])[0]==_EXT4_MAGIC:
+		return None
+
+	inodes,blocks,_,free_blocks=struct_unpack("<IIII",sb[0:16])
+	log_block_size=struct_unpack("<I",sb[24:28])[0]
+	inode_size=struct_unpack("<H",sb[88:90])[0]
+	state=struct_unpack("<H",sb[58:60])[0]
+	incompat=struct_unpack("<I",sb[96:100])[0]
+	if incompat&_EXT4_FEATURE_INCOMPAT_64BIT:
+		blocks=blocks|(struct_unpack("<I",sb[336:340])[0]<<32)
+		free_blocks=free_blocks|(struct_unpack("<I",sb[344:348])[0]<<32)
+
+	return {
+		"block_size":1024<<log_block_size,
+		"blocks":blocks,
+		"free_blocks":free_blocks,
+		"inodes":inodes,
+		"inode_size":inode_size,
+		"needs_recovery":(incompat&_EXT4_FEATURE_INCOMPAT_RECOVER)>0,
+		"errors":(state&_EXT4_STATE_ERRORS)>0,
+		"label":util_fixstring(sb[120:136].split(b"\0")[0].decode(errors="replace")),
+	}
+
+def cmd_e2fsck(
+		filepath:Union[str,Path],
+		readonly:bool=False,
+		discard:bool=False
+	)->int:
+
+	# Forces a full check of an ext4 filesystem
+	# → read-only: nothing is changed (-n)
+	# → otherwise: what can be fixed safely is fixed (-p)
+	# With discard, the free blocks are discarded afterwards (on a loop device, holes are punched in the file)
+	# Returns the exit code: 0 clean, 1 fixed, 4 and above not fixed or failed
+
+	command=["e2fsck","-f"]
+	if readonly:
+		command.append("-n")
+	else:
+		command.append("-p")
+	if discard:
+		command.extend(["-E","discard"])
+	command.append(util_path_to_str(filepath))
+
+	return util_subrun(command,ret_mode=_RET_RETURNCODE)
+
+def cmd_resize2fs_min_blocks(filepath:Union[str,Path])->Optional[int]:
+
+	# The minimum size of an ext4 filesystem, as estimated by resize2fs, in filesystem blocks
+
+	result=util_subrun([
+		"resize2fs","-P",
+		util_path_to_str(filepath)
+	])
+	if not result[0]==0 or result[1] is None:
+		return None
+
+	for match in re_finditer(r"minimum size of the filesystem: (\d+)",result[1]):
+		return int(match.group(1))
+
+	return None
+
+def cmd_resize2fs(
+		filepath:Union[str,Path],
+		blocks:int
+	)->bool:
+
+	# Resizes an (unmounted, checked) ext4 filesystem to the given number of filesystem blocks
+
+	result=util_subrun([
+		"resize2fs",
+		util_path_to_str(filepath),
+		str(blocks)
+	])
+	if not result[0]==0:
+		if result[1] is not None:
+			print(result[1])
+
+	return (result[0]==0)
+
+def cmd_dumpe2fs_groups(filepath:Union[str,Path])->Optional[list]:
+
+	# The block groups of an ext4 filesystem, as (first block, last block, free blocks)
+
+	result=util_subrun([
+		"dumpe2fs",
+		util_path_to_str(filepath)
+	])
+	if not result[0]==0 or result[1] is None:
+		return None
+
+	groups=[]
+	for match in re_finditer(
+			r"Group \d+: \(Blocks (\d+)-(\d+)\)[^\n]*\n(?:[^\n]*\n)*?\s+(\d+) free blocks,",
+			result[1]
+		):
+		groups.append((
+			int(match.group(1)),
+			int(match.group(2)),
+			int(match.group(3))
+		))
+
+	return groups
+
+def cmd_mksquashfs(
+		source:Union[str,Path],
+		output:Union[str,Path],
+		compressor:Optional[str]=None
+	)->bool:
+
+	# Packs a directory into a SquashFS image, with owners, permissions and times as they are
+
+	command=[
+		"mksquashfs",
+		util_path_to_str(source),
+		util_path_to_str(output),
+		"-noappend",
+		"-comp",compressor or _ARCHIVE_COMPRESSORS[_FSTYPE_SQUASHFS]
+	]
+
+	return util_subrun(command,ret_mode=_RET_RETURNCODE)==0
+
+def cmd_mkfs_erofs(
+		source:Union[str,Path],
+		output:Union[str,Path],
+		compressor:Optional[str]=None
+	)->bool:
+
+	# Packs a directory into an EROFS image, with owners, permissions and times as they are
+
+	command=[
+		"mkfs.erofs",
+		f"-z{compressor or _ARCHIVE_COMPRESSORS[_FSTYPE_EROFS]}",
+		util_path_to_str(output),
+		util_path_to_str(source)
+	]
+
+	return util_subrun(command,ret_mode=_RET_RETURNCODE)==0
+
+# DMSETUP
+
+def cmd_dmsetup_create(
+		name:str,
+		table:str,
+		readonly:bool=False,
+		print_table:bool=True
+	)->Optional[str]:
+
+	# Creates a device-mapper device from a table given through stdin
+	# Tables with keys in them (dm-crypt) should not be printed
+	# Returns the path to the new device if successful
+
+	command=["dmsetup","create",name]
+	if readonly:
+		command.append("--readonly")
+
+	if print_table:
+		print(table)
+
+	result=util_subrun(command,input_text=f"{table}\n")
+	if not result[0]==0:
+		if result[1] is not None:
+			print(result[1])
+		return None
+
+	return f"/dev/mapper/{name}"
+
+def cmd_dmsetup_remove(
+		name:str,
+		retry:bool=True
+	)->bool:
+
+	# Removes a device-mapper device
+
+	command=["dmsetup","remove"]
+	if retry:
+		command.append("--retry")
+	command.append(name)
+
+	result=util_subrun(command)
+	if not result[0]==0:
+		if result[1] is not None:
+			print(result[1])
+		return False
+
+	return True
+
+def cmd_dmsetup_status(name:str)->Optional[str]:
 
-	if get_quantity:
-		return len(selection)
-	return selection
+	# Gets the status line of a device-mapper device
 
-def cmd_lsblk_get_dev_size(
-		filepath:Union[str,Path],
-		is_filesystem:bool=False
-	)->Optional[int]:
+	result=util_subrun(["dmsetup","status",name])
+	if not result[0]==0:
+		if result[1] is not None:
+			print(result[1])
+		return None
 
-	# Get disk/filesystem size
+	return result[1]
 
-	column={
-		True:"FSSIZE",
-		False:"SIZE"
-	}[is_filesystem]
+def cmd_dmsetup_table(name:str)->Optional[str]:
 
-	fse_ok=util_path_to_str(filepath)
+	# Gets the table of a device-mapper device
 
-	result=util_subrun([
-		"lsblk",fse_ok,
-		"-n","-b",
-		"-o",column,
-	])
+	result=util_subrun(["dmsetup","table",name])
 	if not result[0]==0:
-		print(result[1])
-		return None
-
-	size_raw=result[1]
-	if not size_raw.isdigit():
-		print("NaN")
 		return None
 
-	return int(size_raw)
-
-# PARTED
+	return util_fixstring(result[1])
 
-def cmd_parted_disk_init(
-		filepath:Union[str,Path],
+def cmd_dmsetup_load(
+		name:str,
 		table:str
 	)->bool:
 
-	# Creates a partition table
+	# Loads a new table into the inactive slot of a device-mapper device, it becomes active on resume
 
-	fse_ok=util_path_to_str(filepath)
+	print(table)
 
-	result=util_subrun([
-		"parted","-s",fse_ok,
-		"mklabel",table
-	])
+	result=util_subrun(
+		["dmsetup","load",name],
+		input_text=f"{table}\n"
+	)
 	if not result[0]==0:
 		if result[1] is not None:
 			print(result[1])
+		return False
 
-	return (result[0]==0)
+	return True
 
-def cmd_parted_part_new(
-		filepath:Union[str,Path],
-		fs_type:str,
-		fs_start:Optional[str]=None,
-		fs_end:Optional[str]=None,
+def cmd_dmsetup_suspend(
+		name:str,
+		nolockfs:bool=False
 	)->bool:
 
-	# Create a primary partition
+	# Suspends a device-mapper device: pending I/O is flushed and new I/O waits
+	# Unless nolockfs, the filesystem on it is frozen too
 
-	fse_ok=util_path_to_str(filepath)
+	command=["dmsetup","suspend"]
+	if nolockfs:
+		command.append("--nolockfs")
+	command.append(name)
 
-	the_start=fs_start
-	the_end=fs_end
-	if fs_type==_FSTYPE_EXT4:
-		if the_start is None:
-			the_start="1MiB"
-		if the_end is None:
-			the_end="100%"
+	result=util_subrun(command)
+	if not result[0]==0:
+		if result[1] is not None:
+			print(result[1])
+		return False
 
-	if fs_type==_FSTYPE_FAT32:
-		if the_start is None:
-			the_start="2048s"
-		if the_end is None:
-			the_end="100%"
+	return True
 
-	result=util_subrun([
-		"parted","-s",fse_ok,
-		"mkpart","primary",fs_type,
-		the_start,the_end
-	])
+def cmd_dmsetup_resume(name:str)->bool:
+
+	result=util_subrun(["dmsetup","resume",name])
 	if not result[0]==0:
 		if result[1] is not None:
 			print(result[1])
+		return False
 
-	return (result[0]==0)
+	return True
 
-# MKFS
+def util_parse_dm_snapshot_status(line:Optional[str])->Optional[Mapping]:
 
-def cmd_mkfs_part_format(
-		filepath:Union[str,Path],
-		fs_type:str,
-		fs_label:Optional[str]=None,
-	)->bool:
+	# Parses the status line of a snapshot (or snapshot-merge) target
+	# <start> <length> snapshot <sectors_allocated>/<total_sectors> <metadata_sectors>
+	# or <start> <length> snapshot Invalid|Overflow (no metadata field)
+	# A merge is over when only the metadata is left
 
-	# Formats a partition
+	if line is None:
+		return None
 
-	command=[]
-	fs_label_ok=util_fixstring(fs_label,low=True)
-	if fs_type==_FSTYPE_EXT4:
-		command.extend(["mkfs.ext4","-F"])
-		if fs_label_ok is not None:
-			command.extend(["-L",fs_label_ok])
+	fields=line.split()
+	if len(fields)<4:
+		return None
 
-	if fs_type==_FSTYPE_FAT32:
-		command.extend(["mkfs.fat","-v","-F","32"])
-		if fs_label_ok is not None:
-			command.extend(["-n",fs_label_ok])
+	if not fields[2] in ("snapshot","snapshot-merge"):
+		return None
 
-	command.append(
-		util_path_to_str(filepath)
-	)
+	if not "/" in fields[3]:
+		return {
+			"state":fields[3],
+		}
 
-	result=util_subrun(command)
-	if not result[0]==0:
-		if result[1] is not None:
-			print(result[1])
+	if len(fields)<5:
+		return None
 
-	return (result[0]==0)
+	try:
+		allocated,total=[int(x) for x in fields[3].split("/")]
+		metadata=int(fields[4])
+	except ValueError:
+		return None
+
+	return {
+		"state":"valid",
+		"allocated_sectors":allocated,
+		"total_sectors":total,
+		"metadata_sectors":metadata,
+		"usage":round(allocated/total,4) if total>0 else None,
+		"merged":(allocated==metadata),
+	}
+
+def util_parse_dm_cache_status(line:Optional[str])->Optional[Mapping]:
+
+	# Parses the status line of a dm-cache target
+	# <start> <length> cache <metadata block size> <used>/<total metadata blocks> <cache block size> <used>/<total cache blocks> <read hits> <read misses> <write hits> <write misses> <demotions> <promotions> <dirty> ...
+
+	if line is None:
+		return None
+
+	fields=line.split()
+	if not len(fields)>13:
+		return None
+	if not fields[2]=="cache":
+		return None
+
+	try:
+		meta_used,meta_total=[int(x) for x in fields[4].split("/")]
+		cache_used,cache_total=[int(x) for x in fields[6].split("/")]
+		read_hits,read_misses,write_hits,write_misses=[int(x) for x in fields[7:11]]
+		demotions,promotions,dirty=[int(x) for x in fields[11:14]]
+	except ValueError:
+		return None
+
+	def rate(hits:int,misses:int)->Optional[float]:
+		if hits+misses==0:
+			return None
+		return round(hits/(hits+misses),4)
+
+	return {
+		"metadata_blocks_used":meta_used,
+		"metadata_blocks_total":meta_total,
+		"cache_blocks_used":cache_used,
+		"cache_blocks_total":cache_total,
+		"read_hits":read_hits,
+		"read_misses":read_misses,
+		"read_hit_rate":rate(read_hits,read_misses),
+		"write_hits":write_hits,
+		"write_misses":write_misses,
+		"write_hit_rate":rate(write_hits,write_misses),
+		"demotions":demotions,
+		"promotions":promotions,
+		"dirty_blocks":dirty,
+	}
 
 # LOSETUP
 
@@ -621,9 +3332,13 @@ def cmd_losetup_attach(
 		filepath:Union[str,Path],
 		get_as_pl:bool=False,
 		partitioned:bool=False,
+		offset:Optional[int]=None,
+		sizelimit:Optional[int]=None,
+		readonly:bool=False
 	)->Optional[Union[str,Path]]:
 
 	# Given a path to a file, finds and attaches a loop device to it
+	# With an offset and a size limit, only that part of the file is attached (a single partition, for example)
 	# Returns the path to the loop device if successful
 
 	fse_ok=util_path_to_str(filepath)
@@ -632,10 +3347,17 @@ def cmd_losetup_attach(
 
 	if partitioned:
 		command.append("--partscan")
+	if offset is not None:
+		command.extend(["--offset",str(offset)])
+	if sizelimit is not None:
+		command.extend(["--sizelimit",str(sizelimit)])
+	if readonly:
+		command.append("--read-only")
 
 	command.extend(["--find",fse_ok,"--show"])
 
-	result=util_subrun(command)
+	with util_lock_host_loop():
+		result=util_subrun(command)
 
 	if not result[0]==0:
 		if result[1] is not None:
@@ -740,35 +3462,381 @@ def fun_unmount_all_parts(filepath:Union[str,Path])->bool:
 
 	return (count==count_max)
 
+def fun_build_mount_tree(
+		devices:list,
+		majmin_extra:Optional[list]=None
+	)->Optional[Mapping]:
+
+	# Given a list of block devices, it builds the tree of everything that is mounted from them, in a single read of the mount table
+	# Filesystems without a block device (tmpfs for example) can be given by their "major:minor" from the mount table
+	# This includes bind mounts of those filesystems, and anything mounted on top of any of them
+	# The mounts are grouped in levels: the first level are the leaves, and every level only depends on the ones before it
+	# Returns None if the mount table is not available
+
+	mounts=util_read_mountinfo()
+	if mounts is None:
+		return None
+
+	majmin_set=[]
+	if majmin_extra is not None:
+		majmin_set.extend(majmin_extra)
+	for dev in devices:
+		mm=util_dev_majmin(dev)
+		if mm is None:
+			continue
+		majmin_set.append(mm)
+
+	selected={}
+	for m in mounts:
+		if m["majmin"] in majmin_set:
+			selected.update({m["mount_id"]:m})
+
+	while True:
+		found=0
+		for m in mounts:
+			if m["mount_id"] in selected.keys():
+				continue
+			if m["parent_id"] not in selected.keys():
+				continue
+			selected.update({m["mount_id"]:m})
+			found=found+1
+
+		if found==0:
+			break
+
+	children={}
+	for mount_id in selected.keys():
+		children.update({mount_id:[]})
+	for m in selected.values():
+		if m["parent_id"] in children.keys():
+			children[m["parent_id"]].append(m["mount_id"])
+
+	height={}
+
+	def get_height(mount_id:int)->int:
+		if mount_id in height.keys():
+			return height[mount_id]
+		h=0
+		for child_id in children[mount_id]:
+			h=max(h,get_height(child_id)+1)
+		height.update({mount_id:h})
+		return h
+
+	levels=[]
+	for mount_id in selected.keys():
+		h=get_height(mount_id)
+		while not len(levels)>h:
+			levels.append([])
+		levels[h].append(selected[mount_id])
+
+	return {
+		"devices":list(devices),
+		"mounts":selected,
+		"levels":levels,
+	}
+
+def fun_unmount_source(
+		source:str,
+		fs_type:str,
+		max_workers:int=8
+	)->bool:
+
+	# Unmounts every mount of a filesystem that has no block device (tmpfs for example), found by its source and type
+	# Bind mounts of it, and anything mounted on top, are unmounted first
+
+	mounts=util_read_mountinfo()
+	if mounts is None:
+		return False
+
+	majmin_list=[]
+	for m in mounts:
+		if not (m["source"]==source and m["fstype"]==fs_type):
+			continue
+		if m["majmin"] in majmin_list:
+			continue
+		majmin_list.append(m["majmin"])
+
+	if len(majmin_list)==0:
+		return True
+
+	tree=fun_build_mount_tree([],majmin_extra=majmin_list)
+	if tree is None:
+		return False
+
+	return fun_unmount_tree(
+		tree,
+		max_workers=max_workers
+	)
+
+def fun_umount_target(
+		target:str,
+		lazy:bool=False
+	)->bool:
+
+	# Unmounts a single mount table entry
+	# Unlike cmd_umount, the target can also be a bind mounted file
+
+	if util_get_libc() is not None:
+		flags=0
+		if lazy:
+			flags=_MNT_DETACH
+		return libc_umount(target,flags)==0
+
+	command=["umount"]
+	if lazy:
+		command.append("-l")
+	command.append(target)
+
+	result=util_subrun(command)
+	if not result[0]==0:
+		if result[1] is not None:
+			print(result[1])
+		return False
+
+	return True
+
+def fun_unmount_tree(
+		tree:Mapping,
+		max_workers:int=8,
+		lazy:bool=False
+	)->bool:
+
+	# Unmounts a tree from fun_build_mount_tree, one level at a time, with the mounts of each level unmounted in parallel
+
+	for level in tree["levels"]:
+
+		targets=[m["target"] for m in level]
+		if len(targets)==0:
+			continue
+
+		print("\nUnmounting:",targets)
+
+		with ThreadPoolExecutor(
+				max_workers=max(1,min(max_workers,len(targets)))
+			) as pool:
+			results=list(
+				pool.map(
+					lambda t:fun_umount_target(t,lazy=lazy),
+					targets
+				)
+			)
+
+		if not all(results):
+			print("Failed to unmount at least one of:",targets)
+			return False
+
+	return True
+
+def util_loop_attached(loopdev:str)->bool:
+
+	# Whether a loop device still has a backing file
+
+	return util_sysfs_entry(loopdev).joinpath("loop","backing_file").exists()
+
+def util_loop_blockers(
+		loopdev:str,
+		mounts:Optional[list]
+	)->Mapping:
+
+	# What keeps a loop device busy: the mounts of it and of its partitions, and the device-mapper targets (or other holders) stacked on it
+
+	devices=[loopdev]
+	devices.extend(
+		util_sysfs_partitions(loopdev)
+	)
+
+	majmin_set=[]
+	for dev in devices:
+		mm=util_dev_majmin(dev)
+		if mm is None:
+			continue
+		majmin_set.append(mm)
+
+	targets=[]
+	if mounts is not None:
+		for m in mounts:
+			if m["majmin"] in majmin_set:
+				targets.append(m["target"])
+
+	holders=[]
+	for holder in util_sysfs_holders(devices):
+		name=util_sysfs_dm_name(holder)
+		if name is None:
+			holders.append(holder)
+		else:
+			holders.append(f"{holder} ({name})")
+
+	return {
+		"mounts":targets,
+		"holders":holders,
+	}
+
+def fun_loop_detach(loopdev:str)->Mapping:
+
+	# Detaches a single loop device, and reports how it went
+	# → "ok": the device is detached, or will be as soon as it is closed ("deferred")
+	# → "seconds": how long it took
+	# → "blockers": if it is still attached, what keeps it busy
+
+	time_start=monotonic()
+
+	ok=(libc_loop_detach(loopdev) in (0,ENXIO))
+	if not ok:
+		ok=cmd_losetup_detatch(loopdev)
+
+	report={
+		"device":loopdev,
+		"ok":ok,
+		"deferred":False,
+		"seconds":round(monotonic()-time_start,6),
+		"blockers":None,
+	}
+
+	if util_loop_attached(loopdev):
+		report.update({
+			"deferred":ok,
+			"blockers":util_loop_blockers(
+				loopdev,
+				util_read_mountinfo()
+			)
+		})
+
+	return report
+
+def fun_loop_detach_all(
+		loopdev_list:list,
+		max_workers:int=8
+	)->list:
+
+	# Detaches several loop devices in parallel
+	# Returns the report of each one, from fun_loop_detach
+
+	if len(loopdev_list)==0:
+		return []
+
+	with ThreadPoolExecutor(
+			max_workers=max(1,min(max_workers,len(loopdev_list)))
+		) as pool:
+		reports=list(
+			pool.map(fun_loop_detach,loopdev_list)
+		)
+
+	for report in reports:
+		print(
+			"\nDetach:",report["device"],
+			"ok" if report["ok"] else "FAILED",
+			"(deferred)" if report["deferred"] else "",
+			f"{report['seconds']}s"
+		)
+		if report["blockers"] is not None:
+			print("Blocked by:",report["blockers"])
+
+	return reports
+
 def fun_deep_detatch(
 		filepath:Union[str,Path],
-		verbose:bool=True
+		verbose:bool=True,
+		max_workers:int=8,
+		autoclear:bool=False
 	)->bool:
 
 	# Given a path to a file, it does the following:
-	# → gets all loop devices that come from the file
-	# → for each loop device detected, unmount them completely
+	# → gets all loop devices that come from the file, all of their partitions, and the device-mapper targets stacked on them
+	# → builds the tree of everything mounted from them, in one pass
+	# → unmounts the tree from the leaves up, in parallel within each level
+	# → removes the device-mapper targets and detaches all the loop devices, in parallel
+	# If autoclear, the loop devices are marked as autoclear before anything else, so if something fails midway they still go away once the last mount is gone
+
+	return fun_deep_detatch_all(
+		[filepath],
+		verbose=verbose,
+		max_workers=max_workers,
+		autoclear=autoclear
+	)
 
-	fse_ok=util_path_to_str(filepath)
+def fun_deep_detatch_all(
+		filepaths:list,
+		verbose:bool=True,
+		max_workers:int=8,
+		autoclear:bool=False
+	)->bool:
 
-	loopdev_list=cmd_losetup_get_devices(fse_ok)
-	if len(loopdev_list)==0:
-		return True
+	# Same as fun_deep_detatch, but for several files that belong together (the members of a striped volume for example)
 
-	count=0
-	count_max=len(loopdev_list)
+	loopdev_list=[]
+	for filepath in filepaths:
+		fse_ok=util_path_to_str(filepath)
 
-	for loopdev in loopdev_list:
+		found=util_sysfs_loop_devices(fse_ok)
+		if found is None:
+			found=[]
+			for loopdev in cmd_losetup_get_devices(fse_ok):
+				if not isinstance(loopdev,Mapping):
+					continue
+				loopdev_path=loopdev.get("name")
+				if loopdev_path is None:
+					continue
+				found.append(loopdev_path)
 
-		if not isinstance(loopdev,Mapping):
-			continue
+		loopdev_list.extend(found)
 
+	if len(loopdev_list)==0:
+		return True
+
+	devices=[]
+	for loopdev_path in loopdev_list:
+		devices.append(loopdev_path)
+		devices.extend(
+			util_sysfs_partitions(loopdev_path)
+		)
+	holders=util_sysfs_holders(devices)
+	devices.extend(holders)
+
+	if verbose:
 		print(
 			"\nPerforming full detach on:",
-			loopdev
+			devices
 		)
 
-		loopdev_path=loopdev.get("name")
+	if autoclear:
+		for loopdev_path in loopdev_list:
+			if not libc_loop_set_autoclear(loopdev_path)==0:
+				print("Unable to set autoclear on:",loopdev_path)
+
+	tree=fun_build_mount_tree(devices)
+	if tree is None:
+		return fun_deep_detatch_sequential(loopdev_list)
+
+	if not fun_unmount_tree(
+			tree,
+			max_workers=max_workers
+		):
+		return False
+
+	for holder in holders:
+		holder_name=util_sysfs_dm_name(holder)
+		if holder_name is None:
+			print("Not a device-mapper target, unable to remove:",holder)
+			return False
+		if not cmd_dmsetup_remove(holder_name):
+			return False
+
+	reports=fun_loop_detach_all(
+		loopdev_list,
+		max_workers=max_workers
+	)
+
+	return all(report["ok"] for report in reports)
+
+def fun_deep_detatch_sequential(loopdev_list:list)->bool:
+
+	# Fallback for fun_deep_detatch when the mount table can not be read
+	# Unmounts and detaches each loop device one after another, through lsblk and findmnt
+
+	count=0
+	count_max=len(loopdev_list)
+
+	for loopdev_path in loopdev_list:
 
 		if not fun_unmount_all_parts(loopdev_path):
 			continue
@@ -780,16 +3848,15 @@ def fun_deep_detatch(
 
 	return (count==count_max)
 
-def fun_create_and_format_part(
+def fun_create_part(
 		filepath:Union[str,Path],
 		fs_type:str,
-		fs_label:Optional[str]=None,
 		fs_start:Optional[str]=None,
-		fs_end:Optional[str]=None,
-		conf_only:bool=False
-	)->Union[bool,Optional[str]]:
+		fs_end:Optional[str]=None
+	)->Optional[str]:
 
-	# Creates a new partition, finds it, and formats it
+	# Creates a new partition and finds it
+	# Returns the path to the partition, or None
 
 	fse_ok=util_path_to_str(filepath)
 
@@ -804,8 +3871,6 @@ def fun_create_and_format_part(
 			fs_end=fs_end,
 		):
 
-		if conf_only:
-			return False
 		return None
 
 	parts_after=cmd_lsblk_get_devices(
@@ -814,8 +3879,6 @@ def fun_create_and_format_part(
 	)
 	if not len(parts_after)==len(parts_before)+1:
 		print("Only ONE new partition should be here")
-		if conf_only:
-			return False
 		return None
 
 	parts=[]
@@ -836,12 +3899,32 @@ def fun_create_and_format_part(
 		if qq is None:
 			continue
 
-		if fse_part not in parts:
+		if qq not in parts:
 			fse_part=qq
 			break
 
 	if fse_part is None:
 		print("Partition not found")
+
+	return fse_part
+
+def fun_create_and_format_part(
+		filepath:Union[str,Path],
+		fs_type:str,
+		fs_label:Optional[str]=None,
+		fs_start:Optional[str]=None,
+		fs_end:Optional[str]=None,
+		conf_only:bool=False
+	)->Union[bool,Optional[str]]:
+
+	# Creates a new partition, finds it, and formats it
+
+	fse_part=fun_create_part(
+		filepath,fs_type,
+		fs_start=fs_start,
+		fs_end=fs_end
+	)
+	if fse_part is None:
 		if conf_only:
 			return False
 		return None
@@ -1,32 +1,155 @@
 #!/usr/bin/python3.9
 
-from secrets import token_hex
+from concurrent.futures import ThreadPoolExecutor
 
-from typing import Mapping,Optional,Union
+from functools import wraps
+
+from json import (
+	dumps as json_dumps,
+	loads as json_loads
+)
+
+from os import (
+	O_CREAT,
+	O_EXCL,
+	O_WRONLY,
+	chmod as os_chmod,
+	close as os_close,
+	open as os_open,
+	replace as os_replace,
+	truncate as os_truncate,
+	write as os_write
+)
+from os.path import realpath
+
+from secrets import token_bytes,token_hex
+
+from re import match as re_match
+
+from shutil import rmtree
+
+from tempfile import mkdtemp
+
+from select import (
+	POLLERR,
+	POLLIN,
+	POLLPRI,
+	poll as select_poll
+)
+
+from socket import (
+	AF_NETLINK,
+	AF_UNIX,
+	SOCK_DGRAM,
+	SOCK_STREAM,
+	socket
+)
+
+from socketserver import (
+	StreamRequestHandler,
+	ThreadingUnixStreamServer
+)
+
+from stat import S_ISSOCK
+
+from threading import Lock,Semaphore,Thread
+
+from time import monotonic,sleep,time
+
+from typing import BinaryIO,Callable,Mapping,Optional,Union
 
 from pathlib import Path
 
+# PyYAML is optional: when it is there, a patched mongod.conf is fully parsed before it replaces the old one
+
+try:
+	from yaml import safe_load as yaml_safe_load
+except ImportError:
+	yaml_safe_load=None
+
 from fstoolkit import (
 
 	_PARTED_LABEL_GPT,
 	_PARTED_LABEL_MBR,
 	_FSTYPE_EXT4,
+	_FSTYPE_SQUASHFS,
+	_FSTYPE_EROFS,
+	_CODEC_NONE,
+	_CODEC_ZLIB,
+	_CODEC_FILES,
+	_SPARSE_CHUNK_SIZE,
+	_SPARSE_CHUNK_SIZE_MAX,
+	_HASH_CHUNK_SIZE,
 
 	util_fixstring,
+	util_parse_size,
 	util_path_to_str,
 	util_subrun,
+	util_read_mountinfo,
+	util_sysfs_loop_devices,
+	util_sysfs_sectors,
+	util_parse_dm_cache_status,
+	util_parse_dm_snapshot_status,
+	util_lock_image,
+	util_dev_majmin,
+	util_sysfs_entry,
+	util_sysfs_partitions,
+	util_guess_fstype,
+	util_sysfs_read,
+	util_cgroup_path,
+	util_backing_majmin,
+	util_flock,
+
+	libc_fs_freeze,
 
 	cmd_mountpoint,
+	cmd_umount,
+	cmd_mksquashfs,
+	cmd_mkfs_erofs,
 	cmd_mount_path,
 	cmd_losetup_attach,
 	cmd_parted_disk_init,
 	cmd_lsblk_get_devices,
+	cmd_lsblk_get_dev_size,
 	cmd_losetup_get_devices,
 	cmd_losetup_detatch,
 	cmd_findmnt_get_filesystems,
+	cmd_mkfs_part_format,
+	cmd_dmsetup_create,
+	cmd_dmsetup_status,
+	cmd_dmsetup_table,
+	cmd_dmsetup_load,
+	cmd_dmsetup_suspend,
+	cmd_dmsetup_resume,
+	cmd_dmsetup_remove,
 
-	fun_create_and_format_part,
-	fun_deep_detatch,
+	fun_create_part,
+	fun_deep_detatch_all,
+	fun_unmount_source,
+	fun_build_mount_tree,
+	fun_unmount_tree,
+	fun_get_topology,
+	fun_hash_file,
+	fun_sparse_export,
+	fun_sparse_import,
+	fun_warm_files,
+	fun_compress_files,
+	fun_read_throughput,
+	fun_io_bench,
+	fun_cgroup_io_apply,
+	fun_cgroup_io_read,
+	cmd_tune2fs_project_quota,
+	libc_set_project,
+	libc_quota_set_project,
+	libc_quota_get_project,
+	_MBR_SECTOR_SIZE,
+	util_mbr_partitions,
+	util_mbr_resize_partition,
+	util_ext4_superblock,
+	cmd_e2fsck,
+	cmd_resize2fs,
+	cmd_resize2fs_min_blocks,
+	cmd_dumpe2fs_groups,
 )
 
 _LABEL="MongoDB Stuff"
@@ -37,6 +160,23 @@ _CMD_NEW="new"
 _CMD_MOUNT="mount"
 _CMD_SETUP="setup"
 _CMD_CLEAN="clean"
+_CMD_EXPORT="export"
+_CMD_IMPORT="import"
+_CMD_VERIFY="verify"
+_CMD_STATUS="status"
+_CMD_AGENT="agent"
+_CMD_SNAPSHOT="snapshot"
+_CMD_WARM="warm"
+_CMD_BENCH="bench"
+_CMD_IO="io"
+_CMD_TENANT="tenant"
+_CMD_SHRINK="shrink"
+_CMD_STATUS_ALL="status-all"
+_CMD_MOUNT_ALL="mount-all"
+_CMD_CLEAN_ALL="clean-all"
+_CMD_LOGS_COMPACT="logs-compact"
+_CMD_CHECK="check"
+_CMD_ARCHIVE="archive"
 
 _RET_ALL=0
 _RET_RETURNCODE=1
@@ -47,6 +187,26 @@ _DIR_MOUNT_DATA="mongo-data"
 _DIR_MOUNT_LOGS="mongo-logs"
 _DIR_DEFAULT_DATA="/var/lib/mongodb"
 _DIR_DEFAULT_LOGS="/var/log/mongodb"
+_DIR_MOUNT_INDEX="/mnt/mongodb-index"
+
+_MOUNT_OPTIONS_PART="noatime"
+_MOUNT_OPTIONS_JOURNAL="noatime,nodiratime,commit=1"
+
+# Layouts
+# → single: one partition with the data and logs directories
+# → split: a data partition (data directory) and a smaller journal partition (WiredTiger journal and logs directories), each with its own filesystem and mount options
+# The partitions of the split layout are told apart by their filesystem labels
+
+_ROLE_MAIN="main"
+_ROLE_DATA="data"
+_ROLE_JOURNAL="journal"
+
+_LABEL_DATA=_DIR_MOUNT_DATA
+_LABEL_JOURNAL=_DIR_MOUNT_LOGS
+
+# The journal partition holds an ext4 filesystem with a journal of its own, and the data partition is at least as big
+
+_JOURNAL_SIZE_MIN=16*1024*1024
 
 # TODO:
 # On reboot, the partition dissapears
@@ -55,6 +215,163 @@ _FLAG_SETUP="setup"
 _FLAG_MOUNT="mount"
 _FLAG_DESTROY="destroy"
 _FLAG_TEST="test"
+_FLAG_INCREMENTAL="incremental"
+_FLAG_EPHEMERAL="ephemeral"
+_FLAG_AUTOCLEAR="autoclear"
+_FLAG_SNAPSHOTS="snapshots"
+_FLAG_WARM="warm"
+_FLAG_CLEAR="clear"
+_FLAG_SHARED="shared"
+_FLAG_REMOVE="remove"
+_FLAG_ESTIMATE="estimate"
+
+_SIDECAR_MANIFEST="manifest"
+_SIDECAR_VOLUME="volume"
+_SIDECAR_STEPS="steps"
+
+# Creation steps of a plain image, in order
+# Each one is recorded in a journal next to the image once done, and a retry of the same creation skips the ones that still check out
+# If a step has to be done again, so do all the steps after it
+# Attaching and mounting are not checked, they are just done again if needed
+
+_STEP_ALLOCATED="allocated"
+_STEP_ATTACHED="attached"
+_STEP_PARTITIONED="partitioned"
+_STEP_FORMATTED="formatted"
+_STEP_ENCRYPTED="encrypted"
+_STEP_CACHED="cached"
+_STEP_SHARED="shared"
+_STEP_MOUNTED="mounted"
+_STEP_OWNED="owned"
+
+_DM_PREFIX="mongolical"
+
+_STRIPE_CHUNK_SIZE=512*1024
+
+_CACHE_MODE_WRITETHROUGH="writethrough"
+_CACHE_MODE_WRITEBACK="writeback"
+_CACHE_BLOCK_SECTORS=128
+
+# Snapshots
+# The filesystems must sit on device-mapper targets, so their tables can be swapped for a snapshot-origin
+# → stripe sets already do
+# → plain images get a linear target (an "origin") over each partition, if created or mounted with the snapshots flag
+# The copy-on-write data is kept in a sparse file next to the image, one per partition
+
+_SNAPSHOT_CREATE="create"
+_SNAPSHOT_MERGE="merge"
+_SNAPSHOT_DISCARD="discard"
+_SNAPSHOT_EXPORT="export"
+_SNAPSHOT_ACTIONS=(
+	_SNAPSHOT_CREATE,
+	_SNAPSHOT_MERGE,
+	_SNAPSHOT_DISCARD,
+	_SNAPSHOT_EXPORT
+)
+_SNAPSHOT_CHUNK_SECTORS=8
+_SNAPSHOT_MERGE_POLL_SECONDS=0.5
+
+# Encryption
+# dm-crypt sits between each partition of a plain image and its filesystem (and below the origins, if any)
+# The workqueues are skipped (no_read_workqueue, no_write_workqueue), so requests are encrypted and decrypted right where they are issued, without queueing
+# The sector size follows the loop device, up to 4K
+# The key is kept in a keyfile, and only the path to it goes in the volume descriptor
+
+_CRYPT_CIPHER="aes-xts-plain64"
+_CRYPT_KEY_SIZE=64
+_CRYPT_SECTOR_SIZE_MAX=4096
+_CRYPT_CHECK_SIZE=64*1024*1024
+
+# Shared volumes
+# Many small tenants share one image (a single partition) instead of getting one each
+# Each tenant gets a directory tree (data and logs) under "tenants", with a project ID of its own, and its size and inode count are capped with project quotas
+# The project quotas are only enforced with the prjquota mount option, and only ext4 is formatted here
+
+_DIR_TENANTS="tenants"
+_MOUNT_OPTIONS_SHARED="prjquota"
+_TENANT_NAME_MAX=64
+
+# Index volumes
+# With directoryForIndexes, WiredTiger keeps the indexes in an "index" directory next to a "collection" one, so the indexes can be on an image of their own (on another disk)
+# → without directoryPerDB: the data directory of the index image is bound to <dbPath>/index
+# → with directoryPerDB: each database has its own "index" directory, so the databases are listed, and <index image>/<db> is bound to <dbPath>/<db>/index
+# The index image is a regular image, mounted on its own mountpoint, and cleaned along with the image it belongs to
+# mongod.conf is patched line by line (comments and the rest of the settings stay as they are), only block style YAML is understood
+
+_MONGOD_CONF_LOG_NAME="mongod.log"
+_YAML_INDENT=2
+
+# Registry
+# Every image managed on this host is kept in one JSON file: the state it should be in (mounted, set up, or clean), where it is mounted and bound, and what it was last seen attached, mounted and bound as
+# The commands that change an image update it, and the bulk commands read it once and compare it with the live state, read in a single pass over sysfs and the mount table
+# It is only a record: the live state always wins
+
+_REGISTRY_PATH="/var/lib/mongolical/registry.json"
+_REGISTRY_LOCK="registry"
+
+_STATE_CLEAN="clean"
+_STATE_ATTACHED="attached"
+_STATE_MOUNTED="mounted"
+_STATE_SETUP="setup"
+
+# Archives
+# A detached plain image can be packed into a compressed read-only filesystem image (SquashFS or EROFS), with its data, journal and logs directories at the top
+# An archive is found by its superblock, it is attached read-only and mounted like a volume with a single partition
+# When set up, only its data (and journal) are bound: mongod has to write its logs somewhere else
+
+_FSTYPES_ARCHIVE=(_FSTYPE_SQUASHFS,_FSTYPE_EROFS)
+_MOUNT_OPTIONS_ARCHIVE="ro"
+_ARCHIVE_DIRS=("data","journal","logs")
+
+# Checks
+# Only detached images whose partitions hold the filesystems directly (plain images, with or without origins) are checked: each partition is attached read-only on its own, and checked with e2fsck -n
+# The checks run in parallel, but only a few at a time on each host disk
+# e2fsck -n can not replay the journal, so a filesystem that was not unmounted cleanly may show errors that mounting it would have fixed: that is reported along with the result
+# The result is kept in the registry, and mount-all holds back the images that need repair until a later check finds them clean
+
+_CHECK_CLEAN="clean"
+_CHECK_NEEDS_REPAIR="needs_repair"
+_CHECK_NEEDS_REPLAY="needs_replay"
+_CHECK_FAILED="failed"
+_CHECK_SKIPPED="skipped"
+_CHECK_PER_DISK=2
+_CHECK_WORKERS=8
+
+# Log compaction
+# mongod renames its log to "<name>.<timestamp>" when it rotates it (logRotate: rename), and logrotate numbers them ("<name>.1")
+# A compressed log may carry the modification time of the original too ("<name>.1.<mtime>.gz"), when the name without it was taken
+# The files changed in the last minute are left alone, they may still be written to
+# With a limit, the oldest compressed logs of each logs directory are deleted until they fit
+
+_LOGS_ROTATED=r"^.+\.log\.(\d{4}-\d{2}-\d{2}T\d{2}-\d{2}-\d{2}|\d+)(\.\d+)?$"
+_LOGS_MIN_AGE=60
+_LOGS_WORKERS=2
+
+# Shrinking
+# Only detached plain images with a single partition: the partition is attached on its own (at its offset in the image), and the partition table is edited in place
+# The headroom is free space left in the filesystem, as a fraction of its minimum size
+# The end of the image is aligned to whole MiB
+
+_SHRINK_HEADROOM=0.1
+_SHRINK_ALIGN=1024*1024
+_SHRINK_SAMPLE_SIZE=64*1024*1024
+
+# Benchmark
+# The files of the benchmark are made in a directory of their own, next to the data and the journal, and deleted afterwards
+
+_BENCH_DIR=".mongolical-bench"
+_BENCH_FILE_SIZE=256*1024*1024
+_BENCH_DURATION=30.0
+
+# Warmup
+# The WiredTiger files are read into the page cache: metadata first, then indexes, then collections, smaller ones first within each group
+
+_WT_SUFFIX=".wt"
+_WT_PREFIX_INDEX="index-"
+_WT_PREFIX_COLLECTION="collection-"
+
+_FSTYPE_TMPFS="tmpfs"
+_MOUNT_OPTIONS_TMPFS="noatime,mode=0755"
 
 _ARG_OFILE="--file"
 _ARG_MTARGET="--target"
@@ -62,6 +379,59 @@ _ARG_SIZE="--size"
 _ARG_MONGO_DATA="--path-data"
 _ARG_MONGO_LOGS="--path-logs"
 _ARG_FLAGS="--flags"
+_ARG_JOURNAL_SIZE="--journal-size"
+_ARG_STRIPE_WITH="--stripe-with"
+_ARG_CACHE_FILE="--cache-file"
+_ARG_CACHE_SIZE="--cache-size"
+_ARG_CACHE_MODE="--cache-mode"
+_ARG_STREAM="--stream"
+_ARG_COMPRESS="--compress"
+_ARG_CHUNK_SIZE="--chunk-size"
+_ARG_WORKERS="--workers"
+_ARG_ACTION="--action"
+_ARG_HOOK="--hook"
+_ARG_WARM_LIST="--warm-list"
+_ARG_IO_BUDGET="--io-budget"
+_ARG_ENCRYPT="--encrypt"
+_ARG_DURATION="--duration"
+_ARG_REPORT="--report"
+_ARG_CGROUP="--cgroup"
+_ARG_IO_MAX="--io-max"
+_ARG_IO_WEIGHT="--io-weight"
+_ARG_IO_LATENCY="--io-latency"
+_ARG_TENANT="--tenant"
+_ARG_QUOTA="--quota"
+_ARG_INODES="--inodes"
+_ARG_HEADROOM="--headroom"
+_ARG_INDEX_FILE="--index-file"
+_ARG_DATABASES="--databases"
+_ARG_MONGOD_CONF="--mongod-conf"
+_ARG_ARCHIVE="--archive"
+_ARG_LOGS_MAX="--logs-max"
+_ARG_PER_DISK="--per-disk"
+_ARG_FSTYPE="--fstype"
+
+_ARG_SOCKET="--socket"
+
+_STREAM_STDIO="-"
+
+_AGENT_SOCKET_DEFAULT="/run/mongolical.sock"
+_AGENT_REFRESH_SECONDS=30
+_AGENT_COMMANDS=(
+	_CMD_NEW,
+	_CMD_MOUNT,
+	_CMD_SETUP,
+	_CMD_CLEAN,
+	_CMD_STATUS,
+	_CMD_SNAPSHOT,
+	_CMD_TENANT
+)
+
+_NETLINK_KOBJECT_UEVENT=15
+
+# The state of the agent, when running as one: lookups go through its cached topology instead of losetup and lsblk
+
+_AGENT_SHARED={"state":None}
 
 def util_extract_pargs(command:str,args:list)->Mapping:
 
@@ -71,16 +441,32 @@ def util_extract_pargs(command:str,args:list)->Mapping:
 			_ARG_OFILE,
 			_ARG_MTARGET,
 			_ARG_SIZE,
+			_ARG_JOURNAL_SIZE,
+			_ARG_STRIPE_WITH,
+			_ARG_CHUNK_SIZE,
+			_ARG_CACHE_FILE,
+			_ARG_CACHE_SIZE,
+			_ARG_CACHE_MODE,
+			_ARG_ENCRYPT,
 			_ARG_MONGO_DATA,
 			_ARG_MONGO_LOGS,
+			_ARG_TENANT,
+			_ARG_INDEX_FILE,
+			_ARG_DATABASES,
+			_ARG_MONGOD_CONF,
 			_ARG_FLAGS
 		])
 	if command==_CMD_MOUNT:
 		args_allowed.extend([
 			_ARG_OFILE,
 			_ARG_MTARGET,
+			_ARG_ENCRYPT,
 			_ARG_MONGO_DATA,
 			_ARG_MONGO_LOGS,
+			_ARG_TENANT,
+			_ARG_INDEX_FILE,
+			_ARG_DATABASES,
+			_ARG_MONGOD_CONF,
 			_ARG_FLAGS
 		])
 	if command==_CMD_SETUP:
@@ -89,14 +475,128 @@ def util_extract_pargs(command:str,args:list)->Mapping:
 			_ARG_MTARGET,
 			_ARG_MONGO_DATA,
 			_ARG_MONGO_LOGS,
+			_ARG_TENANT,
+			_ARG_INDEX_FILE,
+			_ARG_DATABASES,
+			_ARG_MONGOD_CONF,
+			_ARG_WARM_LIST,
+			_ARG_IO_BUDGET,
+			_ARG_WORKERS,
 			_ARG_FLAGS
 		])
+	if command==_CMD_WARM:
+		args_allowed.extend([
+			_ARG_OFILE,
+			_ARG_MONGO_DATA,
+			_ARG_WARM_LIST,
+			_ARG_IO_BUDGET,
+			_ARG_WORKERS
+		])
 	if command==_CMD_CLEAN:
 		args_allowed.extend([
 			_ARG_OFILE,
 			_ARG_MTARGET,
 			_ARG_FLAGS
 		])
+	if command==_CMD_EXPORT:
+		args_allowed.extend([
+			_ARG_OFILE,
+			_ARG_STREAM,
+			_ARG_COMPRESS,
+			_ARG_CHUNK_SIZE,
+			_ARG_WORKERS
+		])
+	if command==_CMD_IMPORT:
+		args_allowed.extend([
+			_ARG_OFILE,
+			_ARG_STREAM,
+			_ARG_WORKERS
+		])
+	if command==_CMD_STATUS:
+		args_allowed.extend([
+			_ARG_OFILE
+		])
+	if command==_CMD_AGENT:
+		args_allowed.extend([
+			_ARG_SOCKET
+		])
+	if command==_CMD_SNAPSHOT:
+		args_allowed.extend([
+			_ARG_OFILE,
+			_ARG_ACTION,
+			_ARG_HOOK,
+			_ARG_STREAM,
+			_ARG_COMPRESS,
+			_ARG_WORKERS
+		])
+	if command==_CMD_IO:
+		args_allowed.extend([
+			_ARG_OFILE,
+			_ARG_CGROUP,
+			_ARG_IO_MAX,
+			_ARG_IO_WEIGHT,
+			_ARG_IO_LATENCY,
+			_ARG_FLAGS
+		])
+	if command==_CMD_TENANT:
+		args_allowed.extend([
+			_ARG_OFILE,
+			_ARG_TENANT,
+			_ARG_QUOTA,
+			_ARG_INODES,
+			_ARG_FLAGS
+		])
+	if command==_CMD_SHRINK:
+		args_allowed.extend([
+			_ARG_OFILE,
+			_ARG_SIZE,
+			_ARG_HEADROOM,
+			_ARG_FLAGS
+		])
+	if command==_CMD_LOGS_COMPACT:
+		args_allowed.extend([
+			_ARG_OFILE,
+			_ARG_MONGO_LOGS,
+			_ARG_COMPRESS,
+			_ARG_ARCHIVE,
+			_ARG_LOGS_MAX,
+			_ARG_IO_BUDGET,
+			_ARG_WORKERS
+		])
+	if command==_CMD_ARCHIVE:
+		args_allowed.extend([
+			_ARG_OFILE,
+			_ARG_ARCHIVE,
+			_ARG_FSTYPE,
+			_ARG_COMPRESS,
+			_ARG_FLAGS
+		])
+	if command==_CMD_CHECK:
+		args_allowed.extend([
+			_ARG_OFILE,
+			_ARG_PER_DISK,
+			_ARG_WORKERS,
+			_ARG_FLAGS
+		])
+	if command==_CMD_CLEAN_ALL:
+		args_allowed.extend([
+			_ARG_FLAGS
+		])
+	if command==_CMD_BENCH:
+		args_allowed.extend([
+			_ARG_OFILE,
+			_ARG_SIZE,
+			_ARG_DURATION,
+			_ARG_WORKERS,
+			_ARG_REPORT
+		])
+	if command==_CMD_VERIFY:
+		args_allowed.extend([
+			_ARG_OFILE,
+			_ARG_CHUNK_SIZE,
+			_ARG_WORKERS,
+			_ARG_FLAGS
+		])
 
 	pargs={}
 
@@ -130,7 +630,16 @@ def util_extract_flags(raw:str)->list:
 		_FLAG_TEST,
 		_FLAG_DESTROY,
 		_FLAG_MOUNT,
-		_FLAG_SETUP
+		_FLAG_SETUP,
+		_FLAG_INCREMENTAL,
+		_FLAG_EPHEMERAL,
+		_FLAG_AUTOCLEAR,
+		_FLAG_SNAPSHOTS,
+		_FLAG_WARM,
+		_FLAG_CLEAR,
+		_FLAG_SHARED,
+		_FLAG_REMOVE,
+		_FLAG_ESTIMATE
 	]
 
 	split_raw=raw.split(":")
@@ -169,290 +678,6346 @@ def util_fixpath(basedir:Path,fpath_str:str)->Path:
 		Path(fpath_str[1:])
 	)
 
-def fsutil_mount_path(
-		orig:str,
-		dest:Union[str,Path],
-		ensure_dest:bool=False,
-	)->bool:
+def util_sidecar_path(filepath:Path,kind:str)->Path:
 
-	if Path(dest).exists():
-		if cmd_mountpoint(dest):
-			return True
+	# Files that belong to an image are kept next to it, named after it
 
-	return (
-		cmd_mount_path(
-			orig,dest,
-			spec_mode="rw",
-			ensure_dest=ensure_dest
-		)
+	return filepath.with_name(
+		f"{filepath.name}.{kind}.json"
 	)
 
-def fsutil_attach_as_loopdevice(fse:str)->tuple:
+def util_read_json(filepath:Path)->Optional[Mapping]:
 
-	if not cmd_losetup_get_devices(fse,get_quantity=True)==0:
-		return (_ERR,"the file is already attached")
+	if not filepath.is_file():
+		return None
 
-	fse_ok=cmd_losetup_attach(fse,partitioned=True)
-	if fse_ok is None:
-		return (_ERR,"failed to attach as a loop device")
+	try:
+		data=json_loads(filepath.read_text())
+	except Exception as exc:
+		print("Unhandled exception:",exc)
+		return None
 
-	return tuple([fse_ok])
+	if not isinstance(data,Mapping):
+		return None
 
-def main_create(
-		filepath:Path,
-		file_size:str,
-		mountpoint:Path
-	)->Optional[str]:
+	return data
 
-	# Creates a raw disk image with an MBR partition table and a single partition
+def util_write_json(filepath:Path,data:Mapping)->bool:
 
-	filepath_str=str(filepath)
-	filepath.parent.mkdir(
-		exist_ok=True,
-		parents=True
-	)
+	# Writes to a temporary file first and then renames it, so the file is never left half written
 
-	exists=filepath.exists()
-	if exists:
-		if not filepath.is_file():
-			return "the path is already occupied and not by a file"
+	filepath_tmp=filepath.with_name(f".{filepath.name}.{token_hex(4)}")
+	try:
+		filepath_tmp.write_text(json_dumps(data,indent=1))
+		os_replace(filepath_tmp,filepath)
+	except Exception as exc:
+		print("Unhandled exception:",exc)
+		if filepath_tmp.exists():
+			filepath_tmp.unlink()
+		return False
 
-	if not exists:
-		result=util_subrun([
-			"truncate",
-			"-s",file_size,
-			filepath_str,
-		],ret_mode=_RET_RETURNCODE)
-		if not result==0:
-			return "failed to create the initial file"
+	return True
 
-	res=fsutil_attach_as_loopdevice(filepath_str)
-	if res[0]==_ERR:
-		return res[1]
-	fse_loopdev=res[0]
+def util_read_descriptor(filepath:Path)->Mapping:
 
-	if not cmd_parted_disk_init(fse_loopdev,_PARTED_LABEL_MBR):
-		return "failed to create partition table"
+	# The volume descriptor keeps the settings of an image that can not be found on the image itself (the members of a stripe set for example)
 
-	fse_part=fun_create_and_format_part(
-		fse_loopdev,
-		_FSTYPE_EXT4,
-		fs_label=_LABEL
+	data=util_read_json(
+		util_sidecar_path(filepath,_SIDECAR_VOLUME)
 	)
-	if fse_part is None:
-		return "failed to create and format partition"
+	if data is None:
+		return {}
 
-	if not fsutil_mount_path(
-			fse_part,
-			mountpoint,
-			ensure_dest=True
-		):
-		return "failed to mount the partition"
-
-	dirlist=[
-		mountpoint,
-		mountpoint.joinpath("data"),
-		mountpoint.joinpath("logs")
-	]
+	return data
 
-	ok=True
-	for dir in dirlist:
-		Path(dir).mkdir(
-			parents=True,
-			exist_ok=True
-		)
-		result=util_subrun([
-			"chown",
-				"mongodb:mongodb",
-				"-R",
-				str(dir)
-			],
-			ret_mode=_RET_RETURNCODE
-		)
-		if not result==0:
-			ok=False
-			break
+def util_update_descriptor(
+		filepath:Path,
+		changes:Mapping
+	)->bool:
 
-	if not ok:
-		return f"failed to adjust ownership for: {dir}"
+	data=dict(util_read_descriptor(filepath))
+	data.update(changes)
 
-	return None
+	return util_write_json(
+		util_sidecar_path(filepath,_SIDECAR_VOLUME),
+		data
+	)
 
-def main_mount(
+def util_steps_load(
 		filepath:Path,
-		mpoint:Path
-	)->Optional[str]:
+		params:Mapping
+	)->tuple:
 
+	# The step journal of an image being created: what it is created with, and the steps done so far
+	# A journal left by a creation with other parameters is not resumed
 
-	fse_loopdev=None
-	loop_devices=cmd_losetup_get_devices(filepath)
-	attached=len(loop_devices)==1
-	if attached:
-		print("NOTE: the file is already attached")
-		fse_loopdev=loop_devices[0].get("name")
-	if not attached:
-		res=fsutil_attach_as_loopdevice(filepath)
-		if res[0]==_ERR:
-			return res[1]
-		fse_loopdev=res[0]
+	fse_steps=util_sidecar_path(filepath,_SIDECAR_STEPS)
 
-	lst=cmd_lsblk_get_devices(fse_loopdev,exclude_itself=True)
-	if not len(lst)>0:
-		return "there are no partitions"
+	steps=util_read_json(fse_steps)
+	if steps is None:
+		return tuple([{
+			"params":dict(params),
+			"done":[],
+			"details":{},
+		}])
 
-	if not isinstance(lst[0],Mapping):
-		return util_msg_err(
-			"object not valid",
-			f"{lst[0]}"
+	if not steps["params"]==dict(params):
+		return (
+			_ERR,
+			util_msg_err(
+				"the image was being created with other parameters",
+				f"delete {fse_steps} (and the image) to start over"
+			)
 		)
 
-	fse_part=util_fixstring(lst[0].get("path"))
-	if fse_part is None:
-		return "partition not found...?"
+	return tuple([steps])
 
-	if not fsutil_mount_path(
-			fse_part,mpoint,
-			ensure_dest=True
-		):
-		return "failed to mount the partition"
+def util_steps_check(
+		steps:Optional[Mapping],
+		step:str,
+		check:Callable[[],bool]
+	)->bool:
 
-	return None
+	# True if a step was done and still checks out
+	# Otherwise the step and the ones after it are forgotten
+	# Without a journal, nothing was done
 
-def main_setup(
+	if steps is None:
+		return False
+
+	done=steps["done"]
+	if step not in done:
+		return False
+
+	if check():
+		return True
+
+	print(f"NOTE: the step '{step}' has to be done again")
+	del done[done.index(step):]
+	return False
+
+def util_steps_mark(
 		filepath:Path,
-		mongo_data:Path,
-		mongo_logs:Path
-	)->Optional[str]:
+		steps:Optional[Mapping],
+		step:str,
+		details:Optional[Mapping]=None
+	)->bool:
 
-	devices=cmd_losetup_get_devices(filepath)
-	qtty=len(devices)
-	if not qtty==1:
-		return util_msg_err(
-			"only ONE associated file is needed",
-			f"there is(are) {qtty} device(s)"
-		)
+	if steps is None:
+		return True
 
-	loopdev=devices[0].get("name")
+	if step not in steps["done"]:
+		steps["done"].append(step)
+	steps["details"].update({
+		step:dict(details or {},time=time())
+	})
 
-	parts=cmd_lsblk_get_devices(
-		loopdev,
-		inc_mountpoint=True,
-		exclude_itself=True
+	return util_write_json(
+		util_sidecar_path(filepath,_SIDECAR_STEPS),
+		steps
 	)
-	qtty=len(parts)
-	if qtty==0:
-		return "at least ONE partition should be here"
 
-	fse_mpoint=parts[0].get("mountpoint")
-	if fse_mpoint is None:
-		fse_part=parts[0].get("path")
-		fse_mpoint=Path(_DIR_MOUNT_DEFAULT)
-		if not cmd_mount_path(
-			fse_part,
-			fse_mpoint
-		):
-			return "failed to mount"
+def util_registry_read()->Mapping:
 
-	m_data=Path(fse_mpoint).joinpath("data")
-	m_logs=Path(fse_mpoint).joinpath("logs")
+	# Returns the registered images, by the real path of their files
 
-	x=[
-		(m_data,mongo_data),
-		(m_logs,mongo_logs)
-	]
+	data=util_read_json(Path(_REGISTRY_PATH))
+	if data is None:
+		return {}
 
-	msg_err:Optional[str]=None
+	return data.get("images",{})
 
-	for pair in x:
-		if not fsutil_mount_path(pair[0],pair[1]):
-			msg_err=util_msg_err(
-				"failed to mount",
-				f"orig:{pair[0]}\ndest:{[pair[1]]}"
-			)
-			break
+def util_registry_update(
+		filepath:Path,
+		changes:Optional[Mapping]
+	)->bool:
 
-	return msg_err
+	# Merges the changes into the entry of an image, creating the entry if needed
+	# With no changes (None), the image is removed from the registry
 
-def main_clean(filepath:Path)->Optional[str]:
+	registry_path=Path(_REGISTRY_PATH)
+	fse_real=realpath(str(filepath))
 
-	# Given a path to a regular file, checks for any loop devices it is linked to, and it detatches the file from them
+	with util_flock(_REGISTRY_LOCK):
+		images=dict(util_registry_read())
+		if changes is None:
+			if fse_real not in images.keys():
+				return True
+			images.pop(fse_real)
 
-	if not fun_deep_detatch(filepath):
+		else:
+			entry=dict(images.get(fse_real,{"file":fse_real}))
+			entry.update(changes)
+			entry.update({"updated":int(time())})
+			images.update({fse_real:entry})
 
-		return "failed to detatch from loopback device(s)"
+		try:
+			registry_path.parent.mkdir(
+				exist_ok=True,
+				parents=True
+			)
+		except Exception as exc:
+			print("Unable to create the registry directory:",exc)
+			return False
 
-	return None
+		return util_write_json(registry_path,{"images":images})
 
-if __name__=="__main__":
+def util_live_state(attached:bool,mounts:list)->str:
 
-	from sys import (
-		argv as sys_argv,
-		exit as sys_exit
-	)
+	# The state an image is in, going by what it is attached, mounted and bound as
 
-	if not len(sys_argv)>2:
-		print(
-			"\n- MONGOLICAL -"
-			f"\nCommands: {[_CMD_NEW,_CMD_MOUNT,_CMD_SETUP,_CMD_CLEAN]}"
-		)
-		sys_exit(0)
+	if any(not m["root"]=="/" for m in mounts):
+		return _STATE_SETUP
 
-	cmd=util_fixstring(sys_argv[1],low=True)
-	pos_args=util_extract_pargs(cmd,sys_argv[2:])
-	flags=[]
-	if pos_args.get(_ARG_FLAGS) is not None:
-		flags.extend(
-			util_extract_flags(
-				pos_args.get(_ARG_FLAGS)
-			)
-		)
+	if len(mounts)>0:
+		return _STATE_MOUNTED
 
-	filepath:Optional[Path]=None
-	basedir=Path(sys_argv[0]).parent
+	if attached:
+		return _STATE_ATTACHED
 
-	then_mount=False
+	return _STATE_CLEAN
+
+def util_dm_name(kind:str)->str:
+
+	# Names for what is stacked on an image (device-mapper targets, or the source of a tmpfs), stored in its descriptor
+
+	return f"{_DM_PREFIX}-{kind}-{token_hex(4)}"
+
+def util_stripe_table(
+		loopdevs:list,
+		chunk_size:int
+	)->Optional[str]:
+
+	# Device-mapper table for a RAID0 stripe over the given devices
+	# The length is rounded down to whole chunks of the smallest device
+
+	chunk_sectors=chunk_size//512
+
+	sizes=[]
+	for loopdev in loopdevs:
+		size=util_sysfs_sectors(loopdev)
+		if size is None:
+			return None
+		sizes.append(size)
+
+	per_device=(min(sizes)//chunk_sectors)*chunk_sectors
+	if per_device==0:
+		return None
+
+	table=f"0 {per_device*len(loopdevs)} striped {len(loopdevs)} {chunk_sectors}"
+	for loopdev in loopdevs:
+		table=f"{table} {loopdev} 0"
+
+	return table
+
+def util_cache_tables(
+		fse_origin:str,
+		fse_cache_loop:str,
+		cache:Mapping
+	)->Optional[tuple]:
+
+	# Device-mapper tables for a dm-cache target
+	# The cache image is split in two with linear targets: the metadata (4M plus 16 bytes per cache block) and the cache blocks
+	# Returns the tables of the metadata, the cache blocks and the cache itself, in that order
+
+	origin_sectors=util_sysfs_sectors(fse_origin)
+	cache_sectors=util_sysfs_sectors(fse_cache_loop)
+	if origin_sectors is None or cache_sectors is None:
+		return None
+
+	block_sectors=cache["block_sectors"]
+	nr_blocks=cache_sectors//block_sectors
+	meta_sectors=(4*1024*1024+16*nr_blocks+511)//512
+	meta_sectors=((meta_sectors+7)//8)*8
+
+	data_sectors=((cache_sectors-meta_sectors)//block_sectors)*block_sectors
+	if not data_sectors>0:
+		return None
+
+	name=cache["name"]
+	return (
+		f"0 {meta_sectors} linear {fse_cache_loop} 0",
+		f"0 {data_sectors} linear {fse_cache_loop} {meta_sectors}",
+		(
+			f"0 {origin_sectors} cache "
+			f"/dev/mapper/{name}-cmeta /dev/mapper/{name}-cdata {fse_origin} "
+			f"{block_sectors} 1 {cache['mode']} default 0"
+		)
+	)
+
+def util_image_locked(fn):
+
+	# Runs a command while holding the locks of the image it is given (its first argument)
+	# Commands on the same image wait for each other, commands on different images do not
+
+	@wraps(fn)
+	def wrapper(filepath,*args,**kwargs):
+		with util_lock_image(filepath):
+			return fn(filepath,*args,**kwargs)
+
+	return wrapper
+
+def util_volume_locked(fn):
+
+	# Same as util_image_locked, for the methods of MongoVolume
+
+	@wraps(fn)
+	def wrapper(self,*args,**kwargs):
+		with util_lock_image(self.state.filepath):
+			return fn(self,*args,**kwargs)
+
+	return wrapper
+
+def util_parse_io_max(raw:str)->Optional[Mapping]:
+
+	# "rbps=100M,wbps=50M,riops=2000,wiops=1000" (any of them) to a mapping
+	# Bandwidths take size suffixes, "max" means no limit
+
+	result={}
+	for item in raw.split(","):
+		item_ok=util_fixstring(item,low=True)
+		if item_ok is None:
+			continue
+		if not item_ok.count("=")==1:
+			return None
+		key,value=item_ok.split("=")
+		if key not in ("rbps","wbps","riops","wiops"):
+			return None
+		if value=="max":
+			result.update({key:None})
+			continue
+		if key.endswith("bps"):
+			value_ok=util_parse_size(value)
+		else:
+			value_ok=int(value) if value.isdigit() else None
+		if value_ok is None:
+			return None
+		result.update({key:value_ok})
+
+	return result
+
+def util_get_workers(pos_args:Mapping,default:int=4)->int:
+
+	value=util_fixstring(pos_args.get(_ARG_WORKERS))
+	if value is None:
+		return default
+	if not value.isdigit():
+		return default
+
+	return max(1,int(value))
+
+def fsutil_mount_path(
+		orig:str,
+		dest:Union[str,Path],
+		ensure_dest:bool=False,
+		options:Optional[str]=None,
+		fs_type:Optional[str]=None,
+	)->bool:
+
+	if Path(dest).exists():
+		if cmd_mountpoint(dest):
+			return True
+
+	return (
+		cmd_mount_path(
+			orig,dest,
+			spec_mode="rw",
+			ensure_dest=ensure_dest,
+			options=options,
+			fs_type=fs_type
+		)
+	)
+
+def fsutil_attach_as_loopdevice(
+		fse:str,
+		readonly:bool=False
+	)->tuple:
+
+	if not cmd_losetup_get_devices(fse,get_quantity=True)==0:
+		return (_ERR,"the file is already attached")
+
+	fse_ok=cmd_losetup_attach(fse,partitioned=True,readonly=readonly)
+	if fse_ok is None:
+		return (_ERR,"failed to attach as a loop device")
+
+	return tuple([fse_ok])
+
+def fsutil_attach_members(
+		members:list,
+		attach:bool=False
+	)->tuple:
+
+	# Finds the loop device of each file, attaching the ones that are not attached yet if asked to
+
+	loopdevs=[]
+	for member in members:
+		found=util_sysfs_loop_devices(member)
+		if found is None:
+			found=[
+				item.get("name")
+				for item in cmd_losetup_get_devices(member)
+				if isinstance(item,Mapping)
+			]
+
+		if len(found)==1:
+			loopdevs.append(found[0])
+			continue
+
+		if len(found)==0 and attach:
+			loopdev=cmd_losetup_attach(member)
+			if loopdev is None:
+				return (
+					_ERR,
+					util_msg_err(
+						"failed to attach as a loop device",
+						f"{member}"
+					)
+				)
+			loopdevs.append(loopdev)
+			continue
+
+		return (
+			_ERR,
+			util_msg_err(
+				"only ONE associated file is needed",
+				f"{member}: there is(are) {len(found)} device(s)"
+			)
+		)
+
+	return tuple([loopdevs])
+
+def fsutil_assemble_stripe(
+		stripe:Mapping,
+		attach:bool=False
+	)->tuple:
+
+	# Gets the device of a stripe set, assembling it from its members if needed (and asked to)
+
+	fse_dev=f"/dev/mapper/{stripe['name']}"
+	if Path(fse_dev).exists():
+		return tuple([fse_dev])
+
+	if not attach:
+		return (_ERR,"the stripe set is not assembled")
+
+	res=fsutil_attach_members(
+		stripe["members"],
+		attach=True
+	)
+	if res[0]==_ERR:
+		return res
+
+	table=util_stripe_table(res[0],stripe["chunk_size"])
+	if table is None:
+		return (_ERR,"the members of the stripe set are too small")
+
+	fse_dev=cmd_dmsetup_create(stripe["name"],table)
+	if fse_dev is None:
+		return (_ERR,"failed to assemble the stripe set")
+
+	return tuple([fse_dev])
+
+def fsutil_create_stripe(
+		filepath:Path,
+		file_size:str,
+		members:list,
+		chunk_size:int
+	)->tuple:
+
+	# Creates the member files of a stripe set (the image being the first one), stripes them and formats the result
+	# The members and the chunk size are kept in the volume descriptor, so the set can be assembled again
+
+	if not (chunk_size>0 and chunk_size%4096==0):
+		return (_ERR,"the chunk size must be a multiple of 4K")
+
+	members_ok=[filepath]
+	for member in members:
+		if member in members_ok:
+			continue
+		members_ok.append(member)
+
+	if not len(members_ok)>1:
+		return (_ERR,"a stripe set needs at least two files")
+
+	for member in members_ok:
+		msg_err=fsutil_create_file(member,file_size)
+		if msg_err is not None:
+			return (_ERR,f"{member}: {msg_err}")
+
+	stripe={
+		"members":[realpath(str(m)) for m in members_ok],
+		"chunk_size":chunk_size,
+		"name":util_dm_name("stripe"),
+	}
+	if not util_update_descriptor(filepath,{"stripe":stripe}):
+		return (_ERR,"failed to write the volume descriptor")
+
+	res=fsutil_assemble_stripe(stripe,attach=True)
+	if res[0]==_ERR:
+		return res
+	fse_dev=res[0]
+
+	stride=chunk_size//4096
+	if not cmd_mkfs_part_format(
+			fse_dev,
+			_FSTYPE_EXT4,
+			fs_label=_LABEL,
+			extra_args=[
+				"-E",f"stride={stride},stripe_width={stride*len(members_ok)}"
+			]
+		):
+		return (_ERR,"failed to format the stripe set")
+
+	return tuple([fse_dev])
+
+def fsutil_assemble_cache(
+		filepath:Path,
+		cache:Mapping,
+		attach:bool=False
+	)->tuple:
+
+	# Gets the dm-cache device of an image, assembling it if needed (and asked to)
+	# The partition of the image is the origin, and the cache image on the fast storage holds the metadata and the cache blocks
+
+	fse_dev=f"/dev/mapper/{cache['name']}"
+	if Path(fse_dev).exists():
+		return tuple([fse_dev])
+
+	if not attach:
+		return (_ERR,"the cache is not assembled")
+
+	res=fsutil_find_loopdevice(filepath,attach=True)
+	if res[0]==_ERR:
+		return res
+
+	res=fsutil_find_partitions(res[0])
+	if res[0]==_ERR:
+		return res
+	fse_origin=res[0][0]["path"]
+
+	res=fsutil_attach_members(
+		[cache["file"]],
+		attach=True
+	)
+	if res[0]==_ERR:
+		return res
+
+	tables=util_cache_tables(fse_origin,res[0][0],cache)
+	if tables is None:
+		return (_ERR,"the cache image is too small")
+
+	names=(
+		f"{cache['name']}-cmeta",
+		f"{cache['name']}-cdata",
+		cache["name"]
+	)
+	for name,table in zip(names,tables):
+		if Path(f"/dev/mapper/{name}").exists():
+			continue
+		if cmd_dmsetup_create(name,table) is None:
+			return (_ERR,f"failed to create: {name}")
+
+	return tuple([fse_dev])
+
+def fsutil_create_cache(
+		filepath:Path,
+		cache_file:Path,
+		cache_size:str,
+		cache_mode:str
+	)->tuple:
+
+	# Creates the cache image and puts the cache in front of the (already formatted) partition of the image
+	# The cache settings are kept in the volume descriptor, so the cache can be assembled again
+
+	if cache_mode not in (_CACHE_MODE_WRITETHROUGH,_CACHE_MODE_WRITEBACK):
+		return (_ERR,f"unknown cache mode: {cache_mode}")
+
+	if cache_file.exists():
+		return (_ERR,"the cache file already exists")
+
+	msg_err=fsutil_create_file(cache_file,cache_size)
+	if msg_err is not None:
+		return (_ERR,f"{cache_file}: {msg_err}")
+
+	cache={
+		"file":realpath(str(cache_file)),
+		"mode":cache_mode,
+		"block_sectors":_CACHE_BLOCK_SECTORS,
+		"name":util_dm_name("cache"),
+	}
+	if not util_update_descriptor(filepath,{"cache":cache}):
+		return (_ERR,"failed to write the volume descriptor")
+
+	return fsutil_assemble_cache(filepath,cache,attach=True)
+
+def fsutil_create_ephemeral(
+		filepath:Path,
+		size:str
+	)->tuple:
+
+	# An ephemeral volume lives in memory (tmpfs) with a size cap, and there is no image: the file given is only a name for it
+	# Only the volume descriptor is written, and the tmpfs is told apart from others by its source name
+
+	size_ok=util_parse_size(size)
+	if size_ok is None:
+		return (_ERR,f"invalid size: {size}")
+
+	if filepath.exists():
+		return (_ERR,"the path is already occupied")
+
+	if util_read_descriptor(filepath).get("ephemeral") is not None:
+		return (_ERR,"the ephemeral volume already exists")
+
+	filepath.parent.mkdir(
+		exist_ok=True,
+		parents=True
+	)
+
+	ephemeral={
+		"name":util_dm_name(_FSTYPE_TMPFS),
+		"size":size_ok,
+	}
+	if not util_update_descriptor(filepath,{"ephemeral":ephemeral}):
+		return (_ERR,"failed to write the volume descriptor")
+
+	return tuple([ephemeral["name"]])
+
+def fsutil_ephemeral_partitions(ephemeral:Mapping)->tuple:
+
+	# The tmpfs of an ephemeral volume, as if it was a partition, and where it is mounted (or None)
+
+	mounts=util_read_mountinfo()
+	if mounts is None:
+		return (_ERR,"unable to read the mount table")
+
+	fse_mpoint:Optional[str]=None
+	for m in mounts:
+		if not (m["source"]==ephemeral["name"] and m["fstype"]==_FSTYPE_TMPFS):
+			continue
+		if not m["root"]=="/":
+			continue
+		fse_mpoint=m["target"]
+		break
+
+	return tuple([[
+		{
+			"role":_ROLE_MAIN,
+			"path":ephemeral["name"],
+			"mountpoint":fse_mpoint,
+			"subdir":None,
+			"options":f"size={ephemeral['size']},{_MOUNT_OPTIONS_TMPFS}",
+			"fstype":_FSTYPE_TMPFS,
+		}
+	]])
+
+def util_crypt_sector_size(fse_loopdev:str)->int:
+
+	# The largest block size the loop device reports (the physical one follows the backing storage), up to 4K
+
+	entry=util_sysfs_entry(fse_loopdev)
+	size=512
+	for name in ("queue/logical_block_size","queue/physical_block_size"):
+		value=util_sysfs_read(entry,name)
+		if value is None or not value.isdigit():
+			continue
+		size=max(size,int(value))
+
+	return min(size,_CRYPT_SECTOR_SIZE_MAX)
+
+def util_crypt_table(
+		fse_part:str,
+		key:bytes,
+		crypt:Mapping
+	)->Optional[str]:
+
+	# Device-mapper table for dm-crypt over a partition
+	# The length is rounded down to whole crypt sectors
+
+	sectors=util_sysfs_sectors(fse_part)
+	if sectors is None:
+		return None
+
+	per_sector=crypt["sector_size"]//512
+	sectors=(sectors//per_sector)*per_sector
+	if sectors==0:
+		return None
+
+	return (
+		f"0 {sectors} crypt {crypt['cipher']} {key.hex()} 0 {fse_part} 0 "
+		f"3 no_read_workqueue no_write_workqueue sector_size:{crypt['sector_size']}"
+	)
+
+def fsutil_create_keyfile(keyfile:Path)->Optional[str]:
+
+	# A new random key, readable by root only
+
+	keyfile.parent.mkdir(
+		exist_ok=True,
+		parents=True
+	)
+
+	try:
+		fd=os_open(str(keyfile),O_WRONLY|O_CREAT|O_EXCL,0o600)
+	except Exception as exc:
+		return f"failed to create the keyfile: {exc}"
+
+	try:
+		os_write(fd,token_bytes(_CRYPT_KEY_SIZE))
+	finally:
+		os_close(fd)
+
+	return None
+
+def fsutil_crypt_partitions(
+		crypt:Mapping,
+		fse_loopdev:str
+	)->tuple:
+
+	# The partitions of an encrypted image, as seen through dm-crypt, opening the ones that are not open yet
+	# The labels are encrypted too, so the role of each partition comes from the volume descriptor, in partition order
+
+	parts=util_sysfs_partitions(fse_loopdev)
+	if not len(parts)==len(crypt["roles"]):
+		return (
+			_ERR,
+			util_msg_err(
+				"the partitions do not match the volume descriptor",
+				f"found: {parts}\nexpected: {crypt['roles']}"
+			)
+		)
+
+	mounts=util_read_mountinfo()
+	if mounts is None:
+		return (_ERR,"unable to read the mount table")
+
+	key:Optional[bytes]=None
+
+	result=[]
+	for fse_part,role in zip(parts,crypt["roles"]):
+		name=crypt["names"][role]
+		fse_dev=f"/dev/mapper/{name}"
+		if not Path(fse_dev).exists():
+			if key is None:
+				try:
+					key=Path(crypt["keyfile"]).read_bytes()
+				except Exception as exc:
+					return (_ERR,f"failed to read the keyfile: {exc}")
+				if not len(key)==_CRYPT_KEY_SIZE:
+					return (_ERR,"the keyfile does not hold a valid key")
+
+			table=util_crypt_table(fse_part,key,crypt)
+			if table is None:
+				return (_ERR,f"the partition is too small: {fse_part}")
+			if cmd_dmsetup_create(name,table,print_table=False) is None:
+				return (_ERR,f"failed to open: {fse_part}")
+
+		result.append(
+			util_partition_entry(
+				role,
+				fse_dev,
+				util_mounted_at(fse_dev,mounts)
+			)
+		)
+
+	return tuple([result])
+
+def fsutil_create_crypt(
+		filepath:Path,
+		fse_loopdev:str,
+		keyfile:Path
+	)->Optional[str]:
+
+	# Puts dm-crypt between the (already formatted) partitions of a plain image and their filesystems, and formats them again
+	# If the keyfile does not exist, a new key is made
+
+	desc=util_read_descriptor(filepath)
+	for kind in ("stripe","cache","ephemeral"):
+		if desc.get(kind) is not None:
+			return "only plain images can be encrypted"
+
+	res=fsutil_find_partitions(fse_loopdev)
+	if res[0]==_ERR:
+		return res[1]
+
+	roles_by_path={}
+	for part in res[0]:
+		roles_by_path.update({part["path"]:part["role"]})
+
+	roles=[]
+	for fse_part in util_sysfs_partitions(fse_loopdev):
+		if fse_part not in roles_by_path.keys():
+			return f"unknown partition: {fse_part}"
+		roles.append(roles_by_path[fse_part])
+
+	if not keyfile.exists():
+		msg_err=fsutil_create_keyfile(keyfile)
+		if msg_err is not None:
+			return msg_err
+
+	crypt={
+		"keyfile":realpath(str(keyfile)),
+		"cipher":_CRYPT_CIPHER,
+		"sector_size":util_crypt_sector_size(fse_loopdev),
+		"roles":roles,
+		"names":{
+			role:util_dm_name("crypt")
+			for role in roles
+		},
+	}
+	if not util_update_descriptor(filepath,{"crypt":crypt}):
+		return "failed to write the volume descriptor"
+
+	res=fsutil_crypt_partitions(crypt,fse_loopdev)
+	if res[0]==_ERR:
+		return res[1]
+
+	for part in res[0]:
+		if not cmd_mkfs_part_format(
+				part["path"],
+				_FSTYPE_EXT4,
+				fs_label=util_label_for_role(part["role"]),
+				extra_args=["-b","4096"]
+			):
+			return f"failed to format: {part['path']}"
+
+	return None
+
+def fsutil_crypt_check(
+		filepath:Path,
+		fse_loopdev:str
+	)->Optional[Mapping]:
+
+	# Built-in throughput check: the start of each partition is read with and without dm-crypt, and the overhead is reported
+
+	crypt=util_read_descriptor(filepath).get("crypt")
+	if crypt is None:
+		return None
+
+	report={}
+	for fse_part,role in zip(util_sysfs_partitions(fse_loopdev),crypt["roles"]):
+		raw=fun_read_throughput(fse_part,_CRYPT_CHECK_SIZE)
+		encrypted=fun_read_throughput(
+			f"/dev/mapper/{crypt['names'][role]}",
+			_CRYPT_CHECK_SIZE
+		)
+		overhead=None
+		if raw is not None and encrypted is not None and raw>0:
+			overhead=round((1-encrypted/raw)*100,2)
+		report.update({
+			role:{
+				"raw_bytes_per_second":None if raw is None else int(raw),
+				"crypt_bytes_per_second":None if encrypted is None else int(encrypted),
+				"overhead_percent":overhead,
+			}
+		})
+
+	print("\nEncryption overhead:",report)
+
+	return report
+
+def fsutil_set_keyfile(
+		filepath:Path,
+		keyfile:Path
+	)->Optional[str]:
+
+	crypt=util_read_descriptor(filepath).get("crypt")
+	if crypt is None:
+		return "the volume is not encrypted"
+
+	if not keyfile.is_file():
+		return "the keyfile does not exist"
+
+	crypt_ok=dict(crypt)
+	crypt_ok.update({"keyfile":realpath(str(keyfile))})
+	if not util_update_descriptor(filepath,{"crypt":crypt_ok}):
+		return "failed to write the volume descriptor"
+
+	return None
+
+def fsutil_plain_partitions(
+		desc:Mapping,
+		fse_loopdev:str
+	)->tuple:
+
+	# The partitions of a plain image, through dm-crypt if it is encrypted
+
+	crypt=desc.get("crypt")
+	if crypt is not None:
+		return fsutil_crypt_partitions(crypt,fse_loopdev)
+
+	return fsutil_find_partitions(fse_loopdev)
+
+def fsutil_enable_origins(
+		filepath:Path,
+		fse_dev:str
+	)->Optional[str]:
+
+	# Makes a plain image ready for snapshots: from now on, its partitions are mounted through linear targets (origins)
+	# Stripe sets are device-mapper targets already
+
+	desc=util_read_descriptor(filepath)
+
+	if desc.get("origins") is not None:
+		return None
+	if desc.get("stripe") is not None:
+		return None
+	if desc.get("ephemeral") is not None:
+		return "an ephemeral volume can not have snapshots"
+	if desc.get("cache") is not None:
+		return "a cached volume can not have snapshots"
+
+	res=fsutil_plain_partitions(desc,fse_dev)
+	if res[0]==_ERR:
+		return res[1]
+
+	origins={}
+	for part in res[0]:
+		if part["mountpoint"] is not None:
+			return "the volume is mounted without snapshot support, run the clean command first"
+		origins.update({
+			part["role"]:util_dm_name("origin")
+		})
+
+	if not util_update_descriptor(filepath,{"origins":origins}):
+		return "failed to write the volume descriptor"
+
+	return None
+
+def fsutil_origin_partitions(
+		origins:Mapping,
+		partitions:list
+	)->tuple:
+
+	# The partitions of a plain image, as seen through their origins, creating the origins that are missing
+
+	mounts=util_read_mountinfo()
+	if mounts is None:
+		return (_ERR,"unable to read the mount table")
+
+	result=[]
+	for part in partitions:
+		name=origins.get(part["role"])
+		if name is None:
+			return (_ERR,f"there is no origin for the partition: {part['role']}")
+
+		fse_dev=f"/dev/mapper/{name}"
+		if not Path(fse_dev).exists():
+			sectors=util_sysfs_sectors(part["path"])
+			if sectors is None:
+				return (_ERR,f"unable to get the size of: {part['path']}")
+			if cmd_dmsetup_create(name,f"0 {sectors} linear {part['path']} 0") is None:
+				return (_ERR,f"failed to create: {name}")
+
+		part_ok=dict(part)
+		part_ok.update({
+			"path":fse_dev,
+			"mountpoint":util_mounted_at(fse_dev,mounts),
+		})
+		result.append(part_ok)
+
+	return tuple([result])
+
+def fsutil_archive_fstype(filepath:Path)->Optional[str]:
+
+	# The filesystem type of an archive (see main_archive), or None if the image is not one
+
+	if not filepath.is_file():
+		return None
+
+	fstype=util_guess_fstype(filepath)
+	if fstype not in _FSTYPES_ARCHIVE:
+		return None
+
+	return fstype
+
+def fsutil_volume_files(filepath:Path)->list:
+
+	# All the files an image is made of
+
+	desc=util_read_descriptor(filepath)
+
+	if desc.get("ephemeral") is not None:
+		return []
+
+	stripe=desc.get("stripe")
+	if stripe is not None:
+		return [Path(m) for m in stripe["members"]]
+
+	cache=desc.get("cache")
+	if cache is not None:
+		return [filepath,Path(cache["file"])]
+
+	return [filepath]
+
+def fsutil_volume_device(
+		filepath:Path,
+		attach:bool=False
+	)->tuple:
+
+	# Gets the device the volume sits on: the loop device of the image, or the device of its stripe set or its cache
+	# For an ephemeral volume, this is the source name of its tmpfs
+
+	desc=util_read_descriptor(filepath)
+
+	ephemeral=desc.get("ephemeral")
+	if ephemeral is not None:
+		return tuple([ephemeral["name"]])
+
+	stripe=desc.get("stripe")
+	if stripe is not None:
+		return fsutil_assemble_stripe(stripe,attach=attach)
+
+	cache=desc.get("cache")
+	if cache is not None:
+		return fsutil_assemble_cache(filepath,cache,attach=attach)
+
+	if fsutil_archive_fstype(filepath) is not None:
+		return fsutil_find_loopdevice(filepath,attach=attach,readonly=True)
+
+	return fsutil_find_loopdevice(filepath,attach=attach)
+
+def fsutil_volume_partitions(
+		filepath:Path,
+		fse_dev:str
+	)->tuple:
+
+	# Same as fsutil_find_partitions, but stripe sets and cached volumes are device-mapper targets: the filesystem is on the device itself
+
+	desc=util_read_descriptor(filepath)
+
+	ephemeral=desc.get("ephemeral")
+	if ephemeral is not None:
+		return fsutil_ephemeral_partitions(ephemeral)
+
+	fstype=None
+	if desc.get("stripe") is None and desc.get("cache") is None:
+		fstype=fsutil_archive_fstype(filepath)
+
+	if fstype is None and desc.get("stripe") is None and desc.get("cache") is None:
+		res=fsutil_plain_partitions(desc,fse_dev)
+		if res[0]==_ERR:
+			return res
+		if desc.get("origins") is not None:
+			res=fsutil_origin_partitions(desc["origins"],res[0])
+			if res[0]==_ERR:
+				return res
+		return util_shared_partitions(desc,res[0])
+
+	lst=cmd_lsblk_get_devices(fse_dev,inc_mountpoint=True)
+	if not len(lst)>0:
+		return (_ERR,"the device-mapper target is gone")
+
+	# An archive has no partitions either, the filesystem is on the loop device
+
+	if fstype is not None:
+		return tuple([[
+			{
+				"role":_ROLE_MAIN,
+				"path":fse_dev,
+				"mountpoint":util_fixstring(lst[0].get("mountpoint")),
+				"subdir":None,
+				"options":_MOUNT_OPTIONS_ARCHIVE,
+				"fstype":fstype,
+			}
+		]])
+
+	return util_shared_partitions(
+		desc,
+		[
+			{
+				"role":_ROLE_MAIN,
+				"path":fse_dev,
+				"mountpoint":util_fixstring(lst[0].get("mountpoint")),
+				"subdir":None,
+				"options":_MOUNT_OPTIONS_PART,
+			}
+		]
+	)
+
+def util_shared_partitions(
+		desc:Mapping,
+		partitions:list
+	)->tuple:
+
+	# The partition of a shared volume is mounted with project quotas enforced
+
+	if desc.get("shared") is not None:
+		for part in partitions:
+			part.update({
+				"options":f"{part['options']},{_MOUNT_OPTIONS_SHARED}"
+			})
+
+	return tuple([partitions])
+
+def util_tenant_name(name:Optional[str])->Optional[str]:
+
+	# Tenant names are used as directory names: letters, digits, "-" and "_"
+
+	name_ok=util_fixstring(name,low=True)
+	if name_ok is None:
+		return None
+	if len(name_ok)>_TENANT_NAME_MAX:
+		return None
+	if not all(c.isalnum() or c in "-_" for c in name_ok):
+		return None
+
+	return name_ok
+
+def fsutil_enable_shared(
+		filepath:Path,
+		partitions:list
+	)->Optional[str]:
+
+	# Turns on project quotas on the filesystem of a new volume (not mounted yet), and marks it as shared in its descriptor
+
+	if not len(partitions)==1:
+		return "a shared volume can not have a separate journal partition"
+
+	part=partitions[0]
+	if part.get("fstype")==_FSTYPE_TMPFS:
+		return "an ephemeral volume can not be shared"
+	if part["mountpoint"] is not None:
+		return "the filesystem is already mounted"
+
+	if not cmd_tune2fs_project_quota(part["path"]):
+		return "failed to turn on project quotas"
+
+	if not util_update_descriptor(filepath,{"shared":{"tenants":{}}}):
+		return "failed to write the volume descriptor"
+
+	util_shared_partitions({"shared":True},partitions)
+
+	return None
+
+def fsutil_shared_root(filepath:Path)->tuple:
+
+	# The partition of a mounted shared volume, and the directory the tenants are in
+
+	if util_read_descriptor(filepath).get("shared") is None:
+		return (_ERR,"the volume is not shared")
+
+	res=fsutil_volume_device(filepath)
+	if res[0]==_ERR:
+		return res
+
+	res=fsutil_volume_partitions(filepath,res[0])
+	if res[0]==_ERR:
+		return res
+
+	part=res[0][0]
+	if part["mountpoint"] is None:
+		return (_ERR,"the volume is not mounted")
+
+	return (
+		part["path"],
+		Path(part["mountpoint"]).joinpath(_DIR_TENANTS)
+	)
+
+def fsutil_tenant_binds(
+		fse_part:str,
+		name:str
+	)->list:
+
+	# Where the directories of a tenant are bound
+
+	majmin=util_dev_majmin(fse_part)
+	root=f"/{_DIR_TENANTS}/{name}"
+
+	targets=[]
+	for m in (util_read_mountinfo() or []):
+		if not m["majmin"]==majmin:
+			continue
+		if m["root"]==root or m["root"].startswith(f"{root}/"):
+			targets.append(m["target"])
+
+	return targets
+
+def fsutil_tenant_pairs(
+		filepath:Path,
+		partitions:list,
+		mongo_data:Path,
+		mongo_logs:Path,
+		tenant:Optional[str]=None
+	)->tuple:
+
+	# Same as fsutil_bind_pairs, but a shared volume needs a tenant, and the directories of that tenant are bound instead
+
+	shared=util_read_descriptor(filepath).get("shared")
+	if shared is None:
+		if tenant is not None:
+			return (_ERR,"the volume is not shared")
+		return tuple([
+			fsutil_bind_pairs(partitions,mongo_data,mongo_logs)
+		])
+
+	if tenant is None:
+		return (_ERR,"the volume is shared, the tenant is missing")
+
+	name_ok=util_tenant_name(tenant)
+	if name_ok not in shared["tenants"].keys():
+		return (_ERR,f"the tenant does not exist: {tenant}")
+
+	dir_tenant=Path(partitions[0]["mountpoint"]).joinpath(_DIR_TENANTS,name_ok)
+
+	return tuple([[
+		(dir_tenant.joinpath("data"),mongo_data),
+		(dir_tenant.joinpath("logs"),mongo_logs)
+	]])
+
+def util_yaml_key(line:str)->Optional[tuple]:
+
+	# The indentation, key and value of a "key: value" line, or None for anything else (comments, lists, blank lines)
+
+	found=re_match(r"^( *)([A-Za-z0-9_.]+):(?:\s+(.*))?$",line.rstrip("\n"))
+	if found is None:
+		return None
+
+	return (
+		len(found.group(1)),
+		found.group(2),
+		util_fixstring(found.group(3))
+	)
+
+def util_yaml_find(
+		lines:list,
+		keypath:tuple
+	)->Mapping:
+
+	# Finds where each parent of a key (and the key itself) is in a block style YAML document
+	# Returns the found paths, each with the index of its line, its indentation, and the index of the last line of its block
+
+	found={}
+	stack=[]
+	for idx,line in enumerate(lines):
+		parsed=util_yaml_key(line)
+		if parsed is None:
+			continue
+
+		indent,key,_=parsed
+		while len(stack)>0 and stack[-1][0]>=indent:
+			stack.pop()
+		stack.append((indent,key))
+
+		path=tuple(k for _,k in stack)
+		if path==keypath[:len(path)]:
+			found.update({
+				path:{
+					"line":idx,
+					"indent":indent,
+				}
+			})
+
+	# A block goes on until a line (not blank, not a comment) that is not indented deeper
+
+	for entry in found.values():
+		end=entry["line"]
+		for idx in range(entry["line"]+1,len(lines)):
+			line=lines[idx]
+			if len(line.strip())==0 or line.lstrip().startswith("#"):
+				continue
+			if not len(line)-len(line.lstrip(" "))>entry["indent"]:
+				break
+			end=idx
+		entry.update({"end":end})
+
+	return found
+
+def util_yaml_get(
+		lines:list,
+		keypath:tuple
+	)->Optional[str]:
+
+	found=util_yaml_find(lines,keypath)
+	if keypath not in found.keys():
+		return None
+
+	return util_yaml_key(lines[found[keypath]["line"]])[2]
+
+def util_yaml_step(lines:list)->int:
+
+	# How deep the document indents a child under its parent (the first indented key tells), or the default for a flat document
+
+	for line in lines:
+		parsed=util_yaml_key(line)
+		if parsed is None:
+			continue
+		if parsed[0]>0:
+			return parsed[0]
+
+	return _YAML_INDENT
+
+def util_yaml_child_indent(
+		lines:list,
+		parent:Mapping
+	)->Optional[int]:
+
+	# The indentation of the first child of a found key, or None if its block is empty
+
+	for idx in range(parent["line"]+1,parent["end"]+1):
+		parsed=util_yaml_key(lines[idx])
+		if parsed is None:
+			continue
+		if parsed[0]>parent["indent"]:
+			return parsed[0]
+
+	return None
+
+def util_yaml_check(lines:list)->Optional[str]:
+
+	# Checks that a patched document still parses
+	# With PyYAML the whole document is loaded, without it every key has to line up with a sibling or open a new level under a parent
+
+	if yaml_safe_load is not None:
+		try:
+			yaml_safe_load("".join(lines))
+		except Exception as exc:
+			return f"{exc}"
+
+		return None
+
+	stack=[0]
+	opens=False
+	for idx,line in enumerate(lines):
+		parsed=util_yaml_key(line)
+		if parsed is None:
+			continue
+
+		indent,key,value=parsed
+		if opens and indent>stack[-1]:
+			stack.append(indent)
+		else:
+			while indent<stack[-1]:
+				stack.pop()
+			if not indent==stack[-1]:
+				return f"line {idx+1}: bad indentation of {key}"
+
+		opens=(value is None)
+
+	return None
+
+def util_yaml_set(
+		lines:list,
+		keypath:tuple,
+		value:str
+	)->list:
+
+	# Sets a scalar in a block style YAML document (like mongod.conf), everything else stays as it is
+	# Missing parents are added at the end of the closest parent that is there (or at the end of the document)
+	# New keys are indented like the children already under that parent, and deeper levels follow the indentation of the document
+
+	result=list(lines)
+	found=util_yaml_find(result,keypath)
+
+	if keypath in found.keys():
+		idx=found[keypath]["line"]
+		indent=found[keypath]["indent"]
+		result[idx]=f"{' '*indent}{keypath[-1]}: {value}\n"
+		return result
+
+	depth=0
+	while keypath[:depth+1] in found.keys():
+		depth=depth+1
+
+	step=util_yaml_step(result)
+	insert_at=len(result)
+	indent=0
+	if depth>0:
+		parent=found[keypath[:depth]]
+		insert_at=parent["end"]+1
+		indent=util_yaml_child_indent(result,parent)
+		if indent is None:
+			indent=parent["indent"]+step
+		else:
+			step=indent-parent["indent"]
+
+	if insert_at==len(result) and len(result)>0 and not result[-1].endswith("\n"):
+		result[-1]=f"{result[-1]}\n"
+
+	added=[]
+	for key in keypath[depth:-1]:
+		added.append(f"{' '*indent}{key}:\n")
+		indent=indent+step
+	added.append(f"{' '*indent}{keypath[-1]}: {value}\n")
+
+	return result[:insert_at]+added+result[insert_at:]
+
+def fsutil_mongod_conf(
+		conf_path:Path,
+		mongo_data:Path,
+		mongo_logs:Path,
+		directory_per_db:bool=False
+	)->Optional[str]:
+
+	# Points mongod.conf at the bound directories, with indexes in their own directory (creates the file if it is not there)
+	# The name of the log file is kept, only its directory changes
+	# The change is refused if the data directory already holds collections in the flat layout, or if directoryPerDB would change on a data directory with WiredTiger files: mongod can not switch layouts on existing data
+
+	lines=[]
+	if conf_path.exists():
+		try:
+			lines=conf_path.read_text().splitlines(keepends=True)
+		except Exception as exc:
+			return util_msg_err(
+				"failed to read",
+				f"{conf_path}: {exc}"
+			)
+
+	keypath_indexes=("storage","wiredTiger","engineConfig","directoryForIndexes")
+	if not util_yaml_get(lines,keypath_indexes)=="true":
+		flat=list(mongo_data.glob(f"{_WT_PREFIX_COLLECTION}*{_WT_SUFFIX}"))
+		if len(flat)>0:
+			return util_msg_err(
+				"the data directory already has collections without directoryForIndexes",
+				f"{mongo_data}: {len(flat)} file(s)"
+			)
+
+	per_db_now=(util_fixstring(util_yaml_get(lines,("storage","directoryPerDB")),low=True) or "false")
+	per_db_new="true" if directory_per_db else "false"
+	if not per_db_now==per_db_new:
+		existing=next(mongo_data.rglob(f"*{_WT_SUFFIX}"),None)
+		if existing is not None:
+			return util_msg_err(
+				f"the data directory already has WiredTiger files, directoryPerDB can not change from {per_db_now} to {per_db_new}",
+				f"{existing}"
+			)
+
+	log_name=_MONGOD_CONF_LOG_NAME
+	log_path=util_yaml_get(lines,("systemLog","path"))
+	if log_path is not None:
+		log_name=Path(log_path.strip("\"'")).name
+
+	if len(lines)==0:
+		lines.append("# mongod.conf (written by mongolical)\n")
+
+	for keypath,value in (
+			(("storage","dbPath"),json_dumps(str(mongo_data))),
+			(("storage","directoryPerDB"),per_db_new),
+			(keypath_indexes,"true"),
+			(("systemLog","destination"),"file"),
+			(("systemLog","path"),json_dumps(str(mongo_logs.joinpath(log_name)))),
+		):
+		lines=util_yaml_set(lines,keypath,value)
+
+	bad=util_yaml_check(lines)
+	if bad is not None:
+		return util_msg_err(
+			"the patched file does not parse, it was left as it was",
+			f"{conf_path}: {bad}"
+		)
+
+	conf_tmp=conf_path.with_name(f".{conf_path.name}.tmp")
+	try:
+		conf_path.parent.mkdir(parents=True,exist_ok=True)
+		conf_tmp.write_text("".join(lines))
+		os_replace(conf_tmp,conf_path)
+	except Exception as exc:
+		return util_msg_err(
+			"failed to write",
+			f"{conf_path}: {exc}"
+		)
+
+	return None
+
+def fsutil_index_pairs(
+		filepath:Path,
+		mongo_data:Path,
+		index_file:Optional[Path]=None,
+		databases:Optional[list]=None
+	)->tuple:
+
+	# Mounts the index image of an image (the one given, or the one remembered) and gets what to bind from it
+	# The index image is remembered in the volume descriptor, with a mountpoint of its own under _DIR_MOUNT_INDEX (several volumes can have index images at the same time)
+
+	index=util_read_descriptor(filepath).get("index")
+	if index_file is not None:
+		mountpoint=None
+		if index is not None and index["file"]==str(index_file):
+			mountpoint=index.get("mountpoint")
+		index={
+			"file":str(index_file),
+			"databases":databases,
+			"mountpoint":mountpoint,
+		}
+
+	if index is None:
+		return tuple([[]])
+
+	changed=(index_file is not None)
+	if index.get("mountpoint") is None:
+		index.update({
+			"mountpoint":str(
+				Path(_DIR_MOUNT_INDEX).joinpath(
+					f"{Path(index['file']).name}-{token_hex(4)}"
+				)
+			)
+		})
+		changed=True
+
+	if changed:
+		if not util_update_descriptor(filepath,{"index":index}):
+			return (_ERR,"failed to write the volume descriptor")
+
+	for db in (index["databases"] or []):
+		if "/" in db or db in (".",".."):
+			return (_ERR,f"invalid database name: {db}")
+
+	index_path=Path(index["file"])
+	if realpath(str(index_path))==realpath(str(filepath)):
+		return (_ERR,"an image can not be its own index image")
+
+	msg_err=main_mount(index_path,Path(index["mountpoint"]))
+	if msg_err is not None:
+		return (_ERR,util_msg_err("failed to mount the index image",msg_err))
+
+	res=fsutil_volume_device(index_path)
+	if res[0]==_ERR:
+		return res
+	res=fsutil_volume_partitions(index_path,res[0])
+	if res[0]==_ERR:
+		return res
+
+	# The data directory of the index image, whatever its layout
+
+	dir_index=fsutil_bind_pairs(res[0],mongo_data,mongo_data)[0][0]
+
+	if index["databases"] is None:
+		msg_err=fsutil_prepare_dirs(mongo_data.joinpath("index"),subdirs=())
+		if msg_err is not None:
+			return (_ERR,msg_err)
+		return tuple([[
+			(dir_index,mongo_data.joinpath("index"))
+		]])
+
+	msg_err=fsutil_prepare_dirs(dir_index,subdirs=tuple(index["databases"]))
+	if msg_err is not None:
+		return (_ERR,msg_err)
+
+	pairs=[]
+	for db in index["databases"]:
+		msg_err=fsutil_prepare_dirs(mongo_data.joinpath(db),subdirs=("index",))
+		if msg_err is not None:
+			return (_ERR,msg_err)
+		pairs.append(
+			(dir_index.joinpath(db),mongo_data.joinpath(db,"index"))
+		)
+
+	return tuple([pairs])
+
+def fsutil_device_alive(
+		fse_dev:str,
+		filepath:Path
+	)->bool:
+
+	# Ephemeral volumes have no device that can go away
+
+	if not fse_dev.startswith("/dev/"):
+		return True
+
+	if fse_dev.startswith("/dev/mapper/"):
+		return Path(fse_dev).exists()
+
+	return fsutil_loopdevice_backs(fse_dev,filepath)
+
+def fsutil_loopdevice_backs(
+		loopdev:str,
+		filepath:Path
+	)->bool:
+
+	# Checks that a loop device is still attached to the given file, by reading sysfs only
+
+	backfile=Path("/sys/block").joinpath(
+		Path(loopdev).name,
+		"loop","backing_file"
+	)
+	try:
+		backfile_str=backfile.read_text().strip()
+	except Exception:
+		return False
+
+	return backfile_str==realpath(str(filepath))
+
+def fsutil_create_file(
+		filepath:Path,
+		file_size:str
+	)->Optional[str]:
+
+	filepath.parent.mkdir(
+		exist_ok=True,
+		parents=True
+	)
+
+	exists=filepath.exists()
+	if exists:
+		if not filepath.is_file():
+			return "the path is already occupied and not by a file"
+
+	if not exists:
+		result=util_subrun([
+			"truncate",
+			"-s",file_size,
+			str(filepath),
+		],ret_mode=_RET_RETURNCODE)
+		if not result==0:
+			return "failed to create the initial file"
+
+	return None
+
+def util_layout_labels(journal_size:Optional[int]=None)->list:
+
+	# The labels of the partitions of a layout, in the order they are on the disk
+
+	if journal_size is None:
+		return [_LABEL]
+
+	return [_LABEL_DATA,_LABEL_JOURNAL]
+
+def util_check_journal_size(
+		file_size:str,
+		journal_size:Optional[int]
+	)->Optional[str]:
+
+	# Checks that the split layout fits in an image of the given size, before anything is allocated
+
+	if journal_size is None:
+		return None
+
+	if not journal_size>=_JOURNAL_SIZE_MIN:
+		return f"the journal partition needs at least {_JOURNAL_SIZE_MIN} bytes"
+
+	size=util_parse_size(file_size)
+	if size is not None and not size-1024*1024-journal_size>=_JOURNAL_SIZE_MIN:
+		return "the journal partition does not fit, the image is too small"
+
+	return None
+
+def fsutil_partition_loopdevice(
+		fse_loopdev:str,
+		journal_size:Optional[int]=None
+	)->tuple:
+
+	# Creates an MBR partition table and the partitions
+	# → without a journal size: a single partition
+	# → with a journal size: a data partition, and a journal partition of that size at the end
+
+	if not cmd_parted_disk_init(fse_loopdev,_PARTED_LABEL_MBR):
+		return (_ERR,"failed to create partition table")
+
+	if journal_size is None:
+		fse_part=fun_create_part(fse_loopdev,_FSTYPE_EXT4)
+		if fse_part is None:
+			return (_ERR,"failed to create partition")
+
+		return tuple([fse_part])
+
+	disk_size=cmd_lsblk_get_dev_size(fse_loopdev)
+	if disk_size is None:
+		return (_ERR,"failed to get the size of the loop device")
+
+	mib=1024*1024
+	data_end=(disk_size-journal_size)//mib
+	if not data_end>1:
+		return (_ERR,"the journal partition does not fit")
+
+	fse_part_data=fun_create_part(
+		fse_loopdev,
+		_FSTYPE_EXT4,
+		fs_start="1MiB",
+		fs_end=f"{data_end}MiB"
+	)
+	if fse_part_data is None:
+		return (_ERR,"failed to create the data partition")
+
+	fse_part_journal=fun_create_part(
+		fse_loopdev,
+		_FSTYPE_EXT4,
+		fs_start=f"{data_end}MiB",
+		fs_end="100%"
+	)
+	if fse_part_journal is None:
+		return (_ERR,"failed to create the journal partition")
+
+	return (fse_part_data,fse_part_journal)
+
+def fsutil_format_partitions(
+		fse_loopdev:str,
+		journal_size:Optional[int]=None
+	)->Optional[str]:
+
+	# Formats the partitions of a loop device, labeled after the layout
+
+	labels=util_layout_labels(journal_size)
+	partitions=util_sysfs_partitions(fse_loopdev)
+	if not len(partitions)==len(labels):
+		return util_msg_err(
+			"the partitions do not match the layout",
+			f"{len(partitions)} partition(s) found, {len(labels)} expected"
+		)
+
+	for fse_part,label in zip(partitions,labels):
+		if not cmd_mkfs_part_format(
+				fse_part,
+				_FSTYPE_EXT4,
+				fs_label=label
+			):
+			return f"failed to format: {fse_part}"
+
+	return None
+
+def fsutil_format_loopdevice(
+		fse_loopdev:str,
+		journal_size:Optional[int]=None
+	)->tuple:
+
+	# Partitions the loop device and formats the partitions
+
+	res=fsutil_partition_loopdevice(fse_loopdev,journal_size=journal_size)
+	if res[0]==_ERR:
+		return res
+
+	msg_err=fsutil_format_partitions(fse_loopdev,journal_size=journal_size)
+	if msg_err is not None:
+		return (_ERR,msg_err)
+
+	return res
+
+def fsutil_prepare_dirs(
+		mountpoint:Path,
+		subdirs:tuple=("data","logs")
+	)->Optional[str]:
+
+	# Creates directories on a mounted partition, owned by the mongodb user
+
+	dirlist=[mountpoint]
+	for subdir in subdirs:
+		dirlist.append(
+			mountpoint.joinpath(subdir)
+		)
+
+	ok=True
+	for dir in dirlist:
+		Path(dir).mkdir(
+			parents=True,
+			exist_ok=True
+		)
+		result=util_subrun([
+			"chown",
+				"mongodb:mongodb",
+				"-R",
+				str(dir)
+			],
+			ret_mode=_RET_RETURNCODE
+		)
+		if not result==0:
+			ok=False
+			break
+
+	if not ok:
+		return f"failed to adjust ownership for: {dir}"
+
+	return None
+
+def fsutil_find_loopdevice(
+		filepath:Path,
+		attach:bool=False,
+		readonly:bool=False
+	)->tuple:
+
+	# Finds the only loop device of a file, attaching it first if asked to (read-only if asked to)
+
+	loop_devices=util_agent_loopdevices(filepath)
+	if loop_devices is None:
+		loop_devices=cmd_losetup_get_devices(filepath)
+	qtty=len(loop_devices)
+
+	if qtty==0 and attach:
+		return fsutil_attach_as_loopdevice(str(filepath),readonly=readonly)
+
+	if not qtty==1:
+		return (
+			_ERR,
+			util_msg_err(
+				"only ONE associated file is needed",
+				f"there is(are) {qtty} device(s)"
+			)
+		)
+
+	if attach:
+		print("NOTE: the file is already attached")
+
+	fse_loopdev=util_fixstring(loop_devices[0].get("name"))
+	if fse_loopdev is None:
+		return (_ERR,"loop device not found...?")
+
+	return tuple([fse_loopdev])
+
+def util_partition_entry(
+		role:str,
+		path:str,
+		mountpoint:Optional[str]
+	)->Mapping:
+
+	# A partition, what it is for, and how it is mounted
+
+	subdir:Optional[str]=None
+	options=_MOUNT_OPTIONS_PART
+	if role==_ROLE_DATA:
+		subdir=_DIR_MOUNT_DATA
+	if role==_ROLE_JOURNAL:
+		subdir=_DIR_MOUNT_LOGS
+		options=_MOUNT_OPTIONS_JOURNAL
+
+	return {
+		"role":role,
+		"path":path,
+		"mountpoint":mountpoint,
+		"subdir":subdir,
+		"options":options,
+	}
+
+def util_label_for_role(role:str)->str:
+
+	if role==_ROLE_DATA:
+		return _LABEL_DATA
+	if role==_ROLE_JOURNAL:
+		return _LABEL_JOURNAL
+
+	return _LABEL
+
+def util_mounted_at(
+		fse_dev:str,
+		mounts:list
+	)->Optional[str]:
+
+	# Where a block device is mounted (not counting bind mounts of parts of it), or None
+
+	majmin=util_dev_majmin(fse_dev)
+	for m in mounts:
+		if m["majmin"]==majmin and m["root"]=="/":
+			return m["target"]
+
+	return None
+
+def fsutil_find_partitions(fse_loopdev:str)->tuple:
+
+	# Finds the partitions of a loop device, what they are for, and where they are mounted (or None)
+	# Returns a tuple with a list of mappings: role, path, mountpoint, subdir (relative to the volume's mountpoint) and mount options
+
+	lst=util_agent_partitions(fse_loopdev)
+	if lst is None:
+		lst=cmd_lsblk_get_devices(
+			fse_loopdev,
+			custom_cols="PATH,LABEL,MOUNTPOINT",
+			exclude_itself=True
+		)
+	if not len(lst)>0:
+		return (_ERR,"there are no partitions")
+
+	by_label={}
+	for item in lst:
+		if not isinstance(item,Mapping):
+			return (
+				_ERR,
+				util_msg_err(
+					"object not valid",
+					f"{item}"
+				)
+			)
+
+		fse_part=util_fixstring(item.get("path"))
+		if fse_part is None:
+			return (_ERR,"partition not found...?")
+
+		label=util_fixstring(item.get("label"),low=True)
+		if label not in by_label.keys():
+			by_label.update({label:item})
+
+	if _LABEL_DATA in by_label.keys() and _LABEL_JOURNAL in by_label.keys():
+		return tuple([[
+			util_partition_entry(
+				_ROLE_DATA,
+				by_label[_LABEL_DATA]["path"],
+				util_fixstring(by_label[_LABEL_DATA].get("mountpoint"))
+			),
+			util_partition_entry(
+				_ROLE_JOURNAL,
+				by_label[_LABEL_JOURNAL]["path"],
+				util_fixstring(by_label[_LABEL_JOURNAL].get("mountpoint"))
+			)
+		]])
+
+	return tuple([[
+		util_partition_entry(
+			_ROLE_MAIN,
+			lst[0]["path"],
+			util_fixstring(lst[0].get("mountpoint"))
+		)
+	]])
+
+def fsutil_mount_partitions(
+		partitions:list,
+		mountpoint:Path
+	)->Optional[str]:
+
+	# Mounts the partitions that are not mounted yet, under the volume's mountpoint
+	# The mountpoints of the given partitions are updated
+
+	for part in partitions:
+		if part["mountpoint"] is not None:
+			continue
+
+		dest=mountpoint
+		if part["subdir"] is not None:
+			dest=mountpoint.joinpath(part["subdir"])
+
+		if not fsutil_mount_path(
+				part["path"],dest,
+				ensure_dest=True,
+				options=part["options"],
+				fs_type=part.get("fstype")
+			):
+			return util_msg_err(
+				"failed to mount the partition",
+				f"{part['path']}"
+			)
+
+		part.update({"mountpoint":str(dest)})
+
+		# A tmpfs is always empty when mounted
+
+		if part.get("fstype")==_FSTYPE_TMPFS:
+			msg_err=fsutil_prepare_partitions([part])
+			if msg_err is not None:
+				return msg_err
+
+	return None
+
+def util_partition_subdirs(part:Mapping)->tuple:
+
+	if part["role"]==_ROLE_DATA:
+		return ("data","data/journal")
+	if part["role"]==_ROLE_JOURNAL:
+		return ("journal","logs")
+
+	return ("data","logs")
+
+def fsutil_partitions_prepared(partitions:list)->bool:
+
+	# True if the directories of every partition are there
+
+	for part in partitions:
+		if part["mountpoint"] is None:
+			return False
+		for subdir in util_partition_subdirs(part):
+			if not Path(part["mountpoint"]).joinpath(subdir).is_dir():
+				return False
+
+	return True
+
+def fsutil_prepare_partitions(partitions:list)->Optional[str]:
+
+	# Creates the directories of each partition
+
+	for part in partitions:
+		msg_err=fsutil_prepare_dirs(
+			Path(part["mountpoint"]),
+			subdirs=util_partition_subdirs(part)
+		)
+		if msg_err is not None:
+			return msg_err
+
+	return None
+
+def fsutil_bind_pairs(
+		partitions:list,
+		mongo_data:Path,
+		mongo_logs:Path
+	)->list:
+
+	# The WiredTiger journal is bound after the data directory, on top of it
+	# An archive is read-only, so its logs are not bound
+
+	mpoints={}
+	for part in partitions:
+		mpoints.update({
+			part["role"]:Path(part["mountpoint"])
+		})
+
+		if part.get("fstype") in _FSTYPES_ARCHIVE:
+			mpoint=Path(part["mountpoint"])
+			pairs=[(mpoint.joinpath("data"),mongo_data)]
+			if mpoint.joinpath("journal").is_dir():
+				pairs.append(
+					(mpoint.joinpath("journal"),mongo_data.joinpath("journal"))
+				)
+			return pairs
+
+	if _ROLE_MAIN in mpoints.keys():
+		return [
+			(mpoints[_ROLE_MAIN].joinpath("data"),mongo_data),
+			(mpoints[_ROLE_MAIN].joinpath("logs"),mongo_logs)
+		]
+
+	return [
+		(mpoints[_ROLE_DATA].joinpath("data"),mongo_data),
+		(mpoints[_ROLE_JOURNAL].joinpath("journal"),mongo_data.joinpath("journal")),
+		(mpoints[_ROLE_JOURNAL].joinpath("logs"),mongo_logs)
+	]
+
+def fsutil_setup_binds(pairs:list)->Optional[str]:
+
+	msg_err:Optional[str]=None
+
+	for pair in pairs:
+		if not fsutil_mount_path(pair[0],pair[1]):
+			msg_err=util_msg_err(
+				"failed to mount",
+				f"orig:{pair[0]}\ndest:{[pair[1]]}"
+			)
+			break
+
+	return msg_err
+
+def util_warm_priority(fse:Path)->tuple:
+
+	name=fse.name
+	group=0
+	if name.startswith(_WT_PREFIX_INDEX):
+		group=1
+	if name.startswith(_WT_PREFIX_COLLECTION):
+		group=2
+
+	return (group,fse.stat().st_size)
+
+def fsutil_warm_files(
+		data_dir:Path,
+		warm_list:Optional[Path]=None
+	)->tuple:
+
+	# The files to warm up, in order
+	# → from a list (one path per line, relative to the data directory or absolute), in the order given
+	# → otherwise every WiredTiger file in the data directory
+
+	if not data_dir.is_dir():
+		return (_ERR,f"the data directory does not exist: {data_dir}")
+
+	if warm_list is not None:
+		try:
+			lines=warm_list.read_text().splitlines()
+		except Exception as exc:
+			return (_ERR,f"failed to read the list: {exc}")
+
+		files=[]
+		for line in lines:
+			line_ok=util_fixstring(line)
+			if line_ok is None:
+				continue
+			fse=Path(line_ok)
+			if not fse.is_absolute():
+				fse=data_dir.joinpath(fse)
+			if not fse.is_file():
+				print("Not found:",fse)
+				continue
+			files.append(fse)
+
+		return tuple([files])
+
+	files=[
+		fse for fse in data_dir.rglob(f"*{_WT_SUFFIX}")
+		if fse.is_file()
+	]
+	files.sort(key=util_warm_priority)
+
+	return tuple([files])
+
+def fsutil_data_dir(filepath:Path)->tuple:
+
+	# The data directory on the mounted volume
+
+	res=fsutil_volume_device(filepath)
+	if res[0]==_ERR:
+		return res
+
+	res=fsutil_volume_partitions(filepath,res[0])
+	if res[0]==_ERR:
+		return res
+
+	for part in res[0]:
+		if not part["role"] in (_ROLE_MAIN,_ROLE_DATA):
+			continue
+		if part["mountpoint"] is None:
+			return (_ERR,"the volume is not mounted")
+		return tuple([Path(part["mountpoint"]).joinpath("data")])
+
+	return (_ERR,"there is no data partition")
+
+def fsutil_logs_dirs(filepath:Path)->tuple:
+
+	# The logs directories on the mounted volume: the one of the volume, or one per tenant for a shared volume
+
+	shared=util_read_descriptor(filepath).get("shared")
+	if shared is not None:
+		res=fsutil_shared_root(filepath)
+		if res[0]==_ERR:
+			return res
+		return tuple([[
+			res[1].joinpath(name,"logs")
+			for name in sorted(shared["tenants"].keys())
+		]])
+
+	res=fsutil_volume_device(filepath)
+	if res[0]==_ERR:
+		return res
+
+	res=fsutil_volume_partitions(filepath,res[0])
+	if res[0]==_ERR:
+		return res
+
+	for part in res[0]:
+		if not part["role"] in (_ROLE_MAIN,_ROLE_JOURNAL):
+			continue
+		if part["mountpoint"] is None:
+			return (_ERR,"the volume is not mounted")
+		return tuple([[Path(part["mountpoint"]).joinpath("logs")]])
+
+	return (_ERR,"there is no logs partition")
+
+def fsutil_logs_rotated(
+		logs_dir:Path,
+		archive:Optional[Path]=None
+	)->tuple:
+
+	# The rotated logs in a logs directory, oldest first: those to compress, and those compressed already (in the archive directory if given)
+
+	if not logs_dir.is_dir():
+		return (_ERR,f"the logs directory does not exist: {logs_dir}")
+
+	suffixes=tuple(entry[0] for entry in _CODEC_FILES.values())
+	now=time()
+
+	pending=[]
+	for fse in logs_dir.iterdir():
+		if fse.is_symlink() or not fse.is_file():
+			continue
+		if re_match(_LOGS_ROTATED,fse.name) is None:
+			continue
+		if now-fse.stat().st_mtime<_LOGS_MIN_AGE:
+			continue
+		pending.append(fse)
+
+	compressed=[]
+	dir_compressed=logs_dir if archive is None else archive
+	if dir_compressed.is_dir():
+		for fse in dir_compressed.iterdir():
+			if fse.is_symlink() or not fse.is_file():
+				continue
+			if not fse.name.endswith(suffixes):
+				continue
+			if re_match(_LOGS_ROTATED,fse.name.rsplit(".",1)[0]) is None:
+				continue
+			compressed.append(fse)
+
+	pending.sort(key=lambda fse:fse.stat().st_mtime)
+	compressed.sort(key=lambda fse:fse.stat().st_mtime)
+
+	return (pending,compressed)
+
+def fsutil_logs_limit(
+		compressed:list,
+		max_bytes:int
+	)->list:
+
+	# Deletes the oldest compressed logs until the rest fit in the limit
+	# Returns the files deleted
+
+	sizes=[fse.stat().st_size for fse in compressed]
+	total=sum(sizes)
+
+	deleted=[]
+	for fse,size in zip(compressed,sizes):
+		if not total>max_bytes:
+			break
+		try:
+			fse.unlink()
+		except Exception as exc:
+			print("Unable to delete:",fse,exc)
+			continue
+		total=total-size
+		deleted.append(str(fse))
+
+	return deleted
+
+def fsutil_bench_dirs(filepath:Path)->tuple:
+
+	# Where the benchmark puts its data file and its journal file: the same places MongoDB would
+	# Also returns the mount options in effect, so runs with different presets can be told apart
+
+	res=fsutil_volume_device(filepath)
+	if res[0]==_ERR:
+		return res
+
+	res=fsutil_volume_partitions(filepath,res[0])
+	if res[0]==_ERR:
+		return res
+	partitions=res[0]
+
+	mounts=util_read_mountinfo()
+	if mounts is None:
+		return (_ERR,"unable to read the mount table")
+
+	dir_data:Optional[Path]=None
+	dir_journal:Optional[Path]=None
+	volume=[]
+	for part in partitions:
+		if part["mountpoint"] is None:
+			return (_ERR,"the volume is not mounted")
+
+		mpoint=Path(part["mountpoint"])
+		if part["role"] in (_ROLE_MAIN,_ROLE_DATA):
+			dir_data=mpoint.joinpath("data")
+		if part["role"]==_ROLE_JOURNAL:
+			dir_journal=mpoint.joinpath("journal")
+
+		for m in mounts:
+			if m["target"]==part["mountpoint"]:
+				volume.append({
+					"role":part["role"],
+					"device":part["path"],
+					"fstype":m["fstype"],
+					"options":m["options"],
+					"super_options":m["super_options"],
+				})
+				break
+
+	if dir_data is None:
+		return (_ERR,"there is no data partition")
+	if not dir_data.is_dir():
+		return (_ERR,f"the data directory does not exist: {dir_data}")
+
+	# MongoDB makes the journal directory of the single layout itself, so it is not made here
+
+	if dir_journal is None:
+		dir_journal=dir_data.joinpath("journal")
+	if not dir_journal.is_dir():
+		dir_journal=dir_data
+
+	return (dir_data,dir_journal,volume)
+
+def fsutil_io_devices(
+		filepath:Path,
+		loops_only:bool=False
+	)->list:
+
+	# The devices the I/O rules of an image go to: the disks its files are stored on, and the loop devices they are attached to
+
+	majmin_list=[]
+	for fse in fsutil_volume_files(filepath):
+		candidates=[]
+		if not loops_only:
+			candidates.append(util_backing_majmin(fse))
+		for loopdev in (util_sysfs_loop_devices(fse) or []):
+			candidates.append(util_dev_majmin(loopdev))
+		for majmin in candidates:
+			if majmin is None or majmin in majmin_list:
+				continue
+			majmin_list.append(majmin)
+
+	return majmin_list
+
+def fsutil_io_apply(
+		filepath:Path,
+		loops_only:bool=False,
+		clear:bool=False
+	)->Optional[str]:
+
+	# Applies the I/O rules in the volume descriptor (or clears them)
+
+	policy=util_read_descriptor(filepath).get("io")
+	if policy is None:
+		return None
+
+	io_max=policy["max"]
+	weight=policy["weight"]
+	latency=policy["latency"]
+	if clear:
+		io_max=None if io_max is None else {}
+		weight=None if weight is None else 0
+		latency=None if latency is None else 0
+
+	return fun_cgroup_io_apply(
+		Path(policy["cgroup"]),
+		fsutil_io_devices(filepath,loops_only=loops_only),
+		io_max=io_max,
+		weight=weight,
+		latency=latency
+	)
+
+def fsutil_volume_mounts(
+		filepath:Path,
+		topology:Mapping,
+		mounts:list
+	)->Mapping:
+
+	# Finds what an image is attached, mounted and bound as, from a topology and a mount table read beforehand
+	# The filesystems sit on the partitions of its loop devices, on a device mapper device built on top of them (stripe, cache, crypt, origins or snapshot), or on a tmpfs for an ephemeral volume
+
+	desc=util_read_descriptor(filepath)
+
+	loop_devices=[]
+	majmin_list=[]
+	for fse in fsutil_volume_files(filepath):
+		for loopdev in topology.get(realpath(str(fse)),[]):
+			loop_devices.append(loopdev["path"])
+			majmin_list.append(loopdev["majmin"])
+			majmin_list.extend(
+				[part["majmin"] for part in loopdev["partitions"]]
+			)
+
+	names=[]
+	for kind in ("stripe","cache"):
+		if desc.get(kind) is not None:
+			names.append(desc[kind]["name"])
+	if desc.get("crypt") is not None:
+		names.extend(desc["crypt"]["names"].values())
+	if desc.get("origins") is not None:
+		names.extend(desc["origins"].values())
+	if desc.get("snapshot") is not None:
+		names.extend(
+			[entry["snap"] for entry in desc["snapshot"]["entries"]]
+		)
+
+	for name in names:
+		fse_dev=Path(f"/dev/mapper/{name}")
+		if not fse_dev.exists():
+			continue
+		majmin=util_dev_majmin(fse_dev)
+		if majmin is not None:
+			majmin_list.append(majmin)
+
+	ephemeral=desc.get("ephemeral")
+
+	found=[]
+	for m in mounts:
+		if m["majmin"] in majmin_list:
+			found.append(m)
+			continue
+		if ephemeral is not None:
+			if m["source"]==ephemeral["name"] and m["fstype"]==_FSTYPE_TMPFS:
+				found.append(m)
+
+	return {
+		"state":util_live_state(len(loop_devices)>0,found),
+		"loop_devices":loop_devices,
+		"mounts":[m["target"] for m in found if m["root"]=="/"],
+		"binds":[m["target"] for m in found if not m["root"]=="/"],
+	}
+
+def fsutil_check_image(filepath:Path)->Mapping:
+
+	# Checks the filesystems of a detached image without changing anything
+	# Returns the result, the e2fsck exit code of each partition, and how long it took
+
+	time_start=monotonic()
+	result={
+		"file":str(filepath),
+		"result":_CHECK_CLEAN,
+		"reason":None,
+		"partitions":[],
+		"seconds":0,
+	}
+
+	def done(outcome:str,reason:Optional[str]=None)->Mapping:
+		result.update({
+			"result":outcome,
+			"reason":reason,
+			"seconds":round(monotonic()-time_start,3),
+		})
+		return result
+
+	desc=util_read_descriptor(filepath)
+	for kind in ("ephemeral","stripe","cache","crypt"):
+		if desc.get(kind) is not None:
+			return done(_CHECK_SKIPPED,f"the filesystems of a {kind} volume can not be checked on their own")
+
+	if fsutil_archive_fstype(filepath) is not None:
+		return done(_CHECK_SKIPPED,"an archive is read-only")
+
+	with util_lock_image(filepath):
+		if not filepath.is_file():
+			return done(_CHECK_FAILED,"the image does not exist")
+		if not cmd_losetup_get_devices(filepath,get_quantity=True)==0:
+			return done(_CHECK_SKIPPED,"the image is attached")
+
+		entries=util_mbr_partitions(filepath)
+		if entries is None:
+			return done(_CHECK_FAILED,"the image has no MBR partition table")
+
+		order=[_CHECK_CLEAN,_CHECK_NEEDS_REPLAY,_CHECK_NEEDS_REPAIR,_CHECK_FAILED]
+		outcome=_CHECK_CLEAN
+		for entry in entries:
+			fse_part=cmd_losetup_attach(
+				filepath,
+				offset=entry["start"]*_MBR_SECTOR_SIZE,
+				sizelimit=entry["sectors"]*_MBR_SECTOR_SIZE,
+				readonly=True
+			)
+			if fse_part is None:
+				return done(_CHECK_FAILED,"failed to attach a partition")
+
+			try:
+				sb=util_ext4_superblock(fse_part)
+				code=cmd_e2fsck(fse_part,readonly=True)
+			finally:
+				cmd_losetup_detatch(fse_part)
+
+			result["partitions"].append({
+				"index":entry["index"],
+				"exit_code":code,
+				"needs_recovery":None if sb is None else sb["needs_recovery"],
+				"errors":None if sb is None else sb["errors"],
+			})
+
+			# 4: errors left uncorrected (with -n, any error), 8 and above: the check itself failed
+			# A journal that was not replayed (and no errors recorded) is not damage: a read-only check can not replay it, mounting does
+			# Worst one wins: failed, then needs_repair, then needs_replay
+
+			part_outcome=_CHECK_CLEAN
+			if not code<8:
+				part_outcome=_CHECK_FAILED
+			elif sb is not None and sb["needs_recovery"] and not sb["errors"]:
+				part_outcome=_CHECK_NEEDS_REPLAY
+			elif not code<4:
+				part_outcome=_CHECK_NEEDS_REPAIR
+
+			if order.index(part_outcome)>order.index(outcome):
+				outcome=part_outcome
+
+	return done(outcome)
+
+def fsutil_registry_record(
+		filepath:Path,
+		changes:Mapping,
+		create:bool=True
+	):
+
+	# Records the outcome of a command in the registry, along with what the image is attached, mounted and bound as now
+	# If not create, an image that is not registered is left out
+	# Failing to write the registry does not fail the command
+
+	if not create:
+		if realpath(str(filepath)) not in util_registry_read().keys():
+			return
+
+	seen=None
+	topology=fun_get_topology()
+	mounts=util_read_mountinfo()
+	if topology is not None and mounts is not None:
+		seen=fsutil_volume_mounts(filepath,topology,mounts)
+
+	entry=dict(changes)
+	entry.update({"seen":seen})
+	if not util_registry_update(filepath,entry):
+		print("Unable to update the registry:",_REGISTRY_PATH)
+
+def fsutil_shrink_plan(
+		filepath:Path,
+		entry:Mapping,
+		fse_part:str,
+		target_size:Optional[int]=None,
+		headroom:float=_SHRINK_HEADROOM
+	)->tuple:
+
+	# What shrinking an image would do: the sizes before and after, and how long it should take
+	# The time counts the used blocks past the new end (resize2fs reads and writes them), and the inode tables (e2fsck reads them twice), at the measured read throughput
+
+	sb=util_ext4_superblock(fse_part)
+	if sb is None:
+		return (_ERR,"the partition does not hold an ext4 filesystem")
+
+	min_blocks=cmd_resize2fs_min_blocks(fse_part)
+	if min_blocks is None:
+		return (_ERR,"failed to get the minimum size of the filesystem")
+
+	block_size=sb["block_size"]
+	offset=entry["start"]*_MBR_SECTOR_SIZE
+	fstat=filepath.stat()
+
+	if target_size is None:
+		end=offset+int(min_blocks*block_size*(1+headroom))
+		end=-(-end//_SHRINK_ALIGN)*_SHRINK_ALIGN
+	else:
+		end=(target_size//_SHRINK_ALIGN)*_SHRINK_ALIGN
+
+	target_blocks=(end-offset)//block_size
+	if target_blocks<min_blocks:
+		return (
+			_ERR,
+			util_msg_err(
+				"the target size is below the minimum size",
+				f"minimum: {offset+min_blocks*block_size} bytes"
+			)
+		)
+
+	# A filesystem that is small enough already is left as it is, the image is still compacted
+
+	if target_blocks>=sb["blocks"]:
+		target_blocks=sb["blocks"]
+		end=offset+target_blocks*block_size
+		end=-(-end//_SHRINK_ALIGN)*_SHRINK_ALIGN
+
+	moved=0
+	for first,last,free in (cmd_dumpe2fs_groups(fse_part) or []):
+		if last<target_blocks:
+			continue
+		moved=moved+(last-first+1-free)*block_size
+
+	used=(sb["blocks"]-sb["free_blocks"])*block_size
+	allocated=fstat.st_blocks*512
+
+	throughput=fun_read_throughput(fse_part,_SHRINK_SAMPLE_SIZE)
+	seconds:Optional[float]=None
+	if throughput is not None:
+		seconds=(2*moved+2*sb["inodes"]*sb["inode_size"])/throughput
+
+	return tuple([{
+		"size":fstat.st_size,
+		"allocated":allocated,
+		"used":used,
+		"min_size":offset+min_blocks*block_size,
+		"target_size":end,
+		"blocks":sb["blocks"],
+		"target_blocks":target_blocks,
+		"saved":max(0,fstat.st_size-end),
+		"saved_allocated":max(0,allocated-(offset+used)),
+		"moved":moved,
+		"throughput":throughput,
+		"seconds":seconds,
+	}])
+
+def util_snapshot_cow_path(
+		filepath:Path,
+		role:str
+	)->Path:
+
+	return filepath.with_name(f"{filepath.name}.snapshot-{role}.cow")
+
+def fsutil_snapshot_hook(
+		hook:Optional[Path],
+		stage:str,
+		filepath:Path,
+		mountpoints:list
+	)->bool:
+
+	# Freezes or thaws the filesystems: through the hook if there is one (called with the stage and the image), or with FIFREEZE/FITHAW
+	# When freezing fails halfway, what was frozen is thawed again
+
+	if hook is not None:
+		result=util_subrun(
+			[str(hook),stage,str(filepath)],
+			ret_mode=_RET_RETURNCODE
+		)
+		return result==0
+
+	done=[]
+	for mpoint in mountpoints:
+		if not libc_fs_freeze(mpoint,freeze=(stage=="freeze"))==0:
+			if stage=="freeze":
+				for mpoint_done in done:
+					libc_fs_freeze(mpoint_done,freeze=False)
+			return False
+		done.append(mpoint)
+
+	return True
+
+def fsutil_snapshot_restore(entries:list)->bool:
+
+	# Puts back the original table of each origin, and removes the snapshot and the copy of the original table
+
+	ok=True
+	for entry in entries:
+		if Path(f"/dev/mapper/{entry['snap']}").exists():
+			ok=cmd_dmsetup_remove(entry["snap"]) and ok
+
+		if not cmd_dmsetup_table(entry["origin"])==entry["table"]:
+			if not cmd_dmsetup_suspend(entry["origin"]):
+				ok=False
+				continue
+			if not cmd_dmsetup_load(entry["origin"],entry["table"]):
+				ok=False
+			ok=cmd_dmsetup_resume(entry["origin"]) and ok
+
+		if Path(f"/dev/mapper/{entry['real']}").exists():
+			ok=cmd_dmsetup_remove(entry["real"]) and ok
+
+	return ok
+
+def fsutil_snapshot_release(
+		filepath:Path,
+		entries:list
+	)->Optional[str]:
+
+	# Detaches and deletes the copy-on-write files, and forgets the snapshot
+
+	cows=[Path(entry["cow"]) for entry in entries]
+	if not fun_deep_detatch_all(cows):
+		return "failed to detach the copy-on-write file(s)"
+
+	for cow in cows:
+		if cow.exists():
+			cow.unlink()
+
+	if not util_update_descriptor(filepath,{"snapshot":None}):
+		return "failed to write the volume descriptor"
+
+	return None
+
+def fsutil_snapshot_create(
+		filepath:Path,
+		hook:Optional[Path]=None
+	)->Optional[str]:
+
+	# Takes a crash-consistent snapshot of every partition of a mounted volume, at the same point in time
+	# → a copy of the table of each origin is made (the "real" device), and a sparse copy-on-write file is attached
+	# → the filesystems are frozen (or the hook is called) and the origins suspended
+	# → each origin becomes a snapshot-origin over its real device, and a read-only snapshot is created next to it
+	# → the origins are resumed and the filesystems thawed right away
+
+	desc=util_read_descriptor(filepath)
+	if desc.get("snapshot") is not None:
+		return "there is a snapshot already, merge it or discard it first"
+
+	res=fsutil_volume_device(filepath)
+	if res[0]==_ERR:
+		return res[1]
+
+	res=fsutil_volume_partitions(filepath,res[0])
+	if res[0]==_ERR:
+		return res[1]
+	partitions=res[0]
+
+	entries=[]
+	for part in partitions:
+		if not part["path"].startswith("/dev/mapper/"):
+			return "the volume does not support snapshots, mount it with the snapshots flag"
+
+		name=Path(part["path"]).name
+		sectors=util_sysfs_sectors(part["path"])
+		table=cmd_dmsetup_table(name)
+		if sectors is None or table is None:
+			return f"unable to read the device: {part['path']}"
+
+		cow=util_snapshot_cow_path(filepath,part["role"])
+		if cow.exists():
+			return f"the copy-on-write file already exists: {cow}"
+
+		entries.append({
+			"role":part["role"],
+			"origin":name,
+			"real":f"{name}-real",
+			"snap":f"{name}-snap",
+			"cow":str(cow),
+			"sectors":sectors,
+			"table":table,
+		})
+
+	# The copy-on-write file may need as much as the partition, plus the exception tables
+	# It is sparse, so only what changes on the origin takes space
+
+	for entry in entries:
+		cow_size=entry["sectors"]*512
+		cow_size=cow_size+cow_size//128+1024*1024
+		msg_err=fsutil_create_file(Path(entry["cow"]),str(cow_size))
+		if msg_err is not None:
+			fsutil_snapshot_release(filepath,entries)
+			return msg_err
+
+		cow_loop=cmd_losetup_attach(entry["cow"])
+		if cow_loop is None:
+			fsutil_snapshot_release(filepath,entries)
+			return "failed to attach the copy-on-write file"
+		entry.update({"cow_loop":cow_loop})
+
+		if cmd_dmsetup_create(entry["real"],entry["table"]) is None:
+			fsutil_snapshot_restore(entries)
+			fsutil_snapshot_release(filepath,entries)
+			return f"failed to create: {entry['real']}"
+
+	mountpoints=[
+		part["mountpoint"]
+		for part in partitions
+		if part["mountpoint"] is not None
+	]
+
+	time_start=monotonic()
+
+	if not fsutil_snapshot_hook(hook,"freeze",filepath,mountpoints):
+		fsutil_snapshot_restore(entries)
+		fsutil_snapshot_release(filepath,entries)
+		return "failed to freeze the filesystem(s)"
+
+	msg_err:Optional[str]=None
+	suspended=[]
+	try:
+		for entry in entries:
+			if not cmd_dmsetup_suspend(entry["origin"],nolockfs=(hook is None)):
+				msg_err=f"failed to suspend: {entry['origin']}"
+				break
+			suspended.append(entry)
+
+		if msg_err is None:
+			for entry in entries:
+				table_snap=(
+					f"0 {entry['sectors']} snapshot "
+					f"/dev/mapper/{entry['real']} {entry['cow_loop']} "
+					f"P {_SNAPSHOT_CHUNK_SECTORS}"
+				)
+				if cmd_dmsetup_create(entry["snap"],table_snap,readonly=True) is None:
+					msg_err=f"failed to create: {entry['snap']}"
+					break
+				table_origin=f"0 {entry['sectors']} snapshot-origin /dev/mapper/{entry['real']}"
+				if not cmd_dmsetup_load(entry["origin"],table_origin):
+					msg_err=f"failed to load: {entry['origin']}"
+					break
+
+	finally:
+		for entry in suspended:
+			cmd_dmsetup_resume(entry["origin"])
+		thawed=fsutil_snapshot_hook(hook,"thaw",filepath,mountpoints)
+
+	print(
+		"\nFrozen for:",
+		f"{round((monotonic()-time_start)*1000,3)}ms"
+	)
+
+	if msg_err is None and not thawed:
+		msg_err="failed to thaw the filesystem(s)"
+
+	if msg_err is not None:
+		fsutil_snapshot_restore(entries)
+		fsutil_snapshot_release(filepath,entries)
+		return msg_err
+
+	for entry in entries:
+		del entry["cow_loop"]
+
+	if not util_update_descriptor(
+			filepath,
+			{
+				"snapshot":{
+					"created":int(time()),
+					"entries":entries,
+				}
+			}
+		):
+		return "failed to write the volume descriptor"
+
+	for entry in entries:
+		print(
+			"\nSnapshot:",entry["role"],
+			f"/dev/mapper/{entry['snap']}",
+			"(read-only)"
+		)
+
+	return None
+
+def fsutil_snapshot_merge(
+		filepath:Path,
+		entries:list
+	)->Optional[str]:
+
+	# Rolls the origins back to the snapshot
+	# Everything mounted from the origins (and the snapshots) is unmounted first, and the volume must be mounted again afterwards
+
+	tree=fun_build_mount_tree(
+		[f"/dev/mapper/{entry['origin']}" for entry in entries]+
+		[f"/dev/mapper/{entry['snap']}" for entry in entries]
+	)
+	if tree is None:
+		return "unable to read the mount table"
+	if not fun_unmount_tree(tree):
+		return "failed to unmount the volume"
+
+	for entry in entries:
+		if not cmd_dmsetup_remove(entry["snap"]):
+			return f"failed to remove: {entry['snap']}"
+
+		cow_loops=util_sysfs_loop_devices(entry["cow"])
+		if cow_loops is None or not len(cow_loops)==1:
+			return f"the copy-on-write file is not attached: {entry['cow']}"
+
+		table_merge=(
+			f"0 {entry['sectors']} snapshot-merge "
+			f"/dev/mapper/{entry['real']} {cow_loops[0]} "
+			f"P {_SNAPSHOT_CHUNK_SECTORS}"
+		)
+		if not cmd_dmsetup_suspend(entry["origin"]):
+			return f"failed to suspend: {entry['origin']}"
+		loaded=cmd_dmsetup_load(entry["origin"],table_merge)
+		if not (cmd_dmsetup_resume(entry["origin"]) and loaded):
+			return f"failed to start merging: {entry['origin']}"
+
+	pending=list(entries)
+	while len(pending)>0:
+		sleep(_SNAPSHOT_MERGE_POLL_SECONDS)
+		for entry in list(pending):
+			status=util_parse_dm_snapshot_status(
+				cmd_dmsetup_status(entry["origin"])
+			)
+			if status is None or not status["state"]=="valid":
+				return util_msg_err(
+					"the merge failed",
+					f"{entry['origin']}: {status}"
+				)
+			if status["merged"]:
+				pending.remove(entry)
+
+	if not fsutil_snapshot_restore(entries):
+		return "failed to restore the original tables"
+
+	return fsutil_snapshot_release(filepath,entries)
+
+def fsutil_snapshot_discard(
+		filepath:Path,
+		entries:list
+	)->Optional[str]:
+
+	# Drops the snapshot, the origins keep their current contents
+
+	tree=fun_build_mount_tree(
+		[f"/dev/mapper/{entry['snap']}" for entry in entries]
+	)
+	if tree is None:
+		return "unable to read the mount table"
+	if not fun_unmount_tree(tree):
+		return "failed to unmount the snapshot"
+
+	if not fsutil_snapshot_restore(entries):
+		return "failed to restore the original tables"
+
+	return fsutil_snapshot_release(filepath,entries)
+
+@util_image_locked
+def fsutil_create_plain(
+		filepath:Path,
+		steps:Mapping,
+		file_size:str,
+		journal_size:Optional[int]=None,
+		encrypt:Optional[Path]=None,
+		cache_file:Optional[Path]=None,
+		cache_size:Optional[str]=None,
+		cache_mode:str=_CACHE_MODE_WRITETHROUGH
+	)->tuple:
+
+	# Creates a plain image (optionally encrypted or cached), skipping the steps of its journal that still check out
+	# Returns the device the volume sits on
+
+	if not util_steps_check(
+			steps,_STEP_ALLOCATED,
+			lambda:(
+				filepath.is_file() and
+				filepath.stat().st_size==steps["details"][_STEP_ALLOCATED]["size"]
+			)
+		):
+
+		msg_err=fsutil_create_file(filepath,file_size)
+		if msg_err is not None:
+			return (_ERR,msg_err)
+		util_steps_mark(
+			filepath,steps,_STEP_ALLOCATED,
+			{"size":filepath.stat().st_size}
+		)
+
+	res=fsutil_find_loopdevice(filepath,attach=True)
+	if res[0]==_ERR:
+		return res
+	fse_loopdev=res[0]
+	util_steps_mark(
+		filepath,steps,_STEP_ATTACHED,
+		{"device":fse_loopdev}
+	)
+
+	labels=util_layout_labels(journal_size)
+	if not util_steps_check(
+			steps,_STEP_PARTITIONED,
+			lambda:len(util_sysfs_partitions(fse_loopdev))==len(labels)
+		):
+
+		# Whatever was stacked on the old partitions is gone
+
+		if not util_update_descriptor(
+				filepath,
+				{"crypt":None,"cache":None,"origins":None,"shared":None}
+			):
+			return (_ERR,"failed to write the volume descriptor")
+
+		res=fsutil_partition_loopdevice(
+			fse_loopdev,
+			journal_size=journal_size
+		)
+		if res[0]==_ERR:
+			return res
+		util_steps_mark(filepath,steps,_STEP_PARTITIONED)
+
+	# Once encrypted, the filesystems are only seen through dm-crypt
+
+	if not util_steps_check(
+			steps,_STEP_FORMATTED,
+			lambda:(
+				_STEP_ENCRYPTED in steps["done"] or
+				all(
+					util_guess_fstype(fse_part)==_FSTYPE_EXT4
+					for fse_part in util_sysfs_partitions(fse_loopdev)
+				)
+			)
+		):
+
+		msg_err=fsutil_format_partitions(
+			fse_loopdev,
+			journal_size=journal_size
+		)
+		if msg_err is not None:
+			return (_ERR,msg_err)
+		util_steps_mark(filepath,steps,_STEP_FORMATTED)
+
+	if encrypt is not None:
+		if not util_steps_check(
+				steps,_STEP_ENCRYPTED,
+				lambda:util_read_descriptor(filepath).get("crypt") is not None
+			):
+
+			msg_err=fsutil_create_crypt(filepath,fse_loopdev,encrypt)
+			if msg_err is not None:
+				return (_ERR,msg_err)
+			fsutil_crypt_check(filepath,fse_loopdev)
+			util_steps_mark(filepath,steps,_STEP_ENCRYPTED)
+
+	if cache_file is None:
+		return tuple([fse_loopdev])
+
+	if util_steps_check(
+			steps,_STEP_CACHED,
+			lambda:util_read_descriptor(filepath).get("cache") is not None
+		):
+
+		return fsutil_volume_device(filepath,attach=True)
+
+	res=fsutil_create_cache(
+		filepath,
+		cache_file,
+		cache_size,
+		cache_mode
+	)
+	if res[0]==_ERR:
+		return res
+	util_steps_mark(filepath,steps,_STEP_CACHED)
+
+	return res
+
+@util_image_locked
+def main_create(
+		filepath:Path,
+		file_size:str,
+		mountpoint:Path,
+		journal_size:Optional[int]=None,
+		stripe_with:Optional[list]=None,
+		chunk_size:int=_STRIPE_CHUNK_SIZE,
+		cache_file:Optional[Path]=None,
+		cache_size:Optional[str]=None,
+		cache_mode:str=_CACHE_MODE_WRITETHROUGH,
+		ephemeral:bool=False,
+		snapshots:bool=False,
+		encrypt:Optional[Path]=None,
+		shared:bool=False
+	)->Optional[str]:
+
+	# Creates a raw disk image with an MBR partition table and a single partition
+	# With a journal size, the image gets a data partition and a journal partition instead
+	# With more files to stripe with, all of them are striped together and formatted as a whole
+	# With a cache file, a cache image on faster storage is put in front of the partition
+	# If ephemeral, there is no image: the volume is a tmpfs capped at the given size
+	# With snapshots, the partitions are mounted in a way that allows taking snapshots of them
+	# With a keyfile to encrypt with, the partitions are encrypted with dm-crypt, and the overhead is measured
+	# If shared, the volume is meant for many tenants, each one in its own directory tree with its own project quota (see main_tenant)
+	# Except for ephemeral volumes, the steps done are recorded in a journal next to the image (see util_steps_load), and a failed creation can be run again to pick up where it stopped
+	# The whole creation holds the lock of the image, the journal included: two creations of the same image run one after the other
+
+	if shared:
+		if ephemeral:
+			return "an ephemeral volume can not be shared"
+		if journal_size is not None:
+			return "a shared volume can not have a separate journal partition"
+
+	if encrypt is not None:
+		if ephemeral or cache_file is not None:
+			return "only plain images can be encrypted"
+		if stripe_with is not None and len(stripe_with)>0:
+			return "only plain images can be encrypted"
+
+	if ephemeral:
+		if journal_size is not None or cache_file is not None:
+			return "an ephemeral volume has no partitions or cache"
+		if stripe_with is not None and len(stripe_with)>0:
+			return "an ephemeral volume can not be striped"
+
+	msg_err=util_check_journal_size(file_size,journal_size)
+	if msg_err is not None:
+		return msg_err
+
+	if cache_file is not None:
+		if journal_size is not None:
+			return "a cached volume can not have a separate journal partition"
+		if stripe_with is not None and len(stripe_with)>0:
+			return "a stripe set can not be cached"
+		if cache_size is None:
+			return "the size of the cache is missing"
+
+	steps:Optional[Mapping]=None
+	if not ephemeral:
+		res=util_steps_load(
+			filepath,
+			{
+				"file_size":file_size,
+				"journal_size":journal_size,
+				"stripe_with":[str(m) for m in (stripe_with or [])],
+				"chunk_size":chunk_size,
+				"cache_file":None if cache_file is None else str(cache_file),
+				"cache_size":cache_size,
+				"cache_mode":cache_mode,
+				"snapshots":snapshots,
+				"encrypt":None if encrypt is None else str(encrypt),
+				"shared":shared,
+			}
+		)
+		if res[0]==_ERR:
+			return res[1]
+		steps=res[0]
+
+	if ephemeral:
+		res=fsutil_create_ephemeral(filepath,file_size)
+		if res[0]==_ERR:
+			return res[1]
+		fse_dev=res[0]
+
+	elif stripe_with is not None and len(stripe_with)>0:
+		if journal_size is not None:
+			return "a stripe set can not have a separate journal partition"
+
+		# A stripe set is made in one go, and assembled again if it was made already
+
+		if util_steps_check(
+				steps,_STEP_FORMATTED,
+				lambda:util_read_descriptor(filepath).get("stripe") is not None
+			):
+			res=fsutil_volume_device(filepath,attach=True)
+		else:
+			res=fsutil_create_stripe(
+				filepath,file_size,
+				stripe_with,chunk_size
+			)
+		if res[0]==_ERR:
+			return res[1]
+		fse_dev=res[0]
+		util_steps_mark(filepath,steps,_STEP_FORMATTED)
+
+	else:
+		res=fsutil_create_plain(
+			filepath,
+			steps,
+			file_size,
+			journal_size=journal_size,
+			encrypt=encrypt,
+			cache_file=cache_file,
+			cache_size=cache_size,
+			cache_mode=cache_mode
+		)
+		if res[0]==_ERR:
+			return res[1]
+		fse_dev=res[0]
+
+	if snapshots:
+		msg_err=fsutil_enable_origins(filepath,fse_dev)
+		if msg_err is not None:
+			return msg_err
+
+	res=fsutil_volume_partitions(filepath,fse_dev)
+	if res[0]==_ERR:
+		return res[1]
+	partitions=res[0]
+
+	if shared:
+		if not util_steps_check(
+				steps,_STEP_SHARED,
+				lambda:util_read_descriptor(filepath).get("shared") is not None
+			):
+
+			msg_err=fsutil_enable_shared(filepath,partitions)
+			if msg_err is not None:
+				return msg_err
+			util_steps_mark(filepath,steps,_STEP_SHARED)
+
+	msg_err=fsutil_mount_partitions(partitions,mountpoint)
+	if msg_err is not None:
+		return msg_err
+	util_steps_mark(
+		filepath,steps,_STEP_MOUNTED,
+		{"mountpoint":str(mountpoint)}
+	)
+
+	if not util_steps_check(
+			steps,_STEP_OWNED,
+			lambda:fsutil_partitions_prepared(partitions)
+		):
+
+		msg_err=fsutil_prepare_partitions(partitions)
+		if msg_err is not None:
+			return msg_err
+		util_steps_mark(filepath,steps,_STEP_OWNED)
+
+	fsutil_registry_record(
+		filepath,
+		{
+			"state":_STATE_MOUNTED,
+			"mountpoint":str(mountpoint),
+		}
+	)
+
+	return None
+
+@util_image_locked
+def main_mount(
+		filepath:Path,
+		mpoint:Path,
+		snapshots:bool=False,
+		encrypt:Optional[Path]=None
+	)->Optional[str]:
+
+	# The keyfile of an encrypted image is remembered, a different one can be given (if it was moved for example)
+
+	if encrypt is not None:
+		msg_err=fsutil_set_keyfile(filepath,encrypt)
+		if msg_err is not None:
+			return msg_err
+
+	res=fsutil_volume_device(filepath,attach=True)
+	if res[0]==_ERR:
+		return res[1]
+	fse_dev=res[0]
+
+	if encrypt is not None:
+		res=fsutil_volume_partitions(filepath,fse_dev)
+		if res[0]==_ERR:
+			return res[1]
+		fsutil_crypt_check(filepath,fse_dev)
+
+	if snapshots:
+		msg_err=fsutil_enable_origins(filepath,fse_dev)
+		if msg_err is not None:
+			return msg_err
+
+	res=fsutil_volume_partitions(filepath,fse_dev)
+	if res[0]==_ERR:
+		return res[1]
+
+	msg_err=fsutil_mount_partitions(res[0],mpoint)
+	if msg_err is not None:
+		return msg_err
+
+	# The loop devices may be new ones, so the I/O rules are applied again
+
+	msg_err=fsutil_io_apply(filepath)
+	if msg_err is not None:
+		return msg_err
+
+	fsutil_registry_record(
+		filepath,
+		{
+			"state":_STATE_MOUNTED,
+			"mountpoint":str(mpoint),
+		}
+	)
+
+	return None
+
+@util_image_locked
+def main_setup(
+		filepath:Path,
+		mongo_data:Path,
+		mongo_logs:Path,
+		tenant:Optional[str]=None,
+		index_file:Optional[Path]=None,
+		databases:Optional[list]=None,
+		mongod_conf:Optional[Path]=None
+	)->Optional[str]:
+
+	# For a shared volume, the directories of the given tenant are bound
+	# With an index image (given now, or remembered from before), its directories are bound on top of the data directory, for mongod to keep the indexes there
+	# With a path to mongod.conf, the paths and the layout of the indexes are set in it
+
+	res=fsutil_volume_device(filepath)
+	if res[0]==_ERR:
+		return res[1]
+	fse_dev=res[0]
+
+	res=fsutil_volume_partitions(filepath,fse_dev)
+	if res[0]==_ERR:
+		return "at least ONE partition should be here"
+	partitions=res[0]
+
+	msg_err=fsutil_mount_partitions(
+		partitions,
+		Path(_DIR_MOUNT_DEFAULT)
+	)
+	if msg_err is not None:
+		return msg_err
+
+	res=fsutil_tenant_pairs(
+		filepath,
+		partitions,
+		mongo_data,
+		mongo_logs,
+		tenant=tenant
+	)
+	if res[0]==_ERR:
+		return res[1]
+
+	msg_err=fsutil_setup_binds(res[0])
+	if msg_err is not None:
+		return msg_err
+
+	res=fsutil_index_pairs(
+		filepath,
+		mongo_data,
+		index_file=index_file,
+		databases=databases
+	)
+	if res[0]==_ERR:
+		return res[1]
+
+	msg_err=fsutil_setup_binds(res[0])
+	if msg_err is not None:
+		return msg_err
+
+	if mongod_conf is not None:
+		index=util_read_descriptor(filepath).get("index")
+		msg_err=fsutil_mongod_conf(
+			mongod_conf,
+			mongo_data,
+			mongo_logs,
+			directory_per_db=(index is not None and index["databases"] is not None)
+		)
+		if msg_err is not None:
+			return msg_err
+
+	fsutil_registry_record(
+		filepath,
+		{
+			"state":_STATE_SETUP,
+			"mongo_data":str(mongo_data),
+			"mongo_logs":str(mongo_logs),
+			"tenant":tenant,
+		}
+	)
+
+	return None
+
+@util_image_locked
+def main_clean(
+		filepath:Path,
+		autoclear:bool=False
+	)->Optional[str]:
+
+	# Given a path to a regular file, checks for any loop devices it is linked to, and it detatches the file from them
+	# For a stripe set, the same is done for every member, and the stripe is removed first
+	# For an ephemeral volume, the tmpfs is unmounted, and its contents are gone
+	# If autoclear, the loop devices go away by themselves once their last mount is gone, even if the clean fails midway
+
+	# A snapshot is discarded, the copy-on-write files are deleted
+	# The index image (if any) is cleaned too
+
+	desc=util_read_descriptor(filepath)
+
+	# The index image is bound on top of the data directory, so it goes first
+
+	index=desc.get("index")
+	if index is not None:
+		msg_err=main_clean(Path(index["file"]),autoclear=autoclear)
+		if msg_err is not None:
+			return util_msg_err("failed to clean the index image",msg_err)
+
+	ephemeral=desc.get("ephemeral")
+	if ephemeral is not None:
+		if not fun_unmount_source(ephemeral["name"],_FSTYPE_TMPFS):
+			return "failed to unmount the ephemeral volume"
+
+	# The I/O rules of the loop devices are cleared, the next image to get them should not inherit them
+
+	msg_err=fsutil_io_apply(filepath,loops_only=True,clear=True)
+	if msg_err is not None:
+		print(msg_err)
+
+	files=fsutil_volume_files(filepath)
+	snapshot=desc.get("snapshot")
+	if snapshot is not None:
+		files.extend(
+			[Path(entry["cow"]) for entry in snapshot["entries"]]
+		)
+
+	if not fun_deep_detatch_all(
+			files,
+			autoclear=autoclear
+		):
+
+		return "failed to detatch from loopback device(s)"
+
+	if snapshot is not None:
+		msg_err=fsutil_snapshot_release(filepath,snapshot["entries"])
+		if msg_err is not None:
+			return msg_err
+
+	fsutil_registry_record(
+		filepath,
+		{"state":_STATE_CLEAN},
+		create=False
+	)
+
+	return None
+
+@util_image_locked
+def main_destroy(filepath:Path)->Optional[str]:
+
+	# Deletes a detached image: every file it is made of, and the files kept next to it
+
+	targets=fsutil_volume_files(filepath)
+	for kind in (_SIDECAR_MANIFEST,_SIDECAR_VOLUME,_SIDECAR_STEPS):
+		targets.append(
+			util_sidecar_path(filepath,kind)
+		)
+
+	for target in targets:
+		if not target.exists():
+			continue
+		try:
+			target.unlink()
+		except Exception as exc:
+			return util_msg_err(
+				"failed to delete",
+				f"{target}: {exc}"
+			)
+
+	if not util_registry_update(filepath,None):
+		print("Unable to update the registry:",_REGISTRY_PATH)
+
+	return None
+
+@util_image_locked
+def main_shrink(
+		filepath:Path,
+		target_size:Optional[int]=None,
+		headroom:float=_SHRINK_HEADROOM,
+		estimate_only:bool=False
+	)->Union[Mapping,str]:
+
+	# Shrinks a detached plain image with a single partition
+	# → the filesystem is checked, and resized to its minimum size plus the headroom (or to fit in the target size of the image)
+	# → the free blocks are discarded, which punches holes in the image where they were
+	# → the partition ends where the filesystem ends, and the image is truncated there
+	# The estimate is printed before anything is changed, with estimate_only that is all there is
+	# The estimate is made without checking the filesystem first (nothing is written), so it may be off for a filesystem that needs fixing
+
+	desc=util_read_descriptor(filepath)
+	for kind in ("ephemeral","stripe","cache","crypt","snapshot"):
+		if desc.get(kind) is not None:
+			return "only plain images can be shrunk"
+
+	if not filepath.is_file():
+		return "the image does not exist"
+	if not cmd_losetup_get_devices(filepath,get_quantity=True)==0:
+		return "the image is attached, run the clean command first"
+
+	entries=util_mbr_partitions(filepath)
+	if entries is None:
+		return "the image has no MBR partition table"
+	if not len(entries)==1:
+		return "only images with a single partition can be shrunk"
+	entry=entries[0]
+	offset=entry["start"]*_MBR_SECTOR_SIZE
+
+	time_start=monotonic()
+
+	fse_part=cmd_losetup_attach(
+		filepath,
+		offset=offset,
+		sizelimit=entry["sectors"]*_MBR_SECTOR_SIZE,
+		readonly=estimate_only
+	)
+	if fse_part is None:
+		return "failed to attach the partition"
+
+	try:
+		if not estimate_only:
+			if not cmd_e2fsck(fse_part)<4:
+				return "the filesystem has errors that could not be fixed"
+
+		res=fsutil_shrink_plan(
+			filepath,entry,fse_part,
+			target_size=target_size,
+			headroom=headroom
+		)
+		if res[0]==_ERR:
+			return res[1]
+		plan=res[0]
+
+		print(
+			"\nEstimate:\n"+json_dumps(plan,indent=1)
+		)
+		if estimate_only:
+			return {"estimate":plan}
+
+		if plan["target_blocks"]<plan["blocks"]:
+			if not cmd_resize2fs(fse_part,plan["target_blocks"]):
+				return "failed to resize the filesystem"
+
+		if not cmd_e2fsck(fse_part,discard=True)<4:
+			return "the filesystem check after resizing failed"
+
+	finally:
+		cmd_losetup_detatch(fse_part)
+
+	if not util_mbr_resize_partition(
+			filepath,
+			entry["index"],
+			(plan["target_size"]-offset)//_MBR_SECTOR_SIZE
+		):
+		return "failed to resize the partition"
+
+	try:
+		os_truncate(filepath,plan["target_size"])
+	except Exception as exc:
+		return util_msg_err(
+			"failed to truncate the image",
+			f"{exc}"
+		)
+
+	# The creation journal has to agree with the new size, or a new run of the creation would start over
+
+	fse_steps=util_sidecar_path(filepath,_SIDECAR_STEPS)
+	steps=util_read_json(fse_steps)
+	if steps is not None and _STEP_ALLOCATED in steps["details"].keys():
+		steps["details"][_STEP_ALLOCATED].update({"size":plan["target_size"]})
+		util_write_json(fse_steps,steps)
+
+	fstat=filepath.stat()
+
+	return {
+		"estimate":plan,
+		"size":fstat.st_size,
+		"allocated":fstat.st_blocks*512,
+		"seconds":monotonic()-time_start,
+	}
+
+@util_image_locked
+def main_archive(
+		filepath:Path,
+		output:Path,
+		fstype:str=_FSTYPE_SQUASHFS,
+		compressor:Optional[str]=None
+	)->Union[Mapping,str]:
+
+	# Packs a detached plain image into an archive: a compressed read-only filesystem image (SquashFS or EROFS) with the same contents
+	# The partitions are attached read-only on their own and mounted read-only, and their directories are bound into one staging directory, which is what gets packed
+	# The image is left as it is, and the archive can be mounted and set up like an image
+
+	if fstype not in _FSTYPES_ARCHIVE:
+		return f"unknown archive type: {fstype}"
+
+	desc=util_read_descriptor(filepath)
+	for kind in ("ephemeral","stripe","cache","crypt","snapshot"):
+		if desc.get(kind) is not None:
+			return "only plain images can be archived"
+
+	if not filepath.is_file():
+		return "the image does not exist"
+	if fsutil_archive_fstype(filepath) is not None:
+		return "the image is an archive already"
+	if not cmd_losetup_get_devices(filepath,get_quantity=True)==0:
+		return "the image is attached, run the clean command first"
+	if output.exists():
+		return "the archive exists already"
+
+	entries=util_mbr_partitions(filepath)
+	if entries is None:
+		return "the image has no MBR partition table"
+
+	time_start=monotonic()
+
+	dir_work=Path(mkdtemp(prefix="mongolical-archive-"))
+	dir_stage=dir_work.joinpath("stage")
+	loop_devices=[]
+	mounted=[]
+	used=0
+
+	try:
+		for entry in entries:
+			fse_part=cmd_losetup_attach(
+				filepath,
+				offset=entry["start"]*_MBR_SECTOR_SIZE,
+				sizelimit=entry["sectors"]*_MBR_SECTOR_SIZE,
+				readonly=True
+			)
+			if fse_part is None:
+				return "failed to attach a partition"
+			loop_devices.append(fse_part)
+
+			sb=util_ext4_superblock(fse_part)
+			if sb is None:
+				return "a partition does not hold an ext4 filesystem"
+			if sb["needs_recovery"]:
+				return "the journal of a partition has to be replayed first (mount the image and clean it)"
+			used=used+(sb["blocks"]-sb["free_blocks"])*sb["block_size"]
+
+			dir_part=dir_work.joinpath(f"part{entry['index']}")
+			if not cmd_mount_path(
+					fse_part,dir_part,
+					spec_mode="ro",
+					ensure_dest=True,
+					options="noload",
+					fs_type=_FSTYPE_EXT4
+				):
+				return "failed to mount a partition"
+			mounted.append(dir_part)
+
+			for name in _ARCHIVE_DIRS:
+				src=dir_part.joinpath(name)
+				if not src.is_dir():
+					continue
+				dest=dir_stage.joinpath(name)
+				if dest in mounted:
+					return f"more than one partition has a {name} directory"
+				if not cmd_mount_path(src,dest,ensure_dest=True):
+					return f"failed to bind the {name} directory"
+				mounted.append(dest)
+
+		if not dir_stage.joinpath("data").is_dir():
+			return "the image has no data directory"
+
+		print("\nPacking:",fstype,output)
+
+		try:
+			if fstype==_FSTYPE_SQUASHFS:
+				built=cmd_mksquashfs(dir_stage,output,compressor)
+			else:
+				built=cmd_mkfs_erofs(dir_stage,output,compressor)
+		except Exception as exc:
+			print("Unhandled exception:",exc)
+			built=False
+
+		if not built:
+			if output.exists():
+				output.unlink()
+			return "failed to build the archive"
+
+	finally:
+		unmounted=True
+		for target in reversed(mounted):
+			if not cmd_umount(target):
+				unmounted=False
+		for fse_part in loop_devices:
+			cmd_losetup_detatch(fse_part)
+
+		# Nothing is removed while something may still be mounted in there
+
+		if unmounted:
+			rmtree(dir_work,ignore_errors=True)
+		else:
+			print("Left in place, something is still mounted:",dir_work)
+
+	if not util_update_descriptor(
+			output,
+			{
+				"archive":{
+					"fstype":fstype,
+					"compressor":compressor,
+					"source":str(filepath),
+					"created":int(time()),
+				}
+			}
+		):
+		print("Unable to write the volume descriptor of the archive")
+
+	size=output.stat().st_size
+
+	return {
+		"archive":str(output),
+		"fstype":fstype,
+		"used":used,
+		"size":size,
+		"ratio":None if used==0 else round(size/used,3),
+		"seconds":round(monotonic()-time_start,3),
+	}
+
+@util_image_locked
+def main_export(
+		filepath:Path,
+		output:Union[Path,BinaryIO],
+		codec:str=_CODEC_NONE,
+		chunk_size:int=_SPARSE_CHUNK_SIZE,
+		workers:int=4
+	)->Optional[str]:
+
+	# Streams a detached disk image as a sparse stream, to a file or to an already open file object (stdout for example)
+	# An output file that is left incomplete by a failure is removed
+
+	if not filepath.is_file():
+		return "the image does not exist"
+
+	if not 0<chunk_size<=_SPARSE_CHUNK_SIZE_MAX:
+		return f"the chunk size must be above 0 and up to {_SPARSE_CHUNK_SIZE_MAX}"
+
+	loop_devices=util_sysfs_loop_devices(filepath)
+	if loop_devices is None:
+		loop_devices=cmd_losetup_get_devices(filepath)
+	if not len(loop_devices)==0:
+		return "the file is attached, run the clean command first"
+
+	if isinstance(output,Path):
+		if output.exists():
+			return "the output file already exists"
+		with open(output,"wb") as fobj:
+			result=fun_sparse_export(
+				filepath,fobj,
+				codec=codec,
+				chunk_size=chunk_size,
+				workers=workers
+			)
+		if isinstance(result,str):
+			output.unlink(missing_ok=True)
+	else:
+		result=fun_sparse_export(
+			filepath,output,
+			codec=codec,
+			chunk_size=chunk_size,
+			workers=workers
+		)
+
+	if isinstance(result,str):
+		return result
+
+	print("\nExported:",result)
+
+	return None
+
+def main_import(
+		source:Union[Path,BinaryIO],
+		filepath:Path,
+		workers:int=4
+	)->Optional[str]:
+
+	# Rebuilds a sparse disk image from a file or an already open file object (stdin for example)
+	# The result can be attached right away with the mount command
+
+	if filepath.exists():
+		return "the path is already occupied"
+
+	filepath.parent.mkdir(
+		exist_ok=True,
+		parents=True
+	)
+
+	with util_lock_image(filepath):
+		if isinstance(source,Path):
+			if not source.is_file():
+				return "the stream file does not exist"
+			with open(source,"rb") as fobj:
+				result=fun_sparse_import(
+					fobj,filepath,
+					workers=workers
+				)
+		else:
+			result=fun_sparse_import(
+				source,filepath,
+				workers=workers
+			)
+
+	if isinstance(result,str):
+		return result
+
+	print("\nImported:",result)
+
+	return None
+
+@util_image_locked
+def main_snapshot(
+		filepath:Path,
+		action:str,
+		hook:Optional[Path]=None,
+		output:Optional[Union[Path,BinaryIO]]=None,
+		codec:str=_CODEC_NONE,
+		workers:int=4
+	)->Optional[str]:
+
+	# Manages the snapshot of a mounted volume
+	# → create: takes a snapshot, exposed as a read-only device for each partition
+	# → export: streams the snapshot out as a sparse stream (with several partitions, one file per partition, named after the role)
+	# → merge: rolls the volume back to the snapshot
+	# → discard: drops the snapshot
+
+	if action not in _SNAPSHOT_ACTIONS:
+		return f"unknown action: {action}"
+
+	if action==_SNAPSHOT_CREATE:
+		return fsutil_snapshot_create(filepath,hook=hook)
+
+	snapshot=util_read_descriptor(filepath).get("snapshot")
+	if snapshot is None:
+		return "there is no snapshot"
+	entries=snapshot["entries"]
+
+	if action==_SNAPSHOT_MERGE:
+		return fsutil_snapshot_merge(filepath,entries)
+
+	if action==_SNAPSHOT_DISCARD:
+		return fsutil_snapshot_discard(filepath,entries)
+
+	if output is None:
+		return "the stream is missing"
+
+	if (not isinstance(output,Path)) and len(entries)>1:
+		return "the snapshot has several partitions, the stream must be a file"
+
+	for entry in entries:
+		fse_snap=f"/dev/mapper/{entry['snap']}"
+		if not Path(fse_snap).exists():
+			return f"the snapshot device is gone: {fse_snap}"
+
+		if isinstance(output,Path):
+			output_ok=output
+			if len(entries)>1:
+				output_ok=output.with_name(f"{output.name}.{entry['role']}")
+			if output_ok.exists():
+				return f"the output file already exists: {output_ok}"
+			with open(output_ok,"wb") as fobj:
+				result=fun_sparse_export(
+					fse_snap,fobj,
+					codec=codec,
+					workers=workers
+				)
+		else:
+			result=fun_sparse_export(
+				fse_snap,output,
+				codec=codec,
+				workers=workers
+			)
+
+		if isinstance(result,str):
+			return result
+
+		print("\nExported:",entry["role"],result)
+
+	return None
+
+@util_image_locked
+def main_io(
+		filepath:Path,
+		cgroup:Optional[Path]=None,
+		io_max:Optional[Mapping]=None,
+		weight:Optional[int]=None,
+		latency:Optional[int]=None,
+		clear:bool=False
+	)->Optional[str]:
+
+	# Sets the I/O rules of an image for a cgroup (the one mongod runs in): bandwidth and IOPS caps, weight and latency target
+	# They are kept in the volume descriptor, applied right away if the image is attached, and again on every mount
+	# The settings that are not given keep their previous values
+	# If clear, the rules are removed
+
+	policy=util_read_descriptor(filepath).get("io")
+
+	if clear:
+		if policy is None:
+			return None
+
+		# The rules of a cgroup that was removed went away with it
+
+		if Path(policy["cgroup"]).is_dir():
+			msg_err=fsutil_io_apply(filepath,clear=True)
+			if msg_err is not None:
+				return msg_err
+		if not util_update_descriptor(filepath,{"io":None}):
+			return "failed to write the volume descriptor"
+		return None
+
+	if policy is None:
+		if cgroup is None:
+			return "the cgroup is missing"
+		policy_ok={
+			"cgroup":None,
+			"max":None,
+			"weight":None,
+			"latency":None,
+		}
+	else:
+		policy_ok=dict(policy)
+
+	if cgroup is not None:
+		cgroup_ok=util_cgroup_path(cgroup)
+		if cgroup_ok is None:
+			return "there is no cgroup v2 hierarchy"
+		if not cgroup_ok.is_dir():
+			return f"the cgroup does not exist: {cgroup_ok}"
+		policy_ok.update({"cgroup":str(cgroup_ok)})
+	if io_max is not None:
+		io_max_ok=dict(policy_ok["max"] or {})
+		io_max_ok.update(io_max)
+		policy_ok.update({"max":io_max_ok})
+	if weight is not None:
+		if not 1<=weight<=10000:
+			return "the weight must be between 1 and 10000"
+		policy_ok.update({"weight":weight})
+	if latency is not None:
+		policy_ok.update({"latency":latency})
+
+	if not util_update_descriptor(filepath,{"io":policy_ok}):
+		return "failed to write the volume descriptor"
+
+	# Rules that cannot be applied are not kept, they would fail again on every mount
+
+	msg_err=fsutil_io_apply(filepath)
+	if msg_err is not None:
+		util_update_descriptor(filepath,{"io":policy})
+		return msg_err
+
+	return None
+
+@util_image_locked
+def main_tenant(
+		filepath:Path,
+		name:str,
+		max_bytes:Optional[int]=None,
+		max_inodes:Optional[int]=None,
+		remove:bool=False
+	)->Optional[str]:
+
+	# Adds a tenant to a mounted shared volume: a directory tree (data and logs) with a project ID of its own, capped at the given size and inode count
+	# For a tenant that exists, only the limits that are given are changed (0 removes a limit)
+	# If remove, the limits are removed and the directory tree of the tenant is deleted, as long as it is not bound anywhere
+
+	name_ok=util_tenant_name(name)
+	if name_ok is None:
+		return f"invalid tenant name: {name}"
+
+	res=fsutil_shared_root(filepath)
+	if res[0]==_ERR:
+		return res[1]
+	fse_part,dir_tenants=res
+
+	tenants=dict(util_read_descriptor(filepath)["shared"]["tenants"])
+	tenant=tenants.get(name_ok)
+	dir_tenant=dir_tenants.joinpath(name_ok)
+
+	if remove:
+		if tenant is None:
+			return f"the tenant does not exist: {name_ok}"
+
+		targets=fsutil_tenant_binds(fse_part,name_ok)
+		if len(targets)>0:
+			return util_msg_err(
+				"the tenant is still bound",
+				"\n".join(targets)
+			)
+
+		if not libc_quota_set_project(fse_part,tenant["project"])==0:
+			return "failed to remove the limits of the tenant"
+
+		if dir_tenant.exists():
+			try:
+				rmtree(dir_tenant)
+			except Exception as exc:
+				return util_msg_err(
+					"failed to delete",
+					f"{dir_tenant}: {exc}"
+				)
+
+		tenants.pop(name_ok)
+		if not util_update_descriptor(filepath,{"shared":{"tenants":tenants}}):
+			return "failed to write the volume descriptor"
+
+		return None
+
+	if tenant is None:
+
+		# The project ID is set before the data and logs directories are made, so they inherit it
+
+		project_id=1+max(
+			[t["project"] for t in tenants.values()],
+			default=0
+		)
+		tenant={
+			"project":project_id,
+			"max_bytes":None,
+			"max_inodes":None,
+		}
+
+		dir_tenant.mkdir(parents=True,exist_ok=True)
+		if not libc_set_project(dir_tenant,project_id)==0:
+			return "failed to set the project ID of the tenant"
+
+		msg_err=fsutil_prepare_dirs(dir_tenant)
+		if msg_err is not None:
+			return msg_err
+
+	tenant=dict(tenant)
+	if max_bytes is not None:
+		tenant.update({"max_bytes":max_bytes or None})
+	if max_inodes is not None:
+		tenant.update({"max_inodes":max_inodes or None})
+
+	if not libc_quota_set_project(
+			fse_part,
+			tenant["project"],
+			max_bytes=tenant["max_bytes"],
+			max_inodes=tenant["max_inodes"]
+		)==0:
+
+		return "failed to set the limits of the tenant"
+
+	tenants.update({name_ok:tenant})
+	if not util_update_descriptor(filepath,{"shared":{"tenants":tenants}}):
+		return "failed to write the volume descriptor"
+
+	return None
+
+def main_warm(
+		filepath:Optional[Path],
+		mongo_data:Optional[Path]=None,
+		warm_list:Optional[Path]=None,
+		budget:Optional[int]=None,
+		workers:int=4
+	)->Union[Mapping,str]:
+
+	# Reads the WiredTiger files of a mounted volume into the page cache, so the first queries after a mount do not go to the disk
+	# The files are taken from the given data directory (the bind mount for example), or from the volume itself
+	# The image is not locked: this only reads, and it may take a while under a budget
+
+	data_dir=mongo_data
+	if data_dir is None:
+		if filepath is None:
+			return "the file or the data directory is needed"
+		res=fsutil_data_dir(filepath)
+		if res[0]==_ERR:
+			return res[1]
+		data_dir=res[0]
+
+	res=fsutil_warm_files(data_dir,warm_list)
+	if res[0]==_ERR:
+		return res[1]
+	files=res[0]
+
+	print("\nFiles to warm up:",len(files))
+
+	return fun_warm_files(
+		files,
+		budget=budget,
+		workers=workers
+	)
+
+def main_logs_compact(
+		filepath:Optional[Path],
+		mongo_logs:Optional[Path]=None,
+		codec:str=_CODEC_ZLIB,
+		archive:Optional[Path]=None,
+		max_bytes:Optional[int]=None,
+		budget:Optional[int]=None,
+		workers:int=_LOGS_WORKERS
+	)->Union[Mapping,str]:
+
+	# Compresses the rotated mongod logs of a mounted volume in the background (see fun_compress_files), and deletes the originals
+	# The logs are taken from the given logs directory (the bind mount for example), or from the volume itself (every tenant of a shared volume)
+	# With an archive directory, the compressed logs are moved there (one subdirectory per tenant)
+	# With a limit (bytes), the oldest compressed logs are deleted until the rest fit
+	# The image is not locked: mongod keeps writing its log while this runs
+
+	if codec not in _CODEC_FILES.keys():
+		return f"unknown codec: {codec}"
+
+	logs_dirs=[]
+	if mongo_logs is not None:
+		logs_dirs.append(mongo_logs)
+	else:
+		if filepath is None:
+			return "the file or the logs directory is needed"
+		res=fsutil_logs_dirs(filepath)
+		if res[0]==_ERR:
+			return res[1]
+		logs_dirs.extend(res[0])
+
+	results={}
+	for logs_dir in logs_dirs:
+		dest_dir=archive
+		if archive is not None and len(logs_dirs)>1:
+			dest_dir=archive.joinpath(logs_dir.parent.name)
+		if dest_dir is not None:
+			try:
+				dest_dir.mkdir(exist_ok=True,parents=True)
+			except Exception as exc:
+				return util_msg_err(
+					"failed to create the archive directory",
+					f"{dest_dir}: {exc}"
+				)
+
+		res=fsutil_logs_rotated(logs_dir,dest_dir)
+		if res[0]==_ERR:
+			return res[1]
+
+		print("\nLogs to compress:",logs_dir,len(res[0]))
+
+		result=fun_compress_files(
+			res[0],
+			codec=codec,
+			dest_dir=dest_dir,
+			budget=budget,
+			workers=workers
+		)
+		if isinstance(result,str):
+			return result
+
+		deleted=[]
+		if max_bytes is not None:
+			res=fsutil_logs_rotated(logs_dir,dest_dir)
+			if not res[0]==_ERR:
+				deleted=fsutil_logs_limit(res[1],max_bytes)
+
+		result.update({"deleted":deleted})
+		results.update({str(logs_dir):result})
+
+	return results
+
+def main_bench(
+		filepath:Path,
+		file_size:int=_BENCH_FILE_SIZE,
+		duration:float=_BENCH_DURATION,
+		workers:int=4,
+		report:Optional[Path]=None
+	)->Union[Mapping,str]:
+
+	# Runs a WiredTiger-shaped workload on a mounted volume, and returns (and optionally writes) the results as JSON
+	# The layers of the volume and the mount options are included, to compare presets on the same host
+
+	res=fsutil_bench_dirs(filepath)
+	if res[0]==_ERR:
+		return res[1]
+	dir_data,dir_journal,volume=res
+
+	desc=util_read_descriptor(filepath)
+
+	bench_dirs=[dir_data.joinpath(_BENCH_DIR)]
+	if not dir_journal==dir_data:
+		bench_dirs.append(dir_journal.joinpath(_BENCH_DIR))
+	for bench_dir in bench_dirs:
+		bench_dir.mkdir(exist_ok=True)
+
+	data_file=bench_dirs[0].joinpath("collection-bench.wt")
+	journal_file=bench_dirs[-1].joinpath("WiredTigerLog.bench")
+
+	try:
+		result=fun_io_bench(
+			data_file,
+			journal_file,
+			file_size=file_size,
+			duration=duration,
+			readers=workers
+		)
+	finally:
+		for fse in (data_file,journal_file):
+			if fse.exists():
+				fse.unlink()
+		for bench_dir in bench_dirs:
+			if bench_dir.exists():
+				bench_dir.rmdir()
+
+	if isinstance(result,str):
+		return result
+
+	result={
+		"file":realpath(str(filepath)),
+		"layers":[
+			kind for kind in ("stripe","cache","crypt","origins","ephemeral")
+			if desc.get(kind) is not None
+		],
+		"volume":volume,
+		"results":result,
+	}
+
+	if report is not None:
+		if not util_write_json(report,result):
+			return "failed to write the report"
+
+	return result
+
+@util_image_locked
+def main_verify(
+		filepath:Path,
+		chunk_size:int=_HASH_CHUNK_SIZE,
+		workers:int=4,
+		incremental:bool=False
+	)->Optional[str]:
+
+	# Checks a detached disk image against the manifest stored next to it
+	# → if there is no manifest, the image is hashed and the manifest is written
+	# → if there is one, the image is hashed again and every chunk is compared
+	# → if incremental and the image was not modified since (same size and times), the digests of the manifest are kept instead of reading the image again
+	# Incremental mode is only a fast path for an image that was not written to at all: after any write (mounting it is enough) everything is hashed again, it does not find the chunks that changed
+	# Incremental mode can not detect corruption that leaves the times of the file as they were (writes to the device underneath, for example), only a full check can
+	# The manifest is only written again (to record the new times) once every chunk matches
+
+	if not filepath.is_file():
+		return "the image does not exist"
+
+	loop_devices=util_sysfs_loop_devices(filepath)
+	if loop_devices is None:
+		loop_devices=cmd_losetup_get_devices(filepath)
+	if not len(loop_devices)==0:
+		return "the file is attached, run the clean command first"
+
+	path_manifest=util_sidecar_path(filepath,_SIDECAR_MANIFEST)
+	manifest=util_read_json(path_manifest)
+
+	if manifest is not None:
+		chunk_size=manifest.get("chunk_size",chunk_size)
+
+	if not isinstance(chunk_size,int) or not chunk_size>0:
+		return f"invalid chunk size: {chunk_size}"
+
+	result=fun_hash_file(
+		filepath,
+		chunk_size=chunk_size,
+		workers=workers,
+		previous=(manifest if incremental else None)
+	)
+	if isinstance(result,str):
+		return result
+
+	print(
+		"\nChunks hashed:",result["hashed"],
+		"\nChunks reused:",result["reused"],
+		"\nRoot:",result["root"]
+	)
+
+	if incremental and result["reused"]>0:
+		print("\nNOTE: the reused chunks were not read, corruption that left the times of the file untouched would go unnoticed")
+
+	if manifest is not None:
+
+		if not manifest.get("size")==result["size"]:
+			return util_msg_err(
+				"the image does not match its manifest",
+				f"size: {result['size']} (expected {manifest.get('size')})"
+			)
+
+		mismatched=[]
+		old_chunks=manifest.get("chunks",[])
+		for idx,chunk in enumerate(result["chunks"]):
+			if idx<len(old_chunks):
+				if old_chunks[idx].get("digest")==chunk["digest"]:
+					continue
+			mismatched.append(idx)
+
+		if len(mismatched)>0 or (not manifest.get("root")==result["root"]):
+			return util_msg_err(
+				"the image does not match its manifest",
+				f"chunks (of {chunk_size} bytes): {mismatched}"
+			)
+
+		print("\nThe image matches its manifest")
+
+		if manifest.get("mtime_ns")==result["mtime_ns"] and manifest.get("ctime_ns")==result["ctime_ns"]:
+			return None
+
+	if not util_write_json(
+			path_manifest,
+			{
+				"image":filepath.name,
+				"algorithm":result["algorithm"],
+				"size":result["size"],
+				"chunk_size":result["chunk_size"],
+				"mtime_ns":result["mtime_ns"],
+				"ctime_ns":result["ctime_ns"],
+				"root":result["root"],
+				"chunks":result["chunks"],
+			}
+		):
+		return "failed to write the manifest"
+
+	print("\nManifest written:",str(path_manifest))
+
+	return None
+
+def main_status(
+		filepath:Path,
+		topology:Optional[Mapping]=None
+	)->Union[Mapping,str]:
+
+	# Gets the loop devices, partitions and mountpoints (bind mounts included) of a disk image
+	# A topology from fun_get_topology can be given to avoid reading it again
+
+	if topology is None:
+		topology=fun_get_topology()
+	if topology is None:
+		return "unable to read the loop devices and the mount table"
+
+	fse_real=realpath(str(filepath))
+	loop_devices=topology.get(fse_real,[])
+
+	result={
+		"file":fse_real,
+		"exists":Path(fse_real).exists(),
+		"attached":len(loop_devices)>0,
+		"loop_devices":loop_devices,
+	}
+
+	stripe=util_read_descriptor(filepath).get("stripe")
+	if stripe is not None:
+		fse_dev=f"/dev/mapper/{stripe['name']}"
+		members=[]
+		for member in stripe["members"]:
+			members.append({
+				"file":member,
+				"loop_devices":topology.get(member,[]),
+			})
+		result.update({
+			"stripe":{
+				"device":fse_dev,
+				"assembled":Path(fse_dev).exists(),
+				"chunk_size":stripe["chunk_size"],
+				"members":members,
+			}
+		})
+
+	ephemeral=util_read_descriptor(filepath).get("ephemeral")
+	if ephemeral is not None:
+		mounts=[]
+		for m in (util_read_mountinfo() or []):
+			if m["source"]==ephemeral["name"] and m["fstype"]==_FSTYPE_TMPFS:
+				mounts.append({
+					"target":m["target"],
+					"root":m["root"],
+				})
+		result.update({
+			"ephemeral":{
+				"source":ephemeral["name"],
+				"size":ephemeral["size"],
+				"mounts":mounts,
+			}
+		})
+
+	cache=util_read_descriptor(filepath).get("cache")
+	if cache is not None:
+		fse_dev=f"/dev/mapper/{cache['name']}"
+		stats=None
+		if Path(fse_dev).exists():
+			stats=util_parse_dm_cache_status(
+				cmd_dmsetup_status(cache["name"])
+			)
+		result.update({
+			"cache":{
+				"device":fse_dev,
+				"assembled":Path(fse_dev).exists(),
+				"file":cache["file"],
+				"mode":cache["mode"],
+				"loop_devices":topology.get(cache["file"],[]),
+				"stats":stats,
+			}
+		})
+
+	fstype=fsutil_archive_fstype(filepath)
+	if fstype is not None:
+		archive=util_read_descriptor(filepath).get("archive") or {}
+		result.update({
+			"archive":{
+				"fstype":fstype,
+				"source":archive.get("source"),
+				"created":archive.get("created"),
+			}
+		})
+
+	index=util_read_descriptor(filepath).get("index")
+	if index is not None:
+		result.update({
+			"index":{
+				"file":index["file"],
+				"databases":index["databases"],
+				"mountpoint":index.get("mountpoint"),
+				"attached":len(topology.get(realpath(index["file"]),[]))>0,
+			}
+		})
+
+	shared=util_read_descriptor(filepath).get("shared")
+	if shared is not None:
+		res=fsutil_shared_root(filepath)
+		tenants={}
+		for name,tenant in shared["tenants"].items():
+			usage=None
+			targets=[]
+			if not res[0]==_ERR:
+				usage=libc_quota_get_project(res[0],tenant["project"])
+				targets=fsutil_tenant_binds(res[0],name)
+			tenants.update({
+				name:{
+					"project":tenant["project"],
+					"max_bytes":tenant["max_bytes"],
+					"max_inodes":tenant["max_inodes"],
+					"usage":usage,
+					"binds":targets,
+				}
+			})
+		result.update({
+			"shared":{
+				"tenants":tenants,
+			}
+		})
+
+	policy=util_read_descriptor(filepath).get("io")
+	if policy is not None:
+		majmin_list=fsutil_io_devices(filepath)
+		result.update({
+			"io":{
+				"policy":policy,
+				"devices":majmin_list,
+				"applied":fun_cgroup_io_read(
+					Path(policy["cgroup"]),
+					majmin_list
+				),
+			}
+		})
+
+	crypt=util_read_descriptor(filepath).get("crypt")
+	if crypt is not None:
+		result.update({
+			"crypt":{
+				"cipher":crypt["cipher"],
+				"sector_size":crypt["sector_size"],
+				"keyfile":crypt["keyfile"],
+				"devices":{
+					role:{
+						"device":f"/dev/mapper/{name}",
+						"open":Path(f"/dev/mapper/{name}").exists(),
+					}
+					for role,name in crypt["names"].items()
+				},
+			}
+		})
+
+	origins=util_read_descriptor(filepath).get("origins")
+	if origins is not None:
+		result.update({
+			"origins":{
+				role:{
+					"device":f"/dev/mapper/{name}",
+					"assembled":Path(f"/dev/mapper/{name}").exists(),
+				}
+				for role,name in origins.items()
+			}
+		})
+
+	snapshot=util_read_descriptor(filepath).get("snapshot")
+	if snapshot is not None:
+		entries=[]
+		for entry in snapshot["entries"]:
+			fse_snap=f"/dev/mapper/{entry['snap']}"
+			stats=None
+			if Path(fse_snap).exists():
+				stats=util_parse_dm_snapshot_status(
+					cmd_dmsetup_status(entry["snap"])
+				)
+			entries.append({
+				"role":entry["role"],
+				"device":fse_snap,
+				"cow":entry["cow"],
+				"stats":stats,
+			})
+		result.update({
+			"snapshot":{
+				"created":snapshot["created"],
+				"entries":entries,
+			}
+		})
+
+	return result
+
+def util_registry_live()->tuple:
+
+	# Reads the registry, the loop devices and the mount table, once for all the images
+
+	topology=fun_get_topology()
+	mounts=util_read_mountinfo()
+	if topology is None or mounts is None:
+		return (_ERR,"unable to read the loop devices and the mount table")
+
+	registry=util_registry_read()
+	live={
+		fse_real:fsutil_volume_mounts(Path(fse_real),topology,mounts)
+		for fse_real in registry.keys()
+	}
+
+	return (registry,live,topology)
+
+def main_status_all()->Union[Mapping,str]:
+
+	# Gets the state of every registered image, and whether it is in the state it should be in (drift)
+	# The files attached as loop devices that do not belong to any registered image are listed too, they may not be images at all
+
+	res=util_registry_live()
+	if res[0]==_ERR:
+		return res[1]
+	registry,live,topology=res
+
+	images={}
+	files_known=[]
+	for fse_real,entry in registry.items():
+		filepath=Path(fse_real)
+		files_known.extend(
+			[realpath(str(fse)) for fse in fsutil_volume_files(filepath)]
+		)
+		snapshot=util_read_descriptor(filepath).get("snapshot")
+		if snapshot is not None:
+			files_known.extend(
+				[realpath(entry_snap["cow"]) for entry_snap in snapshot["entries"]]
+			)
+
+		images.update({
+			fse_real:{
+				"state":entry.get("state"),
+				"live":live[fse_real],
+				"drift":not live[fse_real]["state"]==entry.get("state"),
+				"mountpoint":entry.get("mountpoint"),
+				"mongo_data":entry.get("mongo_data"),
+				"mongo_logs":entry.get("mongo_logs"),
+				"tenant":entry.get("tenant"),
+				"seen":entry.get("seen"),
+				"updated":entry.get("updated"),
+			}
+		})
+
+	return {
+		"registry":_REGISTRY_PATH,
+		"images":images,
+		"unregistered":sorted(
+			[fse for fse in topology.keys() if fse not in files_known]
+		),
+	}
+
+def main_mount_all(files:Optional[list]=None)->Union[Mapping,str]:
+
+	# Brings every registered image (or only those among the given files) back to the state it should be in (after a reboot for example): mounted, or mounted and set up
+	# The images that are in that state already are left alone, and one that fails does not stop the others
+	# The images that the last check found in need of repair are held back (see main_check)
+	# The state each image should be in is kept, even if bringing it there failed
+
+	res=util_registry_live()
+	if res[0]==_ERR:
+		return res[1]
+	registry,live,_=res
+
+	files_real=None
+	if files is not None:
+		files_real=[realpath(str(fse)) for fse in files]
+
+	results={}
+	for fse_real,entry in registry.items():
+		if files_real is not None and fse_real not in files_real:
+			continue
+
+		filepath=Path(fse_real)
+		state=entry.get("state")
+		state_live=live[fse_real]["state"]
+
+		actions=[]
+		if state in (_STATE_MOUNTED,_STATE_SETUP):
+			if state_live in (_STATE_CLEAN,_STATE_ATTACHED):
+				actions.append(_CMD_MOUNT)
+		if state==_STATE_SETUP and not state_live==_STATE_SETUP:
+			actions.append(_CMD_SETUP)
+
+		check=entry.get("check")
+		if len(actions)>0 and check is not None:
+			if check["result"] in (_CHECK_NEEDS_REPAIR,_CHECK_FAILED):
+				results.update({
+					fse_real:{
+						"state":state,
+						"was":state_live,
+						"actions":[],
+						"error":f"held back, the last check result was: {check['result']} (check it again once repaired)",
+					}
+				})
+				continue
+
+		msg_err=None
+		if _CMD_MOUNT in actions:
+			msg_err=main_mount(
+				filepath,
+				Path(entry.get("mountpoint") or _DIR_MOUNT_DEFAULT)
+			)
+
+		if msg_err is None and _CMD_SETUP in actions:
+			msg_err=main_setup(
+				filepath,
+				Path(entry.get("mongo_data") or _DIR_DEFAULT_DATA),
+				Path(entry.get("mongo_logs") or _DIR_DEFAULT_LOGS),
+				tenant=entry.get("tenant")
+			)
+
+		if len(actions)>0:
+			if not util_registry_update(filepath,{"state":state}):
+				print("Unable to update the registry:",_REGISTRY_PATH)
+
+		results.update({
+			fse_real:{
+				"state":state,
+				"was":state_live,
+				"actions":actions,
+				"error":msg_err,
+			}
+		})
+
+	return results
+
+def main_check(
+		files:Optional[list]=None,
+		per_disk:int=_CHECK_PER_DISK,
+		workers:int=_CHECK_WORKERS
+	)->Union[Mapping,str]:
+
+	# Checks many detached images at once (the given ones, or every registered image) before they are mounted, after an unclean shutdown for example
+	# At most per_disk checks run at the same time on each host disk, and the images are taken from each disk in turn, so every disk is kept busy
+	# Returns the result of each image, and the images grouped by result
+
+	registry=util_registry_read()
+	if files is None:
+		files=[Path(fse_real) for fse_real in registry.keys()]
+	if len(files)==0:
+		return "there are no images to check"
+
+	groups={}
+	for fse in files:
+		disk=util_backing_majmin(fse)
+		if disk not in groups.keys():
+			groups.update({disk:[]})
+		groups[disk].append(fse)
+
+	order=[]
+	queues=[
+		[(disk,fse) for fse in group]
+		for disk,group in groups.items()
+	]
+	while any(len(queue)>0 for queue in queues):
+		for queue in queues:
+			if len(queue)>0:
+				order.append(queue.pop(0))
+
+	limits={
+		disk:Semaphore(max(1,per_disk))
+		for disk in groups.keys()
+	}
+
+	def check(job:tuple)->Mapping:
+		disk,fse=job
+		with limits[disk]:
+			result=fsutil_check_image(fse)
+		result.update({"disk":disk})
+		return result
+
+	time_start=monotonic()
+
+	with ThreadPoolExecutor(
+			max_workers=max(1,workers)
+		) as pool:
+		results=list(pool.map(check,order))
+
+	summary={
+		outcome:[]
+		for outcome in (_CHECK_CLEAN,_CHECK_NEEDS_REPLAY,_CHECK_NEEDS_REPAIR,_CHECK_FAILED,_CHECK_SKIPPED)
+	}
+	for result in results:
+		summary[result["result"]].append(result["file"])
+
+		# Skipped images keep the result of their last check
+
+		fse_real=realpath(result["file"])
+		if fse_real not in registry.keys() or result["result"]==_CHECK_SKIPPED:
+			continue
+		if not util_registry_update(
+				Path(fse_real),
+				{"check":{"result":result["result"],"time":int(time())}}
+			):
+			print("Unable to update the registry:",_REGISTRY_PATH)
+
+	return {
+		"images":results,
+		"summary":summary,
+		"seconds":round(monotonic()-time_start,3),
+	}
+
+def main_clean_all(autoclear:bool=False)->Union[Mapping,str]:
+
+	# Cleans every registered image that is attached, mounted or set up
+	# The state each image should be in is kept, so mount-all brings them all back
+
+	res=util_registry_live()
+	if res[0]==_ERR:
+		return res[1]
+	registry,live,_=res
+
+	results={}
+	for fse_real,entry in registry.items():
+		filepath=Path(fse_real)
+		state=entry.get("state")
+		state_live=live[fse_real]["state"]
+
+		actions=[]
+		if not state_live==_STATE_CLEAN:
+			actions.append(_CMD_CLEAN)
+
+		msg_err=None
+		if _CMD_CLEAN in actions:
+			msg_err=main_clean(filepath,autoclear=autoclear)
+			if not util_registry_update(filepath,{"state":state}):
+				print("Unable to update the registry:",_REGISTRY_PATH)
+
+		results.update({
+			fse_real:{
+				"state":state,
+				"was":state_live,
+				"actions":actions,
+				"error":msg_err,
+			}
+		})
+
+	return results
+
+# API
+
+class MongolicalError(Exception):
+	pass
+
+class VolumeState:
+
+	# What is known about a volume once it has been resolved: the loop device, its partitions, where the volume is mounted and the bind mounts on top of it
+
+	__slots__=(
+		"filepath",
+		"loopdev",
+		"partitions",
+		"mountpoint",
+		"binds",
+	)
+
+	def __init__(self,filepath:Path):
+		self.filepath:Path=filepath
+		self.loopdev:Optional[str]=None
+		self.partitions:Optional[list]=None
+		self.mountpoint:Optional[Path]=None
+		self.binds:tuple=()
+
+	def forget(self):
+		self.loopdev=None
+		self.partitions=None
+		self.mountpoint=None
+		self.binds=()
+
+	def as_dict(self)->Mapping:
+		return {
+			"file":str(self.filepath),
+			"loopdev":self.loopdev,
+			"partitions":self.partitions,
+			"mountpoint":(None if self.mountpoint is None else str(self.mountpoint)),
+			"binds":[(str(p[0]),str(p[1])) for p in self.binds],
+		}
+
+class MongoVolume:
+
+	# Programmatic access to a disk image, for callers that manage many volumes in one process
+	# The devices are discovered once and remembered, so calls after the first one do not run losetup or lsblk again
+	# Errors are raised as MongolicalError
+
+	__slots__=("state",)
+
+	def __init__(self,filepath:Union[str,Path]):
+		self.state=VolumeState(
+			Path(realpath(util_path_to_str(filepath)))
+		)
+
+	def __repr__(self)->str:
+		return f"MongoVolume({str(self.state.filepath)!r})"
+
+	def _check(self,msg_err:Optional[str]):
+		if msg_err is not None:
+			raise MongolicalError(msg_err)
+
+	def _unwrap(self,res:tuple)->tuple:
+		if res[0]==_ERR:
+			raise MongolicalError(res[1])
+		return res
+
+	@util_volume_locked
+	def create(
+			self,
+			size:str,
+			mountpoint:Union[str,Path]=_DIR_MOUNT_DEFAULT,
+			journal_size:Optional[int]=None,
+			stripe_with:Optional[list]=None,
+			chunk_size:int=_STRIPE_CHUNK_SIZE,
+			cache_file:Optional[Union[str,Path]]=None,
+			cache_size:Optional[str]=None,
+			cache_mode:str=_CACHE_MODE_WRITETHROUGH,
+			ephemeral:bool=False,
+			snapshots:bool=False,
+			encrypt:Optional[Union[str,Path]]=None,
+			shared:bool=False
+		)->"MongoVolume":
+
+		# Creates the image, attaches it, partitions and formats it, and mounts it
+		# If ephemeral, a tmpfs capped at the given size is mounted instead
+		# With a keyfile to encrypt with, dm-crypt is put between the partitions and the filesystems
+		# If shared, project quotas are turned on, for the tenants to be added later
+
+		if shared:
+			if ephemeral:
+				raise MongolicalError("an ephemeral volume can not be shared")
+			if journal_size is not None:
+				raise MongolicalError("a shared volume can not have a separate journal partition")
+
+		if cache_file is not None:
+			if journal_size is not None:
+				raise MongolicalError("a cached volume can not have a separate journal partition")
+			if stripe_with is not None and len(stripe_with)>0:
+				raise MongolicalError("a stripe set can not be cached")
+			if cache_size is None:
+				raise MongolicalError("the size of the cache is missing")
+
+		if encrypt is not None:
+			if ephemeral or cache_file is not None:
+				raise MongolicalError("only plain images can be encrypted")
+			if stripe_with is not None and len(stripe_with)>0:
+				raise MongolicalError("only plain images can be encrypted")
+
+		self._check(
+			util_check_journal_size(size,journal_size)
+		)
+
+		if ephemeral:
+			if journal_size is not None or cache_file is not None:
+				raise MongolicalError("an ephemeral volume has no partitions or cache")
+			if stripe_with is not None and len(stripe_with)>0:
+				raise MongolicalError("an ephemeral volume can not be striped")
+			self.state.loopdev=self._unwrap(
+				fsutil_create_ephemeral(self.state.filepath,size)
+			)[0]
+
+		elif stripe_with is not None and len(stripe_with)>0:
+			if journal_size is not None:
+				raise MongolicalError("a stripe set can not have a separate journal partition")
+			self.state.loopdev=self._unwrap(
+				fsutil_create_stripe(
+					self.state.filepath,size,
+					[Path(m) for m in stripe_with],
+					chunk_size
+				)
+			)[0]
+
+		else:
+			self._check(
+				fsutil_create_file(self.state.filepath,size)
+			)
+			self.attach()
+
+			self._unwrap(
+				fsutil_format_loopdevice(
+					self.state.loopdev,
+					journal_size=journal_size
+				)
+			)
+
+			if encrypt is not None:
+				self._check(
+					fsutil_create_crypt(
+						self.state.filepath,
+						self.state.loopdev,
+						Path(encrypt)
+					)
+				)
+				fsutil_crypt_check(
+					self.state.filepath,
+					self.state.loopdev
+				)
+
+			if cache_file is not None:
+				self.state.loopdev=self._unwrap(
+					fsutil_create_cache(
+						self.state.filepath,
+						Path(cache_file),
+						cache_size,
+						cache_mode
+					)
+				)[0]
+
+		self.state.partitions=None
+
+		if shared:
+			self._check(
+				fsutil_enable_shared(
+					self.state.filepath,
+					self._unwrap(
+						fsutil_volume_partitions(
+							self.state.filepath,
+							self.state.loopdev
+						)
+					)[0]
+				)
+			)
+
+		self.mount(mountpoint,snapshots=snapshots)
+		self._check(
+			fsutil_prepare_partitions(self.state.partitions)
+		)
+
+		return self
+
+	@util_volume_locked
+	def attach(self)->str:
+
+		# Returns the device the volume sits on (the loop device, or the device of the stripe set), attaching the image if needed
+
+		if self.state.loopdev is not None:
+			if fsutil_device_alive(self.state.loopdev,self.state.filepath):
+				return self.state.loopdev
+			self.state.forget()
+
+		self.state.loopdev=self._unwrap(
+			fsutil_volume_device(
+				self.state.filepath,
+				attach=True
+			)
+		)[0]
+
+		return self.state.loopdev
+
+	@util_volume_locked
+	def mount(
+			self,
+			mountpoint:Optional[Union[str,Path]]=None,
+			snapshots:bool=False,
+			encrypt:Optional[Union[str,Path]]=None
+		)->Path:
+
+		# Mounts the partitions, and returns where the volume is mounted
+		# Without a mountpoint, a mounted volume stays where it is, and one that is not mounted goes to the default mountpoint
+		# A volume that is already mounted somewhere else than the given mountpoint is an error, it is not moved
+		# With snapshots, a plain image is mounted through origins, so snapshots can be taken later
+		# For an encrypted image, a different keyfile than the one remembered can be given
+
+		if encrypt is not None:
+			self._check(
+				fsutil_set_keyfile(self.state.filepath,Path(encrypt))
+			)
+
+		self.attach()
+
+		if snapshots:
+			self._check(
+				fsutil_enable_origins(
+					self.state.filepath,
+					self.state.loopdev
+				)
+			)
+
+		if self.state.partitions is not None and self.state.mountpoint is not None:
+			if mountpoint is None or realpath(str(mountpoint))==realpath(str(self.state.mountpoint)):
+				if all(cmd_mountpoint(p["mountpoint"]) for p in self.state.partitions):
+					return self.state.mountpoint
+
+		# What is mounted already is found out again, a cached handle and a new one see the same
+
+		self.state.partitions=self._unwrap(
+			fsutil_volume_partitions(
+				self.state.filepath,
+				self.state.loopdev
+			)
+		)[0]
+
+		for part in self.state.partitions:
+			if part["mountpoint"] is None:
+				continue
+
+			mounted=Path(part["mountpoint"])
+			if part["subdir"] is not None:
+				mounted=mounted.parent
+
+			if mountpoint is None:
+				mountpoint=mounted
+			if not realpath(str(mountpoint))==realpath(str(mounted)):
+				raise MongolicalError(
+					util_msg_err(
+						"the volume is already mounted somewhere else, tear it down first",
+						f"{mounted}"
+					)
+				)
+
+		if mountpoint is None:
+			mountpoint=_DIR_MOUNT_DEFAULT
+
+		mpoint=Path(mountpoint)
+		self._check(
+			fsutil_mount_partitions(self.state.partitions,mpoint)
+		)
+		self._check(
+			fsutil_io_apply(self.state.filepath)
+		)
+
+		fsutil_registry_record(
+			self.state.filepath,
+			{
+				"state":_STATE_MOUNTED,
+				"mountpoint":str(mpoint),
+			}
+		)
+
+		self.state.mountpoint=mpoint
+		return mpoint
+
+	@util_volume_locked
+	def bind(
+			self,
+			mongo_data:Union[str,Path]=_DIR_DEFAULT_DATA,
+			mongo_logs:Union[str,Path]=_DIR_DEFAULT_LOGS,
+			tenant:Optional[str]=None,
+			index_file:Optional[Union[str,Path]]=None,
+			databases:Optional[list]=None,
+			mongod_conf:Optional[Union[str,Path]]=None
+		)->tuple:
+
+		# Bind mounts the data, journal and logs directories to where MongoDB expects them
+		# For a shared volume, those of the given tenant
+		# With an index image, its directories are bound too, and mongod.conf is patched if given
+
+		if self.state.mountpoint is None:
+			self.mount()
+
+		pairs=self._unwrap(
+			fsutil_tenant_pairs(
+				self.state.filepath,
+				self.state.partitions,
+				Path(mongo_data),
+				Path(mongo_logs),
+				tenant=tenant
+			)
+		)[0]
+		self._check(
+			fsutil_setup_binds(pairs)
+		)
+
+		index_pairs=self._unwrap(
+			fsutil_index_pairs(
+				self.state.filepath,
+				Path(mongo_data),
+				index_file=None if index_file is None else Path(index_file),
+				databases=databases
+			)
+		)[0]
+		self._check(
+			fsutil_setup_binds(index_pairs)
+		)
+		pairs=pairs+index_pairs
+
+		if mongod_conf is not None:
+			index=util_read_descriptor(self.state.filepath).get("index")
+			self._check(
+				fsutil_mongod_conf(
+					Path(mongod_conf),
+					Path(mongo_data),
+					Path(mongo_logs),
+					directory_per_db=(index is not None and index["databases"] is not None)
+				)
+			)
+
+		fsutil_registry_record(
+			self.state.filepath,
+			{
+				"state":_STATE_SETUP,
+				"mongo_data":str(mongo_data),
+				"mongo_logs":str(mongo_logs),
+				"tenant":tenant,
+			}
+		)
+
+		self.state.binds=tuple(pairs)
+		return self.state.binds
+
+	@util_volume_locked
+	def teardown(
+			self,
+			destroy:bool=False,
+			autoclear:bool=False
+		):
+
+		# Unmounts everything, detaches the loop device(s), and optionally deletes the image
+
+		self._check(
+			main_clean(
+				self.state.filepath,
+				autoclear=autoclear
+			)
+		)
+		self.state.forget()
+
+		if destroy:
+			self._check(
+				main_destroy(self.state.filepath)
+			)
+
+	def snapshot(
+			self,
+			action:str=_SNAPSHOT_CREATE,
+			hook:Optional[Union[str,Path]]=None,
+			output:Optional[Union[Path,BinaryIO]]=None
+		):
+
+		# Creates, exports, merges or discards the snapshot of the volume
+		# After a merge the volume is unmounted, and it has to be mounted again
+
+		self._check(
+			main_snapshot(
+				self.state.filepath,
+				action,
+				hook=None if hook is None else Path(hook),
+				output=output
+			)
+		)
+
+		if action==_SNAPSHOT_MERGE:
+			self.state.forget()
+
+	def warm(
+			self,
+			warm_list:Optional[Union[str,Path]]=None,
+			budget:Optional[int]=None,
+			workers:int=4
+		)->Mapping:
+
+		# Reads the WiredTiger files into the page cache, and returns how much was brought in
+
+		if self.state.mountpoint is None:
+			self.mount()
+
+		result=main_warm(
+			self.state.filepath,
+			warm_list=None if warm_list is None else Path(warm_list),
+			budget=budget,
+			workers=workers
+		)
+		if isinstance(result,str):
+			raise MongolicalError(result)
+
+		return result
+
+	def logs_compact(
+			self,
+			codec:str=_CODEC_ZLIB,
+			archive:Optional[Union[str,Path]]=None,
+			max_bytes:Optional[int]=None,
+			budget:Optional[int]=None,
+			workers:int=_LOGS_WORKERS
+		)->Mapping:
+
+		# Compresses the rotated mongod logs, and returns what was done in each logs directory
+
+		if self.state.mountpoint is None:
+			self.mount()
+
+		result=main_logs_compact(
+			self.state.filepath,
+			codec=codec,
+			archive=None if archive is None else Path(archive),
+			max_bytes=max_bytes,
+			budget=budget,
+			workers=workers
+		)
+		if isinstance(result,str):
+			raise MongolicalError(result)
+
+		return result
+
+	def bench(
+			self,
+			file_size:int=_BENCH_FILE_SIZE,
+			duration:float=_BENCH_DURATION,
+			workers:int=4
+		)->Mapping:
+
+		# Runs the WiredTiger-shaped benchmark on the volume
+
+		if self.state.mountpoint is None:
+			self.mount()
+
+		result=main_bench(
+			self.state.filepath,
+			file_size=file_size,
+			duration=duration,
+			workers=workers
+		)
+		if isinstance(result,str):
+			raise MongolicalError(result)
+
+		return result
+
+	def shrink(
+			self,
+			target_size:Optional[int]=None,
+			headroom:float=_SHRINK_HEADROOM,
+			estimate_only:bool=False
+		)->Mapping:
+
+		# Shrinks the image, it must be torn down first
+
+		result=main_shrink(
+			self.state.filepath,
+			target_size=target_size,
+			headroom=headroom,
+			estimate_only=estimate_only
+		)
+		if isinstance(result,str):
+			raise MongolicalError(result)
+
+		return result
+
+	def archive(
+			self,
+			output:Union[str,Path],
+			fstype:str=_FSTYPE_SQUASHFS,
+			compressor:Optional[str]=None
+		)->"MongoVolume":
+
+		# Packs the image into an archive, it must be torn down first, and returns the archive as a volume
+
+		result=main_archive(
+			self.state.filepath,
+			Path(output),
+			fstype=fstype,
+			compressor=compressor
+		)
+		if isinstance(result,str):
+			raise MongolicalError(result)
+
+		return MongoVolume(output)
+
+	def tenant(
+			self,
+			name:str,
+			max_bytes:Optional[int]=None,
+			max_inodes:Optional[int]=None,
+			remove:bool=False
+		):
+
+		# Adds a tenant to the shared volume, changes its limits, or removes it
+
+		if self.state.mountpoint is None:
+			self.mount()
+
+		self._check(
+			main_tenant(
+				self.state.filepath,
+				name,
+				max_bytes=max_bytes,
+				max_inodes=max_inodes,
+				remove=remove
+			)
+		)
+
+	def set_io(
+			self,
+			cgroup:Optional[Union[str,Path]]=None,
+			io_max:Optional[Mapping]=None,
+			weight:Optional[int]=None,
+			latency:Optional[int]=None,
+			clear:bool=False
+		):
+
+		# Sets (or clears) the I/O rules of the volume for a cgroup
+
+		self._check(
+			main_io(
+				self.state.filepath,
+				cgroup=None if cgroup is None else Path(cgroup),
+				io_max=io_max,
+				weight=weight,
+				latency=latency,
+				clear=clear
+			)
+		)
+
+	def status(self)->Mapping:
+
+		result=main_status(self.state.filepath)
+		if isinstance(result,str):
+			raise MongolicalError(result)
+
+		return {
+			"state":self.state.as_dict(),
+			"live":result,
+		}
+
+# AGENT
+
+def util_agent_topology(state:Mapping)->Optional[Mapping]:
+
+	# Returns the cached topology, reading it again only if something changed since the last time
+
+	with state["lock"]:
+		if state["stale"] or (state["topology"] is None):
+			state.update({
+				"topology":fun_get_topology(),
+				"stale":False
+			})
+
+		return state["topology"]
+
+def util_agent_entries(fse_real:str)->Optional[list]:
+
+	# The loop devices of a backing file in the cached topology of the agent, each one checked against sysfs
+	# The cache may be behind what the current request just did, so what it says is only trusted if sysfs agrees
+	# Returns None when not running as an agent, or when the cache knows no device of the file (it may have been attached since)
+
+	state=_AGENT_SHARED["state"]
+	if state is None:
+		return None
+
+	topology=util_agent_topology(state)
+	if topology is None:
+		return None
+
+	entries=topology.get(fse_real,[])
+	if len(entries)==0:
+		return None
+
+	for entry in entries:
+		sysfs=util_sysfs_entry(entry["path"])
+		if not util_sysfs_read(sysfs,"loop/backing_file")==fse_real:
+			return None
+		if not util_sysfs_read(sysfs,"dev")==entry["majmin"]:
+			return None
+
+	return entries
+
+def util_agent_loopdevices(filepath:Path)->Optional[list]:
+
+	# Same as cmd_losetup_get_devices, through the cached topology of the agent
+	# Returns None if it has to be looked up the slow way
+
+	entries=util_agent_entries(realpath(str(filepath)))
+	if entries is None:
+		return None
+
+	return [
+		{"name":entry["path"]}
+		for entry in entries
+	]
+
+def util_agent_partitions(fse_loopdev:str)->Optional[list]:
+
+	# Same as the partitions listed by lsblk (path, label, mountpoint), through the cached topology of the agent
+	# Only which partitions there are comes from the cache: the labels are read from the superblocks, the mountpoints from the mount table as it is now
+	# Returns None if it has to be looked up the slow way
+
+	backfile=util_sysfs_read(util_sysfs_entry(fse_loopdev),"loop/backing_file")
+	if backfile is None:
+		return None
+
+	entries=util_agent_entries(backfile)
+	if entries is None:
+		return None
+
+	found=[entry for entry in entries if entry["path"]==fse_loopdev]
+	if not len(found)==1 or len(found[0]["partitions"])==0:
+		return None
+
+	mounts=util_read_mountinfo()
+	if mounts is None:
+		return None
+
+	lst=[]
+	for part in found[0]["partitions"]:
+		if not util_sysfs_read(util_sysfs_entry(part["path"]),"dev")==part["majmin"]:
+			return None
+
+		sb=util_ext4_superblock(part["path"])
+		if sb is None:
+			return None
+
+		# Like lsblk, the mountpoint of the filesystem itself comes before its binds
+
+		targets=sorted(
+			[m for m in mounts if m["majmin"]==part["majmin"]],
+			key=lambda m:not m["root"]=="/"
+		)
+
+		lst.append({
+			"path":part["path"],
+			"label":sb["label"],
+			"mountpoint":targets[0]["target"] if len(targets)>0 else None,
+		})
+
+	return lst
+
+def util_agent_volume(state:Mapping,filepath:Path)->tuple:
+
+	# Returns the lock and the volume handle of an image
+	# Operations on the same image are serialized, operations on different images run in parallel
+
+	key=realpath(str(filepath))
+	with state["lock"]:
+		if key not in state["images"].keys():
+			state["images"].update({
+				key:(Lock(),MongoVolume(key))
+			})
+		return state["images"][key]
+
+def util_agent_watch(state:Mapping):
+
+	# Marks the cached topology as stale whenever the mount table changes or the kernel reports a block device event
+	# The topology is also refreshed periodically, in case an event is missed
+
+	poller=select_poll()
+
+	fobj_mountinfo=open("/proc/self/mountinfo","rb")
+	fobj_mountinfo.read()
+	poller.register(fobj_mountinfo,POLLPRI|POLLERR)
+
+	sock_uevent:Optional[socket]=None
+	try:
+		sock_uevent=socket(AF_NETLINK,SOCK_DGRAM,_NETLINK_KOBJECT_UEVENT)
+		sock_uevent.bind((0,1))
+		poller.register(sock_uevent,POLLIN)
+	except Exception as exc:
+		print("Block device events not available:",exc)
+		sock_uevent=None
+
+	while True:
+		for fd,_ in poller.poll(_AGENT_REFRESH_SECONDS*1000):
+			if fd==fobj_mountinfo.fileno():
+				fobj_mountinfo.seek(0)
+				fobj_mountinfo.read()
+			if sock_uevent is not None:
+				if fd==sock_uevent.fileno():
+					sock_uevent.recv(65536)
+
+		with state["lock"]:
+			state.update({"stale":True})
+
+def util_agent_text(
+		request:Mapping,
+		field:str,
+		low:bool=False
+	)->Optional[str]:
+
+	# A text field of a request (a path, a name, a size), None if it is not there
+	# JSON numbers are taken as text too, so "size": 10485760 is the same as "size": "10485760"
+
+	value=request.get(field)
+	if value is None:
+		return None
+
+	if isinstance(value,bool) or not isinstance(value,(str,int,float)):
+		raise MongolicalError(f"invalid value for {field}: {json_dumps(value)}")
+
+	return util_fixstring(str(value),low=low)
+
+def util_agent_size(
+		request:Mapping,
+		field:str
+	)->Optional[int]:
+
+	# A size field of a request, in bytes or with a unit ("4M"), None if it is not there
+
+	raw=util_agent_text(request,field)
+	if raw is None:
+		return None
+
+	size=util_parse_size(raw)
+	if size is None or not size>0:
+		raise MongolicalError(f"invalid value for {field}: {raw}")
+
+	return size
+
+def util_agent_count(
+		request:Mapping,
+		field:str
+	)->Optional[int]:
+
+	# A whole number field of a request (0 or more), None if it is not there
+
+	raw=util_agent_text(request,field)
+	if raw is None:
+		return None
+
+	if not raw.isdigit():
+		raise MongolicalError(f"invalid value for {field}: {raw}")
+
+	return int(raw)
+
+def util_agent_flag(
+		request:Mapping,
+		field:str
+	)->bool:
+
+	# A true/false field of a request, false if it is not there
+
+	value=request.get(field,False)
+	if not isinstance(value,bool):
+		raise MongolicalError(f"invalid value for {field}, true or false is expected: {json_dumps(value)}")
+
+	return value
+
+def util_agent_list(
+		request:Mapping,
+		field:str
+	)->Optional[list]:
+
+	# A list of texts field of a request, None if it is not there
+
+	value=request.get(field)
+	if value is None:
+		return None
+
+	if not isinstance(value,list) or not all(isinstance(item,str) for item in value):
+		raise MongolicalError(f"invalid value for {field}, a list of texts is expected: {json_dumps(value)}")
+
+	return value
+
+def util_agent_dispatch(
+		state:Mapping,
+		request:Mapping
+	)->Mapping:
+
+	# Runs one request from a client of the agent
+	# Requests have a "command" and the same parameters as the command line, without the dashes: "file", "size", "journal_size", "stripe_with" (a list), "chunk_size", "cache_file", "cache_size", "cache_mode", "ephemeral", "snapshots", "encrypt" (a keyfile), "autoclear", "action", "hook", "stream", "target", "path_data", "path_logs", "shared", "tenant", "quota", "inodes", "remove", "index_file", "databases" (a list), "mongod_conf"
+
+	command=util_agent_text(request,"command",low=True)
+	if command not in _AGENT_COMMANDS:
+		return {
+			"ok":False,
+			"error":f"unknown command: {command}"
+		}
+
+	file=util_agent_text(request,"file")
+	if file is None:
+		return {
+			"ok":False,
+			"error":"the file is missing"
+		}
+
+	filepath=Path(file)
+	if not filepath.is_absolute():
+		return {
+			"ok":False,
+			"error":"the file must be an absolute path"
+		}
+
+	if command==_CMD_STATUS:
+		result=main_status(
+			filepath,
+			topology=util_agent_topology(state)
+		)
+		if isinstance(result,str):
+			return {
+				"ok":False,
+				"error":result
+			}
+		return {
+			"ok":True,
+			"status":result
+		}
+
+	# Malformed fields are reported by name, before anything is done
+
+	target=util_agent_text(request,"target")
+	path_mongo_data=Path(util_agent_text(request,"path_data") or _DIR_DEFAULT_DATA)
+	path_mongo_logs=Path(util_agent_text(request,"path_logs") or _DIR_DEFAULT_LOGS)
+
+	msg_err:Optional[str]=None
+
+	lock,volume=util_agent_volume(state,filepath)
+	with lock:
+
+		try:
+			if command==_CMD_NEW:
+				file_size=util_agent_text(request,"size")
+				if file_size is None:
+					raise MongolicalError("the size is missing")
+				if util_parse_size(file_size) is None:
+					raise MongolicalError(f"invalid value for size: {file_size}")
+				cache_size=util_agent_text(request,"cache_size")
+				if cache_size is not None and util_parse_size(cache_size) is None:
+					raise MongolicalError(f"invalid value for cache_size: {cache_size}")
+				volume.create(
+					file_size,
+					target or _DIR_MOUNT_DEFAULT,
+					journal_size=util_agent_size(request,"journal_size"),
+					stripe_with=util_agent_list(request,"stripe_with"),
+					chunk_size=(util_agent_size(request,"chunk_size") or _STRIPE_CHUNK_SIZE),
+					cache_file=util_agent_text(request,"cache_file"),
+					cache_size=cache_size,
+					cache_mode=(util_agent_text(request,"cache_mode",low=True) or _CACHE_MODE_WRITETHROUGH),
+					ephemeral=util_agent_flag(request,"ephemeral"),
+					snapshots=util_agent_flag(request,"snapshots"),
+					encrypt=util_agent_text(request,"encrypt"),
+					shared=util_agent_flag(request,"shared")
+				)
+
+			if command==_CMD_MOUNT:
+				volume.mount(
+					None if target is None else Path(target),
+					snapshots=util_agent_flag(request,"snapshots"),
+					encrypt=util_agent_text(request,"encrypt")
+				)
+
+			if command==_CMD_SETUP:
+				volume.bind(
+					path_mongo_data,
+					path_mongo_logs,
+					tenant=util_agent_text(request,"tenant"),
+					index_file=util_agent_text(request,"index_file"),
+					databases=util_agent_list(request,"databases"),
+					mongod_conf=util_agent_text(request,"mongod_conf")
+				)
+
+			if command==_CMD_TENANT:
+				volume.tenant(
+					util_agent_text(request,"tenant"),
+					max_bytes=util_agent_size(request,"quota"),
+					max_inodes=util_agent_count(request,"inodes"),
+					remove=util_agent_flag(request,"remove")
+				)
+
+			if command==_CMD_CLEAN:
+				volume.teardown(
+					autoclear=util_agent_flag(request,"autoclear")
+				)
+
+			if command==_CMD_SNAPSHOT:
+				stream=util_agent_text(request,"stream")
+				volume.snapshot(
+					util_agent_text(request,"action",low=True) or _SNAPSHOT_CREATE,
+					hook=util_agent_text(request,"hook"),
+					output=None if stream is None else Path(stream)
+				)
+
+		except MongolicalError as exc:
+			msg_err=f"{exc}"
+
+		with state["lock"]:
+			state.update({"stale":True})
+
+	return {
+		"ok":(msg_err is None),
+		"error":msg_err
+	}
+
+class AgentRequestHandler(StreamRequestHandler):
+
+	# One JSON object per line in, one JSON object per line out
+
+	def handle(self):
+		for line in self.rfile:
+			if len(line.strip())==0:
+				continue
+
+			try:
+				request=json_loads(line)
+				if not isinstance(request,Mapping):
+					raise ValueError("the request must be an object")
+				response=util_agent_dispatch(
+					self.server.agent_state,
+					request
+				)
+			except Exception as exc:
+				response={
+					"ok":False,
+					"error":f"{exc}"
+				}
+
+			self.wfile.write(
+				json_dumps(response).encode()+b"\n"
+			)
+			self.wfile.flush()
+
+def util_agent_request(
+		request:Mapping,
+		socket_path:Union[str,Path]=_AGENT_SOCKET_DEFAULT
+	)->Mapping:
+
+	# Sends one request to a running agent and waits for the response
+
+	with socket(AF_UNIX,SOCK_STREAM) as sock:
+		sock.connect(util_path_to_str(socket_path))
+		sock.sendall(
+			json_dumps(request).encode()+b"\n"
+		)
+		data=b""
+		while not data.endswith(b"\n"):
+			chunk=sock.recv(65536)
+			if not chunk:
+				break
+			data=data+chunk
+
+	return json_loads(data)
+
+def main_agent(socket_path:Path)->Optional[str]:
+
+	# Keeps running, serving requests through a Unix domain socket, so callers do not pay for the startup and the discovery every time
+
+	if socket_path.exists():
+		if not S_ISSOCK(socket_path.stat().st_mode):
+			return "the path is already occupied and not by a socket"
+		socket_path.unlink()
+
+	socket_path.parent.mkdir(
+		exist_ok=True,
+		parents=True
+	)
+
+	state={
+		"lock":Lock(),
+		"stale":True,
+		"topology":None,
+		"images":{},
+	}
+	_AGENT_SHARED.update({"state":state})
+
+	Thread(
+		target=util_agent_watch,
+		args=(state,),
+		daemon=True
+	).start()
+
+	server=ThreadingUnixStreamServer(
+		str(socket_path),
+		AgentRequestHandler
+	)
+	server.daemon_threads=True
+	server.agent_state=state
+	os_chmod(str(socket_path),0o600)
+
+	print("\nListening on:",str(socket_path))
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		if socket_path.exists():
+			socket_path.unlink()
+
+	return None
+
+if __name__=="__main__":
+
+	import sys
+
+	from sys import (
+		argv as sys_argv,
+		exit as sys_exit
+	)
+
+	# The bulk commands work on the registered images, they take no file
+
+	if not len(sys_argv)>2 and not (len(sys_argv)==2 and util_fixstring(sys_argv[1],low=True) in (_CMD_STATUS_ALL,_CMD_MOUNT_ALL,_CMD_CLEAN_ALL,_CMD_CHECK)):
+		print(
+			"\n- MONGOLICAL -"
+			f"\nCommands: {[_CMD_NEW,_CMD_MOUNT,_CMD_SETUP,_CMD_CLEAN,_CMD_EXPORT,_CMD_IMPORT,_CMD_VERIFY,_CMD_STATUS,_CMD_AGENT,_CMD_SNAPSHOT,_CMD_WARM,_CMD_BENCH,_CMD_IO,_CMD_TENANT,_CMD_SHRINK,_CMD_STATUS_ALL,_CMD_MOUNT_ALL,_CMD_CLEAN_ALL,_CMD_LOGS_COMPACT,_CMD_CHECK,_CMD_ARCHIVE]}"
+		)
+		sys_exit(0)
+
+	cmd=util_fixstring(sys_argv[1],low=True)
+	pos_args=util_extract_pargs(cmd,sys_argv[2:])
+
+	# When the stream goes through stdout, everything else is printed to stderr
+	# export streams to stdout when no stream is given, a snapshot only streams when asked to
+
+	stdio_in=sys.stdin.buffer
+	stdio_out=sys.stdout.buffer
+
+	if cmd==_CMD_EXPORT and pos_args.get(_ARG_STREAM,_STREAM_STDIO)==_STREAM_STDIO:
+		sys.stdout=sys.stderr
+	if cmd==_CMD_SNAPSHOT and pos_args.get(_ARG_STREAM)==_STREAM_STDIO:
+		sys.stdout=sys.stderr
+	flags=[]
+	if pos_args.get(_ARG_FLAGS) is not None:
+		flags.extend(
+			util_extract_flags(
+				pos_args.get(_ARG_FLAGS)
+			)
+		)
+
+	filepath:Optional[Path]=None
+	basedir=Path(sys_argv[0]).parent
+
+	then_mount=False
 	then_setup=False
 	then_clean=False
 	then_destroy=False
+	then_warm=False
+
+	path_mpoint:Optional[Path]=None
+	path_mongo_data:Optional[Path]=None
+	path_mongo_logs:Optional[Path]=None
+	path_keyfile:Optional[Path]=None
+
+	flags=[]
+
+	if cmd==_CMD_NEW:
+
+		print("\n- Creating new virtual disk")
+
+		filepath=util_fixpath(
+			basedir,
+			pos_args[_ARG_OFILE]
+		)
+		file_size=pos_args[_ARG_SIZE]
+
+		journal_size:Optional[int]=None
+		if _ARG_JOURNAL_SIZE in pos_args.keys():
+			journal_size=util_parse_size(pos_args[_ARG_JOURNAL_SIZE])
+			if journal_size is None or not journal_size>=_JOURNAL_SIZE_MIN:
+				print("\nInvalid value for",_ARG_JOURNAL_SIZE)
+				sys_exit(1)
+
+		stripe_with=[]
+		if _ARG_STRIPE_WITH in pos_args.keys():
+			for member in pos_args[_ARG_STRIPE_WITH].split(","):
+				member_ok=util_fixstring(member)
+				if member_ok is None:
+					continue
+				stripe_with.append(
+					util_fixpath(basedir,member_ok)
+				)
+
+		stripe_chunk_size=util_parse_size(pos_args.get(_ARG_CHUNK_SIZE))
+		if stripe_chunk_size is None:
+			stripe_chunk_size=_STRIPE_CHUNK_SIZE
+
+		cache_file:Optional[Path]=None
+		if _ARG_CACHE_FILE in pos_args.keys():
+			cache_file=util_fixpath(
+				basedir,
+				pos_args[_ARG_CACHE_FILE]
+			)
+
+		cache_mode=util_fixstring(
+			pos_args.get(_ARG_CACHE_MODE,_CACHE_MODE_WRITETHROUGH),
+			low=True
+		)
+
+		if _ARG_MTARGET in pos_args.keys():
+			path_mpoint=util_fixpath(
+				basedir,
+				pos_args[_ARG_MTARGET]
+			)
+
+		if _ARG_MONGO_DATA in pos_args.keys():
+			path_mongo_data=util_fixpath(
+				basedir,
+				pos_args[_ARG_MONGO_DATA]
+			)
+			then_mount=True
+			then_setup=True
+
+		if _ARG_MONGO_LOGS in pos_args.keys():
+			path_mongo_logs=util_fixpath(
+				basedir,
+				pos_args[_ARG_MONGO_LOGS]
+			)
+			then_mount=True
+			then_setup=True
+
+		if _ARG_FLAGS in pos_args.keys():
+			flags.extend(
+				util_extract_flags(
+					pos_args[_ARG_FLAGS]
+				)
+			)
+
+		if _FLAG_SETUP in flags:
+			then_setup=True
+
+		if _FLAG_TEST in flags:
+			then_mount=True
+			then_setup=True
+			then_clean=True
+			then_destroy=True
+
+		if _ARG_ENCRYPT in pos_args.keys():
+			path_keyfile=util_fixpath(
+				basedir,
+				pos_args[_ARG_ENCRYPT]
+			)
+
+		if path_mpoint is None:
+			path_mpoint=Path(_DIR_MOUNT_DEFAULT)
+
+		print(
+			"\nParameters:"
+			f"\nFilepath: {str(filepath)}"
+			f"\nFile size: {file_size}"
+			f"\nKeyfile: {path_keyfile}"
+			f"\nJournal size: {journal_size}"
+			f"\nStripe with: {[str(m) for m in stripe_with]}"
+			f"\nCache file: {cache_file}"
+			f"\nCache mode: {cache_mode}"
+			f"\nMountpoint: {path_mpoint}"
+			f"\nShared: {_FLAG_SHARED in flags}"
+		)
+
+		msg_err=main_create(
+			filepath,
+			file_size,
+			path_mpoint,
+			journal_size=journal_size,
+			stripe_with=stripe_with,
+			chunk_size=stripe_chunk_size,
+			cache_file=cache_file,
+			cache_size=pos_args.get(_ARG_CACHE_SIZE),
+			cache_mode=cache_mode,
+			ephemeral=(_FLAG_EPHEMERAL in flags),
+			snapshots=(_FLAG_SNAPSHOTS in flags),
+			encrypt=path_keyfile,
+			shared=(_FLAG_SHARED in flags)
+		)
+		if msg_err is not None:
+			print(f"\n{msg_err}")
+
+	if cmd==_CMD_MOUNT or then_mount or then_setup:
+
+		print("\n- Mounting virtual disk")
 
-	path_mpoint:Optional[Path]=None
-	path_mongo_data:Optional[Path]=None
-	path_mongo_logs:Optional[Path]=None
+		if cmd==_CMD_MOUNT:
+
+			filepath=util_fixpath(
+				basedir,
+				pos_args[_ARG_OFILE]
+			)
+
+			if _ARG_MTARGET in pos_args.keys():
+				path_mpoint=util_fixpath(
+					basedir,
+					pos_args[_ARG_MTARGET]
+				)
+
+			if _ARG_MONGO_DATA in pos_args.keys():
+				path_mongo_data=util_fixpath(
+					basedir,
+					pos_args[_ARG_MONGO_DATA]
+				)
+				then_setup=True
+
+			if _ARG_MONGO_LOGS in pos_args.keys():
+				path_mongo_logs=util_fixpath(
+					basedir,
+					pos_args[_ARG_MONGO_LOGS]
+				)
+				then_setup=True
+
+			if _ARG_FLAGS in pos_args.keys():
+				flags.extend(
+					util_extract_flags(
+						pos_args[_ARG_FLAGS]
+					)
+				)
+
+			if _FLAG_SETUP in flags:
+				then_setup=True
+
+			if _FLAG_TEST in flags:
+				then_setup=True
+				then_clean=True
+
+			if _ARG_ENCRYPT in pos_args.keys():
+				path_keyfile=util_fixpath(
+					basedir,
+					pos_args[_ARG_ENCRYPT]
+				)
+
+		if path_mpoint is None:
+			path_mpoint=Path(_DIR_MOUNT_DEFAULT)
+
+		print(
+			"\nParameters:"
+			f"\nFilepath: {str(filepath)}"
+			f"\nMountpoint: {str(path_mpoint)}"
+		)
+
+		msg_err=main_mount(
+			filepath,
+			path_mpoint,
+			snapshots=(_FLAG_SNAPSHOTS in flags),
+			encrypt=(path_keyfile if cmd==_CMD_MOUNT else None)
+		)
+		if msg_err is not None:
+			print(f"\n{msg_err}")
+
+	if cmd==_CMD_SETUP or then_setup:
+
+		print("\n- Setting up bind mounts from the partition to the specified directories")
+
+		if cmd==_CMD_SETUP:
+
+			filepath=util_fixpath(
+				basedir,
+				pos_args[_ARG_OFILE]
+			)
+			if _ARG_MONGO_DATA in pos_args.keys():
+				path_mongo_data=util_fixpath(
+					basedir,
+					pos_args[_ARG_MONGO_DATA]
+				)
+			if _ARG_MONGO_LOGS in pos_args.keys():
+				path_mongo_logs=util_fixpath(
+					basedir,
+					pos_args[_ARG_MONGO_LOGS]
+				)
+			if _ARG_FLAGS in pos_args.keys():
+				flags.extend(
+					util_extract_flags(
+						pos_args[_ARG_FLAGS]
+					)
+				)
+
+			if _FLAG_TEST in flags:
+				then_clean=True
+
+		if path_mongo_data is None:
+			path_mongo_data=Path(_DIR_DEFAULT_DATA)
+		if path_mongo_logs is None:
+			path_mongo_logs=Path(_DIR_DEFAULT_LOGS)
+
+		tenant=pos_args.get(_ARG_TENANT)
+
+		index_file:Optional[Path]=None
+		if _ARG_INDEX_FILE in pos_args.keys():
+			index_file=util_fixpath(
+				basedir,
+				pos_args[_ARG_INDEX_FILE]
+			)
+
+		databases:Optional[list]=None
+		if _ARG_DATABASES in pos_args.keys():
+			databases=[]
+			for db in pos_args[_ARG_DATABASES].split(","):
+				db_ok=util_fixstring(db)
+				if db_ok is None:
+					continue
+				databases.append(db_ok)
+
+		mongod_conf:Optional[Path]=None
+		if _ARG_MONGOD_CONF in pos_args.keys():
+			mongod_conf=util_fixpath(
+				basedir,
+				pos_args[_ARG_MONGOD_CONF]
+			)
+
+		print(
+			"\nParameters:"
+			f"\nFilepath: {str(filepath)}"
+			f"\nMongoDB Data: {str(path_mongo_data)}"
+			f"\nMongoDB Logs: {str(path_mongo_logs)}"
+			f"\nTenant: {tenant}"
+			f"\nIndex image: {index_file}"
+			f"\nDatabases: {databases}"
+			f"\nmongod.conf: {mongod_conf}"
+		)
+
+		msg_err=main_setup(
+			filepath,
+			path_mongo_data,
+			path_mongo_logs,
+			tenant=tenant,
+			index_file=index_file,
+			databases=databases,
+			mongod_conf=mongod_conf
+		)
+		if msg_err is not None:
+			print(f"\n{msg_err}")
+
+		if (_FLAG_WARM in flags) and (msg_err is None):
+			then_warm=True
+
+	if cmd==_CMD_WARM or then_warm:
+
+		print("\n- Warming up the page cache")
+
+		if cmd==_CMD_WARM:
+
+			# Either the file or the data directory is enough
+
+			filepath=None
+			if _ARG_OFILE in pos_args.keys():
+				filepath=util_fixpath(
+					basedir,
+					pos_args[_ARG_OFILE]
+				)
+			if _ARG_MONGO_DATA in pos_args.keys():
+				path_mongo_data=util_fixpath(
+					basedir,
+					pos_args[_ARG_MONGO_DATA]
+				)
+
+		warm_list:Optional[Path]=None
+		if _ARG_WARM_LIST in pos_args.keys():
+			warm_list=util_fixpath(
+				basedir,
+				pos_args[_ARG_WARM_LIST]
+			)
+
+		budget=util_parse_size(pos_args.get(_ARG_IO_BUDGET))
+
+		print(
+			"\nParameters:"
+			f"\nFilepath: {str(filepath)}"
+			f"\nMongoDB Data: {str(path_mongo_data)}"
+			f"\nList: {warm_list}"
+			f"\nBudget (bytes per second): {budget}"
+		)
+
+		result=main_warm(
+			filepath,
+			mongo_data=path_mongo_data,
+			warm_list=warm_list,
+			budget=budget,
+			workers=util_get_workers(pos_args)
+		)
+		if isinstance(result,str):
+			print(f"\n{result}")
+		else:
+			print("\nWarmed up:",result)
+
+	if cmd==_CMD_LOGS_COMPACT:
+
+		print("\n- Compressing the rotated logs")
+
+		filepath=None
+		if _ARG_OFILE in pos_args.keys():
+			filepath=util_fixpath(
+				basedir,
+				pos_args[_ARG_OFILE]
+			)
+		if _ARG_MONGO_LOGS in pos_args.keys():
+			path_mongo_logs=util_fixpath(
+				basedir,
+				pos_args[_ARG_MONGO_LOGS]
+			)
+
+		archive:Optional[Path]=None
+		if _ARG_ARCHIVE in pos_args.keys():
+			archive=util_fixpath(
+				basedir,
+				pos_args[_ARG_ARCHIVE]
+			)
+
+		codec=pos_args.get(_ARG_COMPRESS,_CODEC_ZLIB)
+		max_bytes=util_parse_size(pos_args.get(_ARG_LOGS_MAX))
+		budget=util_parse_size(pos_args.get(_ARG_IO_BUDGET))
+
+		print(
+			"\nParameters:"
+			f"\nFilepath: {str(filepath)}"
+			f"\nMongoDB Logs: {str(path_mongo_logs)}"
+			f"\nCodec: {codec}"
+			f"\nArchive: {archive}"
+			f"\nLimit (bytes): {max_bytes}"
+			f"\nBudget (bytes per second): {budget}"
+		)
+
+		result=main_logs_compact(
+			filepath,
+			mongo_logs=path_mongo_logs,
+			codec=codec,
+			archive=archive,
+			max_bytes=max_bytes,
+			budget=budget,
+			workers=util_get_workers(pos_args,default=_LOGS_WORKERS)
+		)
+		if isinstance(result,str):
+			print(f"\n{result}")
+		else:
+			print(
+				"\n"+json_dumps(result,indent=1)
+			)
+
+	if cmd==_CMD_CLEAN or then_clean:
+
+		if cmd==_CMD_CLEAN:
+
+			filepath=util_fixpath(
+				basedir,
+				pos_args[_ARG_OFILE]
+			)
+			if _ARG_FLAGS in pos_args.keys():
+				flags.extend(
+					util_extract_flags(
+						pos_args[_ARG_FLAGS]
+					)
+				)
+
+			then_destroy=(_FLAG_DESTROY in flags)
+
+		msg_err=main_clean(
+			filepath,
+			autoclear=(_FLAG_AUTOCLEAR in flags)
+		)
+		if msg_err is not None:
+			print(f"\n{msg_err}")
+
+		if then_destroy and (msg_err is None):
+			msg_err=main_destroy(filepath)
+			if msg_err is not None:
+				print(f"\n{msg_err}")
+			if not filepath.exists():
+				print("\nFILE DESTROYED")
+
+	if cmd==_CMD_EXPORT:
+
+		print("\n- Exporting virtual disk as a sparse stream")
+
+		filepath=util_fixpath(
+			basedir,
+			pos_args[_ARG_OFILE]
+		)
+
+		stream_out:Union[Path,BinaryIO]=stdio_out
+		if not pos_args.get(_ARG_STREAM,_STREAM_STDIO)==_STREAM_STDIO:
+			stream_out=util_fixpath(
+				basedir,
+				pos_args[_ARG_STREAM]
+			)
+
+		codec=util_fixstring(
+			pos_args.get(_ARG_COMPRESS,_CODEC_NONE),
+			low=True
+		)
+
+		chunk_size=_SPARSE_CHUNK_SIZE
+		if _ARG_CHUNK_SIZE in pos_args.keys():
+			chunk_size=util_parse_size(pos_args[_ARG_CHUNK_SIZE])
+			if chunk_size is None or not 0<chunk_size<=_SPARSE_CHUNK_SIZE_MAX:
+				print("\nInvalid value for",_ARG_CHUNK_SIZE)
+				sys_exit(1)
+
+		print(
+			"\nParameters:"
+			f"\nFilepath: {str(filepath)}"
+			f"\nStream: {str(pos_args.get(_ARG_STREAM,_STREAM_STDIO))}"
+			f"\nCodec: {codec}"
+			f"\nChunk size: {chunk_size}"
+		)
+
+		msg_err=main_export(
+			filepath,
+			stream_out,
+			codec=codec,
+			chunk_size=chunk_size,
+			workers=util_get_workers(pos_args)
+		)
+		if msg_err is not None:
+			print(f"\n{msg_err}")
+
+	if cmd==_CMD_IMPORT:
+
+		print("\n- Importing virtual disk from a sparse stream")
+
+		filepath=util_fixpath(
+			basedir,
+			pos_args[_ARG_OFILE]
+		)
+
+		stream_in:Union[Path,BinaryIO]=stdio_in
+		if not pos_args.get(_ARG_STREAM,_STREAM_STDIO)==_STREAM_STDIO:
+			stream_in=util_fixpath(
+				basedir,
+				pos_args[_ARG_STREAM]
+			)
+
+		print(
+			"\nParameters:"
+			f"\nFilepath: {str(filepath)}"
+			f"\nStream: {str(pos_args.get(_ARG_STREAM,_STREAM_STDIO))}"
+		)
+
+		msg_err=main_import(
+			stream_in,
+			filepath,
+			workers=util_get_workers(pos_args)
+		)
+		if msg_err is not None:
+			print(f"\n{msg_err}")
+
+	if cmd==_CMD_VERIFY:
+
+		print("\n- Verifying virtual disk")
+
+		filepath=util_fixpath(
+			basedir,
+			pos_args[_ARG_OFILE]
+		)
+		if _ARG_FLAGS in pos_args.keys():
+			flags.extend(
+				util_extract_flags(
+					pos_args[_ARG_FLAGS]
+				)
+			)
+
+		chunk_size=_HASH_CHUNK_SIZE
+		if _ARG_CHUNK_SIZE in pos_args.keys():
+			chunk_size=util_parse_size(pos_args[_ARG_CHUNK_SIZE])
+			if chunk_size is None or not chunk_size>0:
+				print("\nInvalid value for",_ARG_CHUNK_SIZE)
+				sys_exit(1)
+
+		print(
+			"\nParameters:"
+			f"\nFilepath: {str(filepath)}"
+			f"\nChunk size: {chunk_size}"
+			f"\nIncremental (skips reading an image that was not written to since the manifest): {_FLAG_INCREMENTAL in flags}"
+		)
 
-	flags=[]
+		msg_err=main_verify(
+			filepath,
+			chunk_size=chunk_size,
+			workers=util_get_workers(pos_args),
+			incremental=(_FLAG_INCREMENTAL in flags)
+		)
+		if msg_err is not None:
+			print(f"\n{msg_err}")
 
-	if cmd==_CMD_NEW:
+	if cmd==_CMD_SNAPSHOT:
 
-		print("\n- Creating new virtual disk")
+		print("\n- Managing the snapshot of a virtual disk")
 
 		filepath=util_fixpath(
 			basedir,
 			pos_args[_ARG_OFILE]
 		)
-		file_size=pos_args[_ARG_SIZE]
 
-		if _ARG_MTARGET in pos_args.keys():
-			path_mpoint=util_fixpath(
-				basedir,
-				pos_args[_ARG_MTARGET]
-			)
+		action=util_fixstring(
+			pos_args.get(_ARG_ACTION,_SNAPSHOT_CREATE),
+			low=True
+		)
 
-		if _ARG_MONGO_DATA in pos_args.keys():
-			path_mongo_data=util_fixpath(
+		hook:Optional[Path]=None
+		if _ARG_HOOK in pos_args.keys():
+			hook=util_fixpath(
 				basedir,
-				pos_args[_ARG_MONGO_DATA]
+				pos_args[_ARG_HOOK]
 			)
-			then_mount=True
-			then_setup=True
 
-		if _ARG_MONGO_LOGS in pos_args.keys():
-			path_mongo_logs=util_fixpath(
-				basedir,
-				pos_args[_ARG_MONGO_LOGS]
+		stream_out:Optional[Union[Path,BinaryIO]]=None
+		if _ARG_STREAM in pos_args.keys():
+			stream_out=stdio_out
+			if not pos_args[_ARG_STREAM]==_STREAM_STDIO:
+				stream_out=util_fixpath(
+					basedir,
+					pos_args[_ARG_STREAM]
+				)
+
+		codec=util_fixstring(
+			pos_args.get(_ARG_COMPRESS,_CODEC_NONE),
+			low=True
+		)
+
+		print(
+			"\nParameters:"
+			f"\nFilepath: {str(filepath)}"
+			f"\nAction: {action}"
+			f"\nHook: {hook}"
+			f"\nStream: {pos_args.get(_ARG_STREAM)}"
+		)
+
+		msg_err=main_snapshot(
+			filepath,
+			action,
+			hook=hook,
+			output=stream_out,
+			codec=codec,
+			workers=util_get_workers(pos_args)
+		)
+		if msg_err is not None:
+			print(f"\n{msg_err}")
+
+	if cmd==_CMD_IO:
+
+		print("\n- Setting the I/O rules of a virtual disk")
+
+		filepath=util_fixpath(
+			basedir,
+			pos_args[_ARG_OFILE]
+		)
+		if _ARG_FLAGS in pos_args.keys():
+			flags.extend(
+				util_extract_flags(
+					pos_args[_ARG_FLAGS]
+				)
 			)
-			then_mount=True
-			then_setup=True
 
+		cgroup:Optional[Path]=None
+		if _ARG_CGROUP in pos_args.keys():
+			cgroup=Path(pos_args[_ARG_CGROUP])
+
+		io_max:Optional[Mapping]=None
+		if _ARG_IO_MAX in pos_args.keys():
+			io_max=util_parse_io_max(pos_args[_ARG_IO_MAX])
+			if io_max is None:
+				print("\nInvalid value for",_ARG_IO_MAX)
+				sys_exit(1)
+
+		io_weight:Optional[int]=None
+		if _ARG_IO_WEIGHT in pos_args.keys():
+			if not pos_args[_ARG_IO_WEIGHT].isdigit():
+				print("\nInvalid value for",_ARG_IO_WEIGHT)
+				sys_exit(1)
+			io_weight=int(pos_args[_ARG_IO_WEIGHT])
+
+		io_latency:Optional[int]=None
+		if _ARG_IO_LATENCY in pos_args.keys():
+			if not pos_args[_ARG_IO_LATENCY].isdigit():
+				print("\nInvalid value for",_ARG_IO_LATENCY,"(microseconds)")
+				sys_exit(1)
+			io_latency=int(pos_args[_ARG_IO_LATENCY])
+
+		print(
+			"\nParameters:"
+			f"\nFilepath: {str(filepath)}"
+			f"\nCgroup: {cgroup}"
+			f"\nMax: {io_max}"
+			f"\nWeight: {io_weight}"
+			f"\nLatency target (microseconds): {io_latency}"
+			f"\nClear: {_FLAG_CLEAR in flags}"
+		)
+
+		msg_err=main_io(
+			filepath,
+			cgroup=cgroup,
+			io_max=io_max,
+			weight=io_weight,
+			latency=io_latency,
+			clear=(_FLAG_CLEAR in flags)
+		)
+		if msg_err is not None:
+			print(f"\n{msg_err}")
+
+	if cmd==_CMD_TENANT:
+
+		print("\n- Managing a tenant of a shared virtual disk")
+
+		filepath=util_fixpath(
+			basedir,
+			pos_args[_ARG_OFILE]
+		)
 		if _ARG_FLAGS in pos_args.keys():
 			flags.extend(
 				util_extract_flags(
@@ -460,168 +7025,318 @@ if __name__=="__main__":
 				)
 			)
 
-		if _FLAG_SETUP in flags:
-			then_setup=True
+		tenant=pos_args.get(_ARG_TENANT)
+		if tenant is None:
+			print("\nThe tenant is missing:",_ARG_TENANT)
+			sys_exit(1)
 
-		if _FLAG_TEST in flags:
-			then_mount=True
-			then_setup=True
-			then_clean=True
-			then_destroy=True
+		max_bytes:Optional[int]=None
+		if _ARG_QUOTA in pos_args.keys():
+			max_bytes=util_parse_size(pos_args[_ARG_QUOTA])
+			if max_bytes is None:
+				print("\nInvalid value for",_ARG_QUOTA)
+				sys_exit(1)
 
-		if path_mpoint is None:
-			path_mpoint=Path(_DIR_MOUNT_DEFAULT)
+		max_inodes:Optional[int]=None
+		if _ARG_INODES in pos_args.keys():
+			if not pos_args[_ARG_INODES].isdigit():
+				print("\nInvalid value for",_ARG_INODES)
+				sys_exit(1)
+			max_inodes=int(pos_args[_ARG_INODES])
 
 		print(
 			"\nParameters:"
 			f"\nFilepath: {str(filepath)}"
-			f"\nFile size: {file_size}"
-			f"\nMountpoint: {path_mpoint}"
+			f"\nTenant: {tenant}"
+			f"\nQuota (bytes): {max_bytes}"
+			f"\nInodes: {max_inodes}"
+			f"\nRemove: {_FLAG_REMOVE in flags}"
 		)
 
-		msg_err=main_create(
+		msg_err=main_tenant(
 			filepath,
-			file_size,
-			path_mpoint
+			tenant,
+			max_bytes=max_bytes,
+			max_inodes=max_inodes,
+			remove=(_FLAG_REMOVE in flags)
 		)
 		if msg_err is not None:
 			print(f"\n{msg_err}")
 
-	if cmd==_CMD_MOUNT or then_mount or then_setup:
+	if cmd==_CMD_ARCHIVE:
 
-		print("\n- Mounting virtual disk")
+		print("\n- Packing a detached virtual disk into a read-only archive")
 
-		if cmd==_CMD_MOUNT:
+		filepath=util_fixpath(
+			basedir,
+			pos_args[_ARG_OFILE]
+		)
+		if _ARG_FLAGS in pos_args.keys():
+			flags.extend(
+				util_extract_flags(
+					pos_args[_ARG_FLAGS]
+				)
+			)
 
-			filepath=util_fixpath(
+		fstype=util_fixstring(pos_args.get(_ARG_FSTYPE,_FSTYPE_SQUASHFS),low=True)
+		archive=filepath.with_name(f"{filepath.name}.{fstype}")
+		if _ARG_ARCHIVE in pos_args.keys():
+			archive=util_fixpath(
 				basedir,
-				pos_args[_ARG_OFILE]
+				pos_args[_ARG_ARCHIVE]
 			)
 
-			if _ARG_MTARGET in pos_args.keys():
-				path_mpoint=util_fixpath(
-					basedir,
-					pos_args[_ARG_MTARGET]
-				)
+		compressor=util_fixstring(pos_args.get(_ARG_COMPRESS),low=True)
 
-			if _ARG_MONGO_DATA in pos_args.keys():
-				path_mongo_data=util_fixpath(
-					basedir,
-					pos_args[_ARG_MONGO_DATA]
-				)
-				then_setup=True
+		print(
+			"\nParameters:"
+			f"\nFilepath: {str(filepath)}"
+			f"\nArchive: {str(archive)}"
+			f"\nType: {fstype}"
+			f"\nCompressor: {compressor}"
+			f"\nDestroy the image: {_FLAG_DESTROY in flags}"
+		)
 
-			if _ARG_MONGO_LOGS in pos_args.keys():
-				path_mongo_logs=util_fixpath(
-					basedir,
-					pos_args[_ARG_MONGO_LOGS]
-				)
-				then_setup=True
+		result=main_archive(
+			filepath,
+			archive,
+			fstype=fstype,
+			compressor=compressor
+		)
+		if isinstance(result,str):
+			print(f"\n{result}")
+		else:
+			print(
+				"\n"+json_dumps(result,indent=1)
+			)
 
-			if _ARG_FLAGS in pos_args.keys():
-				flags.extend(
-					util_extract_flags(
-						pos_args[_ARG_FLAGS]
-					)
-				)
+			if _FLAG_DESTROY in flags:
+				msg_err=main_destroy(filepath)
+				if msg_err is not None:
+					print(f"\n{msg_err}")
+				if not filepath.exists():
+					print("\nFILE DESTROYED")
 
-			if _FLAG_SETUP in flags:
-				then_setup=True
+	if cmd==_CMD_SHRINK:
 
-			if _FLAG_TEST in flags:
-				then_setup=True
-				then_clean=True
+		print("\n- Shrinking a detached virtual disk")
 
-		if path_mpoint is None:
-			path_mpoint=Path(_DIR_MOUNT_DEFAULT)
+		filepath=util_fixpath(
+			basedir,
+			pos_args[_ARG_OFILE]
+		)
+		if _ARG_FLAGS in pos_args.keys():
+			flags.extend(
+				util_extract_flags(
+					pos_args[_ARG_FLAGS]
+				)
+			)
+
+		target_size:Optional[int]=None
+		if _ARG_SIZE in pos_args.keys():
+			target_size=util_parse_size(pos_args[_ARG_SIZE])
+			if target_size is None:
+				print("\nInvalid value for",_ARG_SIZE)
+				sys_exit(1)
+
+		headroom=_SHRINK_HEADROOM
+		if _ARG_HEADROOM in pos_args.keys():
+			try:
+				headroom=float(pos_args[_ARG_HEADROOM].strip().rstrip("%"))/100
+			except ValueError:
+				print("\nInvalid value for",_ARG_HEADROOM,"(a percentage)")
+				sys_exit(1)
 
 		print(
 			"\nParameters:"
 			f"\nFilepath: {str(filepath)}"
-			f"\nMountpoint: {str(path_mpoint)}"
+			f"\nTarget size: {target_size}"
+			f"\nHeadroom: {headroom}"
+			f"\nEstimate only: {_FLAG_ESTIMATE in flags}"
 		)
 
-		msg_err=main_mount(
+		result=main_shrink(
 			filepath,
-			path_mpoint
+			target_size=target_size,
+			headroom=headroom,
+			estimate_only=(_FLAG_ESTIMATE in flags)
 		)
-		if msg_err is not None:
-			print(f"\n{msg_err}")
+		if isinstance(result,str):
+			print(f"\n{result}")
+		else:
+			print(
+				"\n"+json_dumps(result,indent=1)
+			)
 
-	if cmd==_CMD_SETUP or then_setup:
+	if cmd==_CMD_BENCH:
 
-		print("\n- Setting up bind mounts from the partition to the specified directories")
+		print("\n- Benchmarking a mounted virtual disk")
 
-		if cmd==_CMD_SETUP:
+		filepath=util_fixpath(
+			basedir,
+			pos_args[_ARG_OFILE]
+		)
 
-			filepath=util_fixpath(
+		bench_size=util_parse_size(pos_args.get(_ARG_SIZE))
+		if bench_size is None:
+			bench_size=_BENCH_FILE_SIZE
+
+		duration=_BENCH_DURATION
+		try:
+			duration=float(pos_args.get(_ARG_DURATION,_BENCH_DURATION))
+		except ValueError:
+			print("\nInvalid duration, using the default")
+
+		path_report:Optional[Path]=None
+		if _ARG_REPORT in pos_args.keys():
+			path_report=util_fixpath(
 				basedir,
-				pos_args[_ARG_OFILE]
+				pos_args[_ARG_REPORT]
 			)
-			if _ARG_MONGO_DATA in pos_args.keys():
-				path_mongo_data=util_fixpath(
-					basedir,
-					pos_args[_ARG_MONGO_DATA]
+
+		print(
+			"\nParameters:"
+			f"\nFilepath: {str(filepath)}"
+			f"\nFile size: {bench_size}"
+			f"\nDuration: {duration}"
+			f"\nReport: {path_report}"
+		)
+
+		result=main_bench(
+			filepath,
+			file_size=bench_size,
+			duration=duration,
+			workers=util_get_workers(pos_args),
+			report=path_report
+		)
+		if isinstance(result,str):
+			print(f"\n{result}")
+		else:
+			print(
+				"\n"+json_dumps(result,indent=1)
+			)
+
+	if cmd==_CMD_STATUS:
+
+		filepath=util_fixpath(
+			basedir,
+			pos_args[_ARG_OFILE]
+		)
+
+		result=main_status(filepath)
+		if isinstance(result,str):
+			print(f"\n{result}")
+		else:
+			print(
+				"\n"+json_dumps(result,indent=1)
+			)
+
+	if cmd==_CMD_CHECK:
+
+		print("\n- Checking the filesystems")
+
+		check_files:Optional[list]=None
+		if _ARG_OFILE in pos_args.keys():
+			check_files=[]
+			for fse in pos_args[_ARG_OFILE].split(","):
+				fse_ok=util_fixstring(fse)
+				if fse_ok is None:
+					continue
+				check_files.append(
+					util_fixpath(basedir,fse_ok)
 				)
-			if _ARG_MONGO_LOGS in pos_args.keys():
-				path_mongo_logs=util_fixpath(
-					basedir,
-					pos_args[_ARG_MONGO_LOGS]
+
+		if _ARG_FLAGS in pos_args.keys():
+			flags.extend(
+				util_extract_flags(
+					pos_args[_ARG_FLAGS]
 				)
-			if _ARG_FLAGS in pos_args.keys():
-				flags.extend(
-					util_extract_flags(
-						pos_args[_ARG_FLAGS]
-					)
+			)
+
+		per_disk=_CHECK_PER_DISK
+		value=util_fixstring(pos_args.get(_ARG_PER_DISK))
+		if value is not None:
+			if not value.isdigit():
+				print("\nInvalid value for",_ARG_PER_DISK)
+				sys_exit(1)
+			per_disk=max(1,int(value))
+
+		print(
+			"\nParameters:"
+			f"\nFiles: {'registered' if check_files is None else [str(fse) for fse in check_files]}"
+			f"\nChecks per disk: {per_disk}"
+			f"\nMount the clean ones (and the ones with a journal to replay): {_FLAG_MOUNT in flags}"
+		)
+
+		result=main_check(
+			check_files,
+			per_disk=per_disk,
+			workers=util_get_workers(pos_args,default=_CHECK_WORKERS)
+		)
+		if isinstance(result,str):
+			print(f"\n{result}")
+		else:
+			print(
+				"\n"+json_dumps(result,indent=1)
+			)
+
+		if _FLAG_MOUNT in flags and not isinstance(result,str):
+			print("\n- Mounting the registered images that are clean (mounting replays the journals)")
+			result=main_mount_all(
+				result["summary"][_CHECK_CLEAN]+result["summary"][_CHECK_NEEDS_REPLAY]
+			)
+			if isinstance(result,str):
+				print(f"\n{result}")
+			else:
+				print(
+					"\n"+json_dumps(result,indent=1)
 				)
 
-			if _FLAG_TEST in flags:
-				then_clean=True
+	if cmd in (_CMD_STATUS_ALL,_CMD_MOUNT_ALL,_CMD_CLEAN_ALL):
 
-		if path_mongo_data is None:
-			path_mongo_data=Path(_DIR_DEFAULT_DATA)
-		if path_mongo_logs is None:
-			path_mongo_logs=Path(_DIR_DEFAULT_LOGS)
+		if _ARG_FLAGS in pos_args.keys():
+			flags.extend(
+				util_extract_flags(
+					pos_args[_ARG_FLAGS]
+				)
+			)
 
 		print(
 			"\nParameters:"
-			f"\nFilepath: {str(filepath)}"
-			f"\nMongoDB Data: {str(path_mongo_data)}"
-			f"\nMongoDB Logs: {str(path_mongo_logs)}"
+			f"\nRegistry: {_REGISTRY_PATH}"
 		)
 
-		msg_err=main_setup(
-			filepath,
-			path_mongo_data,
-			path_mongo_logs
-		)
-		if msg_err is not None:
-			print(f"\n{msg_err}")
+		if cmd==_CMD_STATUS_ALL:
+			result=main_status_all()
+		if cmd==_CMD_MOUNT_ALL:
+			print("\n- Mounting every registered image")
+			result=main_mount_all()
+		if cmd==_CMD_CLEAN_ALL:
+			print("\n- Cleaning every registered image")
+			result=main_clean_all(
+				autoclear=(_FLAG_AUTOCLEAR in flags)
+			)
 
-	if cmd==_CMD_CLEAN or then_clean:
+		if isinstance(result,str):
+			print(f"\n{result}")
+		else:
+			print(
+				"\n"+json_dumps(result,indent=1)
+			)
 
-		if cmd==_CMD_CLEAN:
+	if cmd==_CMD_AGENT:
 
-			filepath=util_fixpath(
+		print("\n- Running as an agent")
+
+		socket_path=Path(_AGENT_SOCKET_DEFAULT)
+		if _ARG_SOCKET in pos_args.keys():
+			socket_path=util_fixpath(
 				basedir,
-				pos_args[_ARG_OFILE]
+				pos_args[_ARG_SOCKET]
 			)
-			if _ARG_FLAGS in pos_args.keys():
-				flags.extend(
-					util_extract_flags(
-						pos_args[_ARG_FLAGS]
-					)
-				)
-
-			then_destroy=(_FLAG_DESTROY in flags)
 
-		msg_err=main_clean(filepath)
+		msg_err=main_agent(socket_path)
 		if msg_err is not None:
 			print(f"\n{msg_err}")
 
-		if then_destroy and (msg_err is None):
-			filepath.unlink()
-			if not filepath.exists():
-				print("\nFILE DESTROYED")
-
 	print("\nEND OF PROGRAM\n")
@@ -0,0 +1,7 @@
+# The modules are plain scripts at the root of the repository
+
+import sys
+
+from pathlib import Path
+
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,328 @@
+# Whole commands run against real images: root, loop devices and the tools of each feature are needed
+# A test is skipped when the host lacks what it exercises, the reason says what is missing
+
+import errno
+import json
+import os
+import struct
+import subprocess
+
+from pathlib import Path
+from shutil import which
+
+import pytest
+
+import mongolical
+
+from fstoolkit import (
+	_MBR_SECTOR_SIZE,
+	_MBR_ENTRIES_OFFSET,
+	_MBR_ENTRY,
+	_MBR_SIGNATURE,
+	_MBR_CHS_BEYOND,
+	_FSTYPE_SQUASHFS,
+	_FSTYPE_EROFS,
+	util_cgroup2_root,
+)
+from mongolical import (
+	_STEP_ALLOCATED,
+	_STEP_ATTACHED,
+	_STEP_PARTITIONED,
+	_STEP_FORMATTED,
+	_STEP_ENCRYPTED,
+	_STEP_MOUNTED,
+	_STEP_OWNED,
+	_SIDECAR_STEPS,
+	_CRYPT_KEY_SIZE,
+	util_sidecar_path,
+	main_create,
+	main_mount,
+	main_clean,
+	main_io,
+	main_tenant,
+	main_archive,
+	fsutil_shared_root,
+)
+
+MiB=1024*1024
+
+needs_root=pytest.mark.skipif(
+	not os.geteuid()==0,
+	reason="needs root"
+)
+
+def needs_tools(*names:str):
+	missing=[name for name in names if which(name) is None]
+	return pytest.mark.skipif(
+		len(missing)>0,
+		reason=f"missing: {' '.join(missing)}"
+	)
+
+needs_dm=pytest.mark.skipif(
+	not Path("/dev/mapper/control").exists(),
+	reason="no device-mapper"
+)
+
+def io_controller()->bool:
+	root=util_cgroup2_root()
+	if root is None:
+		return False
+	return "io" in root.joinpath("cgroup.controllers").read_text().split()
+
+needs_io=pytest.mark.skipif(
+	not io_controller(),
+	reason="no io controller in the cgroup v2 hierarchy"
+)
+
+def quota_format()->bool:
+
+	# ext4 keeps its quotas in the v2 format, built in or as a module
+
+	if Path("/sys/module/quota_v2").is_dir():
+		return True
+	with open("/proc/kallsyms") as symbols:
+		if any(line.endswith(" v2_read_dquot\n") for line in symbols):
+			return True
+	modules=Path("/lib/modules",os.uname().release)
+	return next(modules.rglob("quota_v2.ko*"),None) is not None
+
+needs_quota=pytest.mark.skipif(
+	not quota_format(),
+	reason="the kernel has no quota v2 support"
+)
+
+@pytest.fixture(autouse=True)
+def registry(tmp_path,monkeypatch):
+
+	# The registry of the host is left alone
+
+	monkeypatch.setattr(mongolical,"_REGISTRY_PATH",str(tmp_path.joinpath("registry.json")))
+
+@pytest.fixture
+def images():
+
+	# Images are unmounted and detached whatever the outcome of the test
+
+	created=[]
+	yield created
+	for filepath in reversed(created):
+		main_clean(filepath,autoclear=True)
+
+def steps_of(filepath:Path)->dict:
+	return json.loads(util_sidecar_path(filepath,_SIDECAR_STEPS).read_text())
+
+# user-044: an interrupted `new` picks up where it stopped
+
+@needs_root
+@needs_tools("parted","mkfs.ext4")
+def test_new_resumes_after_a_failed_mount(tmp_path,images):
+	filepath=tmp_path.joinpath("vol.img")
+	images.append(filepath)
+
+	# A file where the mountpoint goes: everything up to mounting is done, then it fails
+
+	blocker=tmp_path.joinpath("blocker")
+	blocker.write_text("in the way")
+	mountpoint=blocker.joinpath("mnt")
+
+	assert main_create(filepath,"128M",mountpoint,journal_size=16*MiB) is not None
+	first=steps_of(filepath)
+	assert first["done"]==[_STEP_ALLOCATED,_STEP_ATTACHED,_STEP_PARTITIONED,_STEP_FORMATTED]
+
+	blocker.unlink()
+	assert main_create(filepath,"128M",mountpoint,journal_size=16*MiB) is None
+	second=steps_of(filepath)
+	assert _STEP_MOUNTED in second["done"]
+	assert _STEP_OWNED in second["done"]
+
+	# Nothing was partitioned or formatted again
+
+	for step in (_STEP_ALLOCATED,_STEP_PARTITIONED,_STEP_FORMATTED):
+		assert second["details"][step]==first["details"][step]
+
+@needs_root
+@needs_tools("parted","mkfs.ext4")
+def test_new_partitions_again_when_the_table_is_gone(tmp_path,images):
+	filepath=tmp_path.joinpath("vol.img")
+	images.append(filepath)
+
+	blocker=tmp_path.joinpath("blocker")
+	blocker.write_text("in the way")
+	mountpoint=blocker.joinpath("mnt")
+
+	assert main_create(filepath,"128M",mountpoint) is not None
+	first=steps_of(filepath)
+	assert main_clean(filepath) is None
+
+	with open(filepath,"r+b") as image:
+		image.write(bytes(512))
+
+	blocker.unlink()
+	assert main_create(filepath,"128M",mountpoint) is None
+	second=steps_of(filepath)
+
+	assert second["details"][_STEP_ALLOCATED]==first["details"][_STEP_ALLOCATED]
+	for step in (_STEP_PARTITIONED,_STEP_FORMATTED):
+		assert second["details"][step]["time"]>first["details"][step]["time"]
+
+# user-040: dm-crypt
+
+def image_holds(filepath:Path,needle:bytes)->bool:
+	with open(filepath,"rb") as image:
+		tail=b""
+		while True:
+			chunk=image.read(4*MiB)
+			if len(chunk)==0:
+				return False
+			if needle in tail+chunk:
+				return True
+			tail=chunk[-len(needle):]
+
+@needs_root
+@needs_tools("parted","mkfs.ext4","dmsetup")
+@needs_dm
+def test_encrypted_volume_survives_a_remount(tmp_path,images):
+	filepath=tmp_path.joinpath("vol.img")
+	images.append(filepath)
+	keyfile=tmp_path.joinpath("vol.key")
+	mountpoint=tmp_path.joinpath("mnt")
+
+	assert main_create(filepath,"128M",mountpoint,encrypt=keyfile) is None
+	assert keyfile.stat().st_size==_CRYPT_KEY_SIZE
+	assert _STEP_ENCRYPTED in steps_of(filepath)["done"]
+
+	payload=os.urandom(64*1024)
+	mountpoint.joinpath("probe").write_bytes(payload)
+	assert main_clean(filepath) is None
+
+	# Only the ciphertext reaches the image
+
+	assert not image_holds(filepath,payload[:4096])
+
+	assert main_mount(filepath,mountpoint) is None
+	assert mountpoint.joinpath("probe").read_bytes()==payload
+
+# user-042: I/O rules of the cgroup mongod runs in
+
+@pytest.fixture
+def cgroup():
+	root=util_cgroup2_root()
+	root.joinpath("cgroup.subtree_control").write_text("+io")
+	child=root.joinpath(f"mongolical-test-{os.getpid()}")
+	child.mkdir()
+	yield child
+	child.rmdir()
+
+def io_max_of(cgroup:Path)->str:
+	return cgroup.joinpath("io.max").read_text()
+
+@needs_root
+@needs_tools("parted","mkfs.ext4")
+@needs_io
+def test_io_rules_follow_the_volume(tmp_path,images,cgroup):
+	filepath=tmp_path.joinpath("vol.img")
+	images.append(filepath)
+	mountpoint=tmp_path.joinpath("mnt")
+
+	assert main_create(filepath,"128M",mountpoint) is None
+	assert main_io(filepath,cgroup=cgroup,io_max={"wbps":10*MiB}) is None
+	assert f"wbps={10*MiB}" in io_max_of(cgroup)
+
+	# The loop device is a new one after a clean and a mount, the rules are applied to it again
+
+	assert main_clean(filepath) is None
+	assert main_mount(filepath,mountpoint) is None
+	assert f"wbps={10*MiB}" in io_max_of(cgroup)
+
+	assert main_io(filepath,clear=True) is None
+	assert f"wbps={10*MiB}" not in io_max_of(cgroup)
+
+def test_io_rules_that_cannot_be_applied_are_not_kept(tmp_path):
+
+	# A directory that is not a cgroup has no io.max
+
+	filepath=tmp_path.joinpath("vol.img")
+	filepath.write_bytes(bytes(MiB))
+
+	assert main_io(filepath,cgroup=tmp_path,io_max={"wbps":10*MiB}) is not None
+	assert mongolical.util_read_descriptor(filepath).get("io") is None
+
+# user-043: tenants of a shared volume
+
+@needs_root
+@needs_tools("parted","mkfs.ext4")
+@needs_quota
+def test_tenant_quota_is_enforced(tmp_path,images):
+	filepath=tmp_path.joinpath("vol.img")
+	images.append(filepath)
+
+	assert main_create(filepath,"128M",tmp_path.joinpath("mnt"),shared=True) is None
+	assert main_tenant(filepath,"t1",max_bytes=4*MiB) is None
+
+	dir_tenant=fsutil_shared_root(filepath)[1].joinpath("t1")
+	with pytest.raises(OSError) as exc:
+		with open(dir_tenant.joinpath("data","fill"),"wb") as fill:
+			for _ in range(8):
+				fill.write(bytes(MiB))
+				fill.flush()
+				os.fsync(fill.fileno())
+	assert exc.value.errno==errno.EDQUOT
+
+	# Lifting the limit lets the tenant grow again
+
+	assert main_tenant(filepath,"t1",max_bytes=0) is None
+	with open(dir_tenant.joinpath("data","fill"),"ab") as fill:
+		fill.write(bytes(4*MiB))
+
+	assert main_tenant(filepath,"t1",remove=True) is None
+	assert not dir_tenant.exists()
+
+# user-050: read-only archives of a detached image
+
+def make_image(filepath:Path,content:Path,size:int=64*MiB):
+
+	# One ext4 partition at 1 MiB holding the given tree, without parted
+
+	start=MiB//_MBR_SECTOR_SIZE
+	sectors=(size-MiB)//_MBR_SECTOR_SIZE
+	with open(filepath,"wb") as image:
+		image.truncate(size)
+		image.seek(_MBR_ENTRIES_OFFSET)
+		image.write(struct.pack(_MBR_ENTRY,0,_MBR_CHS_BEYOND,0x83,_MBR_CHS_BEYOND,start,sectors))
+		image.seek(_MBR_SECTOR_SIZE-len(_MBR_SIGNATURE))
+		image.write(_MBR_SIGNATURE)
+	subprocess.run(
+		["mkfs.ext4","-q","-F","-E",f"offset={MiB}","-d",str(content),str(filepath),f"{sectors//2}k"],
+		check=True
+	)
+
+@needs_root
+@needs_tools("mkfs.ext4")
+@pytest.mark.parametrize(
+	"fstype,tool",
+	[(_FSTYPE_SQUASHFS,"mksquashfs"),(_FSTYPE_EROFS,"mkfs.erofs")]
+)
+def test_archive_mounts_read_only(tmp_path,images,fstype,tool):
+	if which(tool) is None:
+		pytest.skip(f"missing: {tool}")
+
+	content=tmp_path.joinpath("content")
+	content.joinpath("data").mkdir(parents=True)
+	content.joinpath("logs").mkdir()
+	payload=os.urandom(256*1024)
+	content.joinpath("data","probe").write_bytes(payload)
+
+	filepath=tmp_path.joinpath("vol.img")
+	make_image(filepath,content)
+
+	archive=tmp_path.joinpath(f"vol.{fstype}")
+	images.append(archive)
+	assert isinstance(main_archive(filepath,archive,fstype=fstype),dict)
+
+	mountpoint=tmp_path.joinpath("mnt")
+	assert main_mount(archive,mountpoint) is None
+	assert mountpoint.joinpath("data","probe").read_bytes()==payload
+
+	with pytest.raises(OSError) as exc:
+		mountpoint.joinpath("data","other").write_bytes(b"x")
+	assert exc.value.errno==errno.EROFS
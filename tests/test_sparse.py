@@ -0,0 +1,163 @@
+# Sparse stream: fun_sparse_export and fun_sparse_import, no root needed
+
+from io import BytesIO
+
+from struct import pack as struct_pack,unpack as struct_unpack
+
+import pytest
+
+from fstoolkit import (
+	_CODECS,
+	_SPARSE_MAGIC,
+	_SPARSE_RECORD,
+	_SPARSE_RECORD_SIZE,
+	_SPARSE_CHUNK_SIZE_MAX,
+	fun_sparse_export,
+	fun_sparse_import,
+)
+
+CHUNK=64*1024
+
+def make_image(path,size=1024*1024):
+
+	# Data at the start, in the middle (across a chunk boundary) and a zeroed but allocated block, the rest is a hole
+
+	with open(path,"wb") as f:
+		f.truncate(size)
+		f.seek(0)
+		f.write(b"head"*1000)
+		f.seek(3*CHUNK-100)
+		f.write(bytes(range(256))*4)
+		f.seek(8*CHUNK)
+		f.write(bytes(CHUNK))
+
+	return path.read_bytes()
+
+def export(src,codec="none",chunk_size=CHUNK):
+	out=BytesIO()
+	result=fun_sparse_export(src,out,codec=codec,chunk_size=chunk_size,workers=2)
+	assert isinstance(result,dict),result
+	return out.getvalue(),result
+
+def first_record(stream:bytes)->int:
+
+	# The offset of the first record, right after the header
+
+	header_len=struct_unpack("<I",stream[len(_SPARSE_MAGIC):len(_SPARSE_MAGIC)+4])[0]
+	return len(_SPARSE_MAGIC)+4+header_len
+
+@pytest.mark.parametrize("codec",sorted(_CODECS.keys()))
+def test_round_trip(tmp_path,codec):
+	src=tmp_path.joinpath("src.img")
+	original=make_image(src)
+
+	stream,stats=export(src,codec=codec)
+	assert stats["size"]==len(original)
+
+	# The head, and the two chunks the middle write spans: the zeroed block and the hole are not stored
+
+	assert stats["chunks"]==3
+
+	dst=tmp_path.joinpath("dst.img")
+	result=fun_sparse_import(BytesIO(stream),dst,workers=2)
+	assert isinstance(result,dict),result
+	assert result["chunks"]==3
+	assert dst.read_bytes()==original
+
+def test_empty_file(tmp_path):
+	src=tmp_path.joinpath("src.img")
+	src.write_bytes(b"")
+
+	stream,stats=export(src)
+	assert stats["chunks"]==0
+
+	dst=tmp_path.joinpath("dst.img")
+	assert isinstance(fun_sparse_import(BytesIO(stream),dst),dict)
+	assert dst.read_bytes()==b""
+
+@pytest.mark.parametrize("chunk_size",[0,-1,_SPARSE_CHUNK_SIZE_MAX+1])
+def test_export_rejects_chunk_size(tmp_path,chunk_size):
+	src=tmp_path.joinpath("src.img")
+	make_image(src)
+
+	out=BytesIO()
+	result=fun_sparse_export(src,out,chunk_size=chunk_size)
+	assert isinstance(result,str)
+	assert out.getvalue()==b""
+
+def test_export_rejects_codec(tmp_path):
+	src=tmp_path.joinpath("src.img")
+	make_image(src)
+
+	assert fun_sparse_export(src,BytesIO(),codec="nope")=="unknown codec: nope"
+
+def test_checksum_mismatch(tmp_path):
+	src=tmp_path.joinpath("src.img")
+	make_image(src)
+	stream=bytearray(export(src)[0])
+
+	# Uncompressed, so flipping a stored byte keeps the length and breaks only the CRC
+
+	stream[first_record(stream)+_SPARSE_RECORD_SIZE+10]^=0xFF
+
+	dst=tmp_path.joinpath("dst.img")
+	result=fun_sparse_import(BytesIO(bytes(stream)),dst)
+	assert isinstance(result,str)
+	assert "checksum mismatch" in result
+	assert not dst.exists()
+
+def test_wrong_length(tmp_path):
+	src=tmp_path.joinpath("src.img")
+	make_image(src)
+	stream=bytearray(export(src)[0])
+
+	pos=first_record(stream)
+	offset,raw_len,stored_len,crc=struct_unpack(_SPARSE_RECORD,stream[pos:pos+_SPARSE_RECORD_SIZE])
+	stream[pos:pos+_SPARSE_RECORD_SIZE]=struct_pack(_SPARSE_RECORD,offset,raw_len+1,stored_len,crc)
+
+	dst=tmp_path.joinpath("dst.img")
+	result=fun_sparse_import(BytesIO(bytes(stream)),dst)
+	assert "wrong length" in result
+	assert not dst.exists()
+
+def test_out_of_bounds(tmp_path):
+	src=tmp_path.joinpath("src.img")
+	make_image(src)
+	stream=bytearray(export(src)[0])
+
+	pos=first_record(stream)
+	_,raw_len,stored_len,crc=struct_unpack(_SPARSE_RECORD,stream[pos:pos+_SPARSE_RECORD_SIZE])
+	stream[pos:pos+_SPARSE_RECORD_SIZE]=struct_pack(_SPARSE_RECORD,2**40,raw_len,stored_len,crc)
+
+	dst=tmp_path.joinpath("dst.img")
+	result=fun_sparse_import(BytesIO(bytes(stream)),dst)
+	assert "out of bounds" in result
+	assert not dst.exists()
+
+@pytest.mark.parametrize("cut",[1,_SPARSE_RECORD_SIZE,_SPARSE_RECORD_SIZE+100])
+def test_truncated_stream(tmp_path,cut):
+	src=tmp_path.joinpath("src.img")
+	make_image(src)
+	stream=export(src,codec="zlib")[0]
+
+	dst=tmp_path.joinpath("dst.img")
+	result=fun_sparse_import(BytesIO(stream[:-cut]),dst)
+	assert isinstance(result,str)
+	assert "ended unexpectedly" in result
+	assert not dst.exists()
+
+def test_not_a_stream(tmp_path):
+	dst=tmp_path.joinpath("dst.img")
+	assert fun_sparse_import(BytesIO(b"garbage garbage"),dst)=="not a sparse stream"
+	assert not dst.exists()
+
+def test_import_keeps_existing_file(tmp_path):
+	src=tmp_path.joinpath("src.img")
+	make_image(src)
+	stream=export(src)[0]
+
+	dst=tmp_path.joinpath("dst.img")
+	dst.write_bytes(b"keep")
+	result=fun_sparse_import(BytesIO(stream),dst)
+	assert isinstance(result,str)
+	assert dst.read_bytes()==b"keep"
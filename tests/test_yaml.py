@@ -0,0 +1,111 @@
+# mongod.conf patching: util_yaml_set, util_yaml_check and fsutil_mongod_conf, no root needed
+
+import pytest
+
+import mongolical
+
+from mongolical import (
+	util_yaml_get,
+	util_yaml_set,
+	util_yaml_check,
+	fsutil_mongod_conf,
+)
+
+yaml=pytest.importorskip("yaml")
+
+CONF_4=(
+	"# mongod.conf\n"
+	"storage:\n"
+	"    journal:\n"
+	"        enabled: true\n"
+	"net:\n"
+	"    port: 27017\n"
+	"    bindIp: 127.0.0.1\n"
+	"systemLog:\n"
+	"    logAppend: true\n"
+)
+
+def lines_of(text:str)->list:
+	return text.splitlines(keepends=True)
+
+def test_replace_keeps_everything_else():
+	lines=util_yaml_set(lines_of(CONF_4),("net","port"),"27018")
+	assert "".join(lines)==CONF_4.replace("27017","27018")
+
+def test_new_key_uses_sibling_indentation():
+	lines=util_yaml_set(lines_of(CONF_4),("storage","dbPath"),"/data")
+	assert "    dbPath: /data\n" in lines
+	assert yaml.safe_load("".join(lines))["storage"]["dbPath"]=="/data"
+
+def test_new_parents_follow_document_step():
+	lines=util_yaml_set(
+		lines_of(CONF_4),
+		("storage","wiredTiger","engineConfig","directoryForIndexes"),
+		"true"
+	)
+	text="".join(lines)
+	assert "    wiredTiger:\n        engineConfig:\n            directoryForIndexes: true\n" in text
+	assert yaml.safe_load(text)["storage"]["wiredTiger"]["engineConfig"]["directoryForIndexes"] is True
+
+def test_new_top_level_key():
+	lines=util_yaml_set(lines_of(CONF_4),("processManagement","fork"),"false")
+	parsed=yaml.safe_load("".join(lines))
+	assert parsed["processManagement"]["fork"] is False
+	assert parsed["net"]["port"]==27017
+
+def test_empty_block_falls_back_to_default_step():
+	lines=util_yaml_set(["storage:\n","net:\n","  port: 1\n"],("storage","dbPath"),"/d")
+	assert lines[:2]==["storage:\n","  dbPath: /d\n"]
+
+def test_no_trailing_newline():
+	lines=util_yaml_set(["net:\n","  port: 1"],("systemLog","path"),"/l")
+	assert yaml.safe_load("".join(lines))=={"net":{"port":1},"systemLog":{"path":"/l"}}
+
+def test_get():
+	lines=lines_of(CONF_4)
+	assert util_yaml_get(lines,("net","bindIp"))=="127.0.0.1"
+	assert util_yaml_get(lines,("net","missing")) is None
+
+@pytest.mark.parametrize("with_pyyaml",[True,False])
+def test_check(monkeypatch,with_pyyaml):
+	if not with_pyyaml:
+		monkeypatch.setattr(mongolical,"yaml_safe_load",None)
+
+	assert util_yaml_check(lines_of(CONF_4)) is None
+	assert util_yaml_check(["a:\n","    b: 1\n","  c: 2\n"]) is not None
+
+def test_mongod_conf(tmp_path):
+	conf=tmp_path.joinpath("mongod.conf")
+	conf.write_text(CONF_4)
+	data=tmp_path.joinpath("data")
+	logs=tmp_path.joinpath("logs")
+	data.mkdir()
+
+	assert fsutil_mongod_conf(conf,data,logs) is None
+
+	parsed=yaml.safe_load(conf.read_text())
+	assert parsed["storage"]["dbPath"]==str(data)
+	assert parsed["storage"]["directoryPerDB"] is False
+	assert parsed["storage"]["wiredTiger"]["engineConfig"]["directoryForIndexes"] is True
+	assert parsed["systemLog"]=={"logAppend":True,"destination":"file","path":str(logs.joinpath("mongod.log"))}
+
+def test_mongod_conf_refuses_layout_changes(tmp_path):
+	conf=tmp_path.joinpath("mongod.conf")
+	data=tmp_path.joinpath("data")
+	logs=tmp_path.joinpath("logs")
+	data.mkdir()
+
+	# Collections in the flat layout: directoryForIndexes can not be turned on
+
+	data.joinpath("collection-0-1.wt").write_bytes(b"")
+	conf.write_text(CONF_4)
+	assert fsutil_mongod_conf(conf,data,logs) is not None
+	assert conf.read_text()==CONF_4
+
+	# directoryPerDB can not be flipped on existing data
+
+	data.joinpath("collection-0-1.wt").unlink()
+	data.joinpath("db").mkdir()
+	data.joinpath("db","collection-0-2.wt").write_bytes(b"")
+	assert fsutil_mongod_conf(conf,data,logs,directory_per_db=True) is not None
+	assert conf.read_text()==CONF_4